@@ -47,6 +47,12 @@ falcon_bin=$falcon_dir/'bin'
 root_path='/usr/local/bin'
 falcon_src=$main_dir/'src'/'run_falcon.py'
 falcon_cardiac_src=$main_dir/'src'/'run_falcon_cardiac.py'
+falcon_apply_src=$main_dir/'src'/'run_falcon_apply.py'
+falcon_batch_src=$main_dir/'src'/'run_falcon_batch.py'
+falcon_stream_src=$main_dir/'src'/'run_falcon_stream.py'
+falcon_server_src=$main_dir/'src'/'run_falcon_server.py'
+falcon_worker_src=$main_dir/'src'/'run_falcon_worker.py'
+falcon_tune_src=$main_dir/'src'/'run_falcon_tune.py'
 
 echo '[5] Setting up symlinks for dependencies...'
 sudo ln -s "$falcon_bin"/'c3d' $root_path/'c3d'
@@ -66,6 +72,18 @@ sudo chmod +x "$falcon_src"
 sudo ln -s "$falcon_src" $root_path/'falcon'
 sudo chmod +x "$falcon_cardiac_src"
 sudo ln -s "$falcon_cardiac_src" $root_path/'falcon-cardiac'
+sudo chmod +x "$falcon_apply_src"
+sudo ln -s "$falcon_apply_src" $root_path/'falcon-apply'
+sudo chmod +x "$falcon_batch_src"
+sudo ln -s "$falcon_batch_src" $root_path/'falcon-batch'
+sudo chmod +x "$falcon_stream_src"
+sudo ln -s "$falcon_stream_src" $root_path/'falcon-stream'
+sudo chmod +x "$falcon_server_src"
+sudo ln -s "$falcon_server_src" $root_path/'falcon-server'
+sudo chmod +x "$falcon_worker_src"
+sudo ln -s "$falcon_worker_src" $root_path/'falcon-worker'
+sudo chmod +x "$falcon_tune_src"
+sudo ln -s "$falcon_tune_src" $root_path/'falcon-tune'
 
 echo '[8] Finished installing FALCON!'
 
@@ -20,6 +20,12 @@ if [[ "$OSTYPE" == "linux-gnu"* ]]; then
     echo "[3] Removing falcon from /usr/local/bin..."
     sudo rm /usr/local/bin/falcon
     sudo rm /usr/local/bin/falcon-cardiac
+    sudo rm /usr/local/bin/falcon-apply
+    sudo rm /usr/local/bin/falcon-batch
+    sudo rm /usr/local/bin/falcon-stream
+    sudo rm /usr/local/bin/falcon-server
+    sudo rm /usr/local/bin/falcon-worker
+    sudo rm /usr/local/bin/falcon-tune
     echo "[4] Removing supporting binaries..."
     sudo rm /usr/local/bin/c3d
     sudo rm /usr/local/bin/greedy
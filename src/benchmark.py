@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: benchmark.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: Accuracy and throughput benchmark of FALCON on synthetic phantoms with known motion (see phantom.py).
+# Every registration mode runs the complete pipeline on its own phantom and is judged on speed (time per phase,
+# frames/min, voxels/s, peak RAM) and on accuracy (blob centroid error and image error against the motion-free frames).
+# Runs offline on a CPU-only machine with greedy and c3d installed. The threading modes compare the old free-for-all
+# (every greedy job uses all CPUs) with per-job thread budgets and with workers pinned to NUMA-local core sets.
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+# Imported Libraries
+
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import timeit
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import falcon
+import fileOp as fop
+import phantom
+
+# numpy and SimpleITK are imported inside the functions that need them, like in imageOp
+
+# Blobs are evaluated in frames where their activity is at least this multiple of the body background
+MIN_BLOB_CONTRAST = 2.0
+
+# Registration options of the threading modes, see greedy.get_registration_options
+THREADING_MODES = {'free': {'threads_per_job': 0},
+                   'budget': {'threads_per_job': None},
+                   'pinned': {'threads_per_job': None, 'pin_cores': True}}
+
+
+def load_frames(nifti_files: list) -> list:
+    """
+    Loads the frames of a study as arrays
+    :param nifti_files: A single 4d NIfTI file or a list of 3d NIfTI files
+    :return: List of frame arrays (indexed z, y, x)
+    """
+    import SimpleITK
+    frames = []
+    for nifti_file in nifti_files:
+        img_array = SimpleITK.GetArrayFromImage(SimpleITK.ReadImage(nifti_file, SimpleITK.sitkFloat32))
+        frames.extend(list(img_array) if img_array.ndim == 4 else [img_array])
+    return frames
+
+
+def get_centroid(weights: 'np.ndarray', coordinates: list) -> 'np.ndarray':
+    """
+    Gets the weighted centroid of a region
+    :param weights: Non-negative weights of the voxels, zero outside the region
+    :param coordinates: Physical x, y and z coordinates of the voxels
+    :return: Centroid (x, y, z) in mm
+    """
+    import numpy as np
+    total = weights.sum()
+    if total <= 0:
+        return np.full(3, np.nan)
+    return np.array([(weights * coordinate).sum() / total for coordinate in coordinates])
+
+
+def evaluate_frames(frames: list, ground_truth: dict) -> dict:
+    """
+    Measures how far the frames of a study are from the motion-free frames of its phantom
+    :param frames: Frame arrays of the study (indexed z, y, x), in the order of the ground truth frames
+    :param ground_truth: Ground truth of the phantom, see phantom.create_phantom
+    :return: Dictionary with the mean and maximum blob centroid error in mm and the mean normalized RMSE within the
+    body, over all frames but the reference frame, and the per-frame values
+    """
+    import numpy as np
+    import SimpleITK
+    size, spacing = ground_truth['size'], ground_truth['spacing_mm']
+    z, y, x = np.meshgrid(*[(np.arange(n) - (n - 1) / 2) * spacing for n in size[::-1]], indexing='ij')
+    body_mask = SimpleITK.GetArrayFromImage(SimpleITK.ReadImage(ground_truth['body_mask'])) > 0
+    regions = []
+    for blob in ground_truth['blobs']:
+        center_x, center_y, center_z = blob['center_mm']
+        distance = np.sqrt((x - center_x) ** 2 + (y - center_y) ** 2 + (z - center_z) ** 2)
+        regions.append(distance <= 2 * blob['radius'] + 6)
+
+    centroid_errors, nrmses = [], []
+    for frame, frame_truth in zip(frames[:-1], ground_truth['frames'][:-1]):
+        static = SimpleITK.GetArrayFromImage(SimpleITK.ReadImage(frame_truth['static_frame']))
+        background = float(np.median(static[body_mask]))
+        blob_errors = []
+        for region in regions:
+            peak = float(static[region].max())
+            if peak < MIN_BLOB_CONTRAST * background:
+                continue
+            threshold = background + 0.5 * (peak - background)
+            true_centroid = get_centroid(np.where(region, np.maximum(static - threshold, 0), 0), [x, y, z])
+            frame_centroid = get_centroid(np.where(region, np.maximum(frame - threshold, 0), 0), [x, y, z])
+            blob_errors.append(float(np.linalg.norm(frame_centroid - true_centroid)))
+        centroid_errors.append(float(np.nanmean(blob_errors)) if blob_errors else float('nan'))
+        nrmses.append(float(np.sqrt(np.mean((frame[body_mask] - static[body_mask]) ** 2)) / static[body_mask].mean()))
+    return {'mean_centroid_error_mm': float(np.nanmean(centroid_errors)),
+            'max_centroid_error_mm': float(np.nanmax(centroid_errors)),
+            'mean_nrmse': float(np.mean(nrmses)),
+            'frame_centroid_errors_mm': centroid_errors,
+            'frame_nrmse': nrmses}
+
+
+def get_peak_rss() -> float:
+    """
+    Gets the peak resident memory of this process and of its finished children (worker pools and external tools)
+    :return: Peak resident memory in MB
+    """
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def get_context_switches() -> tuple:
+    """
+    Gets the context switches of this process and of its finished children (worker pools and external tools)
+    :return: Tuple of the voluntary and the involuntary context switches
+    """
+    own_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own_usage.ru_nvcsw + children_usage.ru_nvcsw, own_usage.ru_nivcsw + children_usage.ru_nivcsw
+
+
+def run_case(case_dir: str, registration: str, motion_type: str, multi_resolution_iterations: str, njobs: int,
+             start_frame: int, phantom_options: dict, threading: str = 'budget') -> dict:
+    """
+    Creates a phantom and motion corrects it with FALCON. Run it in a fresh process, so that the peak memory belongs
+    to this case only.
+    :param case_dir: Folder of the case
+    :param registration: Type of registration: rigid | affine | deformable
+    :param motion_type: Type of the phantom motion: rigid | affine | deformable
+    :param multi_resolution_iterations: Number of iterations for each resolution level
+    :param njobs: Number of jobs, None to derive it from the available resources
+    :param start_frame: Frame from which the motion correction is performed, None to detect it
+    :param phantom_options: Additional arguments of phantom.create_phantom
+    :param threading: Threading mode of the registration jobs, see THREADING_MODES
+    :return: Throughput and accuracy of the case
+    """
+    start = timeit.default_timer()
+    ground_truth = phantom.create_phantom(case_dir, motion_type=motion_type, **phantom_options)
+    phantom_time = timeit.default_timer() - start
+    uncorrected = evaluate_frames(load_frames(ground_truth['study_files']), ground_truth)
+
+    config = falcon.RunConfig(main_folder=ground_truth['study_dir'], start_frame=start_frame,
+                              registration=registration, multi_resolution_iterations=multi_resolution_iterations,
+                              njobs=njobs, registration_options=dict(THREADING_MODES[threading]))
+    voluntary_start, involuntary_start = get_context_switches()
+    result = falcon.run(config)
+    peak_rss_mb = get_peak_rss()
+    voluntary_end, involuntary_end = get_context_switches()
+    corrected = evaluate_frames(load_frames(fop.get_files(result.moco_dir, 'moco-*nii*')), ground_truth)
+
+    num_frames = len(ground_truth['frames'])
+    registered_frames = num_frames - result.start_frame - 1
+    voxels_per_frame = math.prod(ground_truth['size'])
+    registration_time = result.timings['registration']
+    return {'registration': registration,
+            'threading': threading,
+            'motion': motion_type,
+            'frames': num_frames,
+            'registered_frames': registered_frames,
+            'voxels_per_frame': voxels_per_frame,
+            'njobs': result.njobs,
+            'phantom_s': phantom_time,
+            'timings_s': result.timings,
+            'frames_per_min': registered_frames / registration_time * 60 if registration_time > 0 else None,
+            'voxels_per_s': registered_frames * voxels_per_frame / registration_time if registration_time > 0 else None,
+            'peak_rss_mb': peak_rss_mb,
+            'voluntary_context_switches': voluntary_end - voluntary_start,
+            'involuntary_context_switches': involuntary_end - involuntary_start,
+            'uncorrected': uncorrected,
+            'corrected': corrected}
+
+
+def benchmark(out_dir: str, registrations: list, motion_type: str = None,
+              multi_resolution_iterations: str = '100x50x25', njobs: int = None, start_frame: int = 0,
+              phantom_options: dict = None, keep: bool = False, threading_modes: list = None) -> dict:
+    """
+    Runs the benchmark for several registration modes, each in one or more threading modes
+    :param out_dir: Folder for the cases
+    :param registrations: Registration modes to benchmark
+    :param motion_type: Phantom motion for all modes, None to move every phantom like its registration mode
+    :param multi_resolution_iterations: Number of iterations for each resolution level
+    :param njobs: Number of jobs, None to derive it from the available resources
+    :param start_frame: Frame from which the motion correction is performed, None to detect it
+    :param phantom_options: Additional arguments of phantom.create_phantom
+    :param keep: Keep the cases (phantoms, ground truth and FALCON outputs) instead of removing them
+    :param threading_modes: Threading modes to compare, see THREADING_MODES [default: ['budget']]
+    :return: Results per case ('<registration>' or, with several threading modes, '<registration>-<threading>') and
+    a description of the machine
+    """
+    results = {'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                           'cpu_count': os.cpu_count()},
+               'date': datetime.now().isoformat(timespec='seconds'),
+               'multi_resolution_iterations': multi_resolution_iterations,
+               'phantom_options': phantom_options or {},
+               'cases': {}}
+    threading_modes = threading_modes or ['budget']
+    for registration in registrations:
+        for threading in threading_modes:
+            case_name = registration if len(threading_modes) == 1 else f"{registration}-{threading}"
+            case_dir = os.path.join(out_dir, case_name)
+            logging.info(f"Benchmarking {registration} registration ({threading} threading) in {case_dir}")
+            print(f"Benchmarking {registration} registration ({threading} threading)...")
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('fork')) as case_pool:
+                results['cases'][case_name] = case_pool.submit(run_case, case_dir, registration,
+                                                               motion_type or registration,
+                                                               multi_resolution_iterations, njobs, start_frame,
+                                                               phantom_options or {}, threading).result()
+            if not keep:
+                shutil.rmtree(case_dir)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--registrations", type=str, nargs='+', choices=['rigid', 'affine', 'deformable'],
+                        default=['rigid', 'affine', 'deformable'], help="registration modes to benchmark")
+    parser.add_argument("-m", "--motion", type=str, choices=phantom.MOTION_TYPES, default=None,
+                        help="phantom motion for all modes [default: the motion of each registration mode]")
+    parser.add_argument("-i", "--multi_resolution_iterations", type=str, default='100x50x25',
+                        help="number of iterations for each resolution level")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of jobs [default: derived from the available RAM and threads]")
+    parser.add_argument("-n", "--num_frames", type=int, default=20, help="number of frames of the phantoms")
+    parser.add_argument("--size", type=int, nargs=3, default=[96, 96, 64],
+                        help="number of voxels of the phantoms along x, y and z")
+    parser.add_argument("--format", type=str, choices=['3d', '4d'], default='4d',
+                        help="one 4d NIfTI file or one 3d NIfTI file per frame")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the phantom motion and noise")
+    parser.add_argument("-t", "--threading", type=str, nargs='+', choices=list(THREADING_MODES), default=['budget'],
+                        help="threading modes to compare: free (every job uses all CPUs), budget (threads per job "
+                             "limited) or pinned (budget and NUMA-local core sets)")
+    parser.add_argument("--detect_start_frame", action="store_true",
+                        help="let FALCON detect the start frame instead of registering all frames")
+    parser.add_argument("-d", "--work_dir", type=str, default=None,
+                        help="folder for the cases [default: a temporary folder]")
+    parser.add_argument("--keep", action="store_true", help="keep the phantoms and the FALCON outputs")
+    parser.add_argument("-o", "--output_file", type=str, default=None,
+                        help="optional JSON file to store the results in")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                        level=logging.INFO, filename=datetime.now().strftime('falcon-benchmark-%H-%M-%d-%m-%Y.log'),
+                        filemode='w')
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='falcon-benchmark-')
+    os.makedirs(work_dir, exist_ok=True)
+    benchmark_results = benchmark(work_dir, args.registrations, motion_type=args.motion,
+                                  multi_resolution_iterations=args.multi_resolution_iterations, njobs=args.jobs,
+                                  start_frame=None if args.detect_start_frame else 0,
+                                  phantom_options={'num_frames': args.num_frames, 'size': tuple(args.size),
+                                                   'frame_format': args.format, 'seed': args.seed},
+                                  keep=args.keep, threading_modes=args.threading)
+    if not args.keep and not args.work_dir:
+        shutil.rmtree(work_dir)
+
+    print(' ')
+    for case_name, case in benchmark_results['cases'].items():
+        print(f"{case_name:<20} motion: {case['motion']:<10} | {case['frames_per_min']:8.2f} frames/min | "
+              f"{case['voxels_per_s'] / 1e6:8.2f} Mvoxels/s | total: {case['timings_s']['total']:8.2f} s | "
+              f"peak RAM: {case['peak_rss_mb']:8.1f} MB | involuntary context switches: "
+              f"{case['involuntary_context_switches']:9d} | centroid error: "
+              f"{case['uncorrected']['mean_centroid_error_mm']:.2f} -> "
+              f"{case['corrected']['mean_centroid_error_mm']:.2f} mm | NRMSE: "
+              f"{case['uncorrected']['mean_nrmse']:.3f} -> {case['corrected']['mean_nrmse']:.3f}")
+    if args.output_file:
+        with open(args.output_file, 'w') as output_file:
+            json.dump(benchmark_results, output_file, indent=4)
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: benchmarkIO.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: I/O micro-benchmarks of the conversion, split, merge, summing and DICOM export paths of FALCON on
+# generated data, from brain to total-body sizes and from 20 to 200 frames. Every operation runs in a fresh process so
+# that its wall time and peak memory are its own; the results are stored as JSON and can be compared with the results
+# of another commit to catch regressions.
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+# Imported Libraries
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import timeit
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# numpy, nibabel, SimpleITK and the FALCON modules are imported inside the functions that run in the benchmark
+# processes, so that the memory of the driver stays small and does not show up in the measured peaks
+
+# Image sizes (x, y, z) and voxel sizes in mm of typical studies
+SIZES = {
+    'brain': ((256, 256, 128), 1.2),
+    'whole-body': ((200, 200, 440), 4.0),
+    'total-body': ((256, 256, 672), 2.9)
+}
+
+OPERATIONS = ('split4d', 'merge3d', 'sum_images', 'convert_metaimage', 'convert_dicom', 'push_dicom')
+
+# External tools the operations depend on; operations whose tool is missing are skipped
+REQUIRED_TOOLS = {'convert_metaimage': 'c3d', 'convert_dicom': 'dcm2niix'}
+
+
+def get_peak_rss() -> float:
+    """
+    Gets the peak resident memory of this process and of its finished children (external tools)
+    :return: Peak resident memory in MB
+    """
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def write_nifti_4d_streamed(frames, num_frames: int, shape: tuple, spacing: float, nifti_file: str) -> str:
+    """
+    Writes a 4d NIfTI file frame by frame, so that the whole series never has to be in memory
+    :param frames: Iterable of the frame arrays (indexed x, y, z)
+    :param num_frames: Number of frames
+    :param shape: Shape of a frame
+    :param spacing: Voxel size in mm
+    :param nifti_file: Path of the (gzipped) 4d NIfTI file
+    :return: Path of the 4d NIfTI file
+    """
+    import gzip
+    import nibabel as nib
+    import numpy as np
+    header = nib.Nifti1Header()
+    header.set_data_dtype(np.float32)
+    header.set_data_shape(tuple(shape) + (num_frames,))
+    header.set_zooms((spacing,) * 3 + (1.0,))
+    header.set_data_offset(352)
+    affine = np.diag([spacing] * 3 + [1.0])
+    header.set_sform(affine, code=1)
+    header.set_qform(affine, code=1)
+    with gzip.open(nifti_file, 'wb', compresslevel=1) as nifti_out:
+        header.write_to(nifti_out)
+        nifti_out.write(b'\x00' * (352 - header.sizeof_hdr))
+        for frame in frames:
+            nifti_out.write(frame.astype(np.float32).tobytes(order='F'))
+    return nifti_file
+
+
+def write_dicom_series(frame: 'np.ndarray', spacing: float, dicom_dir: str) -> list:
+    """
+    Writes a frame as a DICOM series (one int16 slice per file) with the tags FALCON's DICOM functions rely on
+    :param frame: Frame array (indexed x, y, z)
+    :param spacing: Voxel size in mm
+    :param dicom_dir: Folder of the series
+    :return: List of the DICOM files
+    """
+    import numpy as np
+    import SimpleITK
+    volume = SimpleITK.GetImageFromArray(np.clip(frame.transpose(2, 1, 0), 0, 32767).astype(np.int16))
+    volume.SetSpacing([spacing] * 3)
+    series_uid = f"1.2.826.0.1.3680043.2.1125.{os.getpid()}.{int(timeit.default_timer() * 1000)}"
+    writer = SimpleITK.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    dicom_files = []
+    for slice_index in range(volume.GetDepth()):
+        dicom_slice = volume[:, :, slice_index]
+        tags = {'0008|0060': 'PT', '0008|0008': 'ORIGINAL\\PRIMARY', '0020|000d': series_uid + '.1',
+                '0020|000e': series_uid + '.2', '0020|0013': str(slice_index + 1),
+                '0020|0032': '\\'.join(map(str, volume.TransformIndexToPhysicalPoint((0, 0, slice_index)))),
+                '0020|0037': '1\\0\\0\\0\\1\\0', '0018|0050': str(spacing), '0028|1052': '0', '0028|1053': '1'}
+        for tag, value in tags.items():
+            dicom_slice.SetMetaData(tag, value)
+        dicom_file = os.path.join(dicom_dir, f"slice{slice_index:04d}.dcm")
+        writer.SetFileName(dicom_file)
+        writer.Execute(dicom_slice)
+        dicom_files.append(dicom_file)
+    return dicom_files
+
+
+def generate_case(case_dir: str, shape: tuple, spacing: float, num_frames: int, operations: list) -> dict:
+    """
+    Generates the input data of a case: a 4d NIfTI file, the frames as 3d NIfTI files and, if needed, as Metaimage
+    files and the first frame as a DICOM series. The frames are a smooth body with noise, so they compress like real
+    studies (the 4d file gets its own noise realisation).
+    :param case_dir: Folder of the case
+    :param shape: Shape of a frame (x, y, z)
+    :param spacing: Voxel size in mm
+    :param num_frames: Number of frames
+    :param operations: Operations the data is generated for
+    :return: Dictionary with the size in MB of every generated input
+    """
+    import nibabel as nib
+    import numpy as np
+    import SimpleITK
+    rng = np.random.default_rng(0)
+    x, y, z = np.meshgrid(*[np.linspace(-1, 1, n, dtype=np.float32) for n in shape], indexing='ij', sparse=True)
+    body = 1000 / (1 + np.exp(((x / 0.8) ** 2 + (y / 0.6) ** 2 + (z / 0.9) ** 2 - 1) * 20))
+
+    def get_frame(frame_index: int) -> 'np.ndarray':
+        activity = 1 - np.exp(-(frame_index + 1) / 5)
+        noise = rng.standard_normal(size=shape, dtype=np.float32) * 50
+        return np.maximum(body * activity + noise * np.sqrt(activity), 0).astype(np.float32)
+
+    for folder in ('4d', 'frames', 'metaimage', 'dicom', 'out'):
+        os.makedirs(os.path.join(case_dir, folder), exist_ok=True)
+    affine = np.diag([spacing] * 3 + [1.0])
+    for frame_index in range(num_frames):
+        frame = get_frame(frame_index)
+        nib.save(nib.Nifti1Image(frame, affine), os.path.join(case_dir, 'frames', f"frame{frame_index:04d}.nii.gz"))
+        if 'convert_metaimage' in operations:
+            metaimage = SimpleITK.GetImageFromArray(frame.transpose(2, 1, 0))
+            metaimage.SetSpacing([spacing] * 3)
+            SimpleITK.WriteImage(metaimage, os.path.join(case_dir, 'metaimage', f"frame{frame_index:04d}.mha"))
+        if frame_index == 0 and ('convert_dicom' in operations or 'push_dicom' in operations):
+            write_dicom_series(frame, spacing, os.path.join(case_dir, 'dicom'))
+    write_nifti_4d_streamed((get_frame(frame_index) for frame_index in range(num_frames)), num_frames, shape, spacing,
+                            os.path.join(case_dir, '4d', 'pet-4d.nii.gz'))
+    return {folder: get_folder_size(os.path.join(case_dir, folder)) for folder in ('4d', 'frames', 'metaimage',
+                                                                                   'dicom')}
+
+
+def get_folder_size(folder: str) -> float:
+    """
+    Gets the size of the files in a folder
+    :param folder: Folder
+    :return: Size in MB
+    """
+    files = [file for file in glob.glob(os.path.join(folder, '*')) if os.path.isfile(file)]
+    return sum(os.path.getsize(file) for file in files) / 1024 ** 2
+
+
+def run_operation(operation: str, case_dir: str) -> None:
+    """
+    Runs one FALCON I/O operation on the data of a case
+    :param operation: One of OPERATIONS
+    :param case_dir: Folder of the case
+    :return: None
+    """
+    import fileOp as fop
+    import imageIO
+    import imageOp
+    out_dir = os.path.join(case_dir, 'out')
+    if operation == 'split4d':
+        imageIO.split4d(os.path.join(case_dir, '4d', 'pet-4d.nii.gz'), out_dir)
+    elif operation == 'merge3d':
+        imageIO.merge3d(os.path.join(case_dir, 'frames'), 'frame*nii*', os.path.join(out_dir, 'merged-4d.nii.gz'))
+    elif operation == 'sum_images':
+        imageOp.sum_images_from_list(fop.get_files(os.path.join(case_dir, 'frames'), '*nii*'),
+                                     os.path.join(out_dir, 'summed.nii.gz'))
+    elif operation == 'convert_metaimage':
+        imageIO.convert_all_non_nifti(os.path.join(case_dir, 'metaimage'))
+    elif operation == 'convert_dicom':
+        imageIO.convert_all_non_nifti(os.path.join(case_dir, 'dicom'))
+    elif operation == 'push_dicom':
+        dicom_out_dir = fop.make_dir(out_dir, 'dicom')
+        imageIO.push_nii_pixel_data_to_dcm(os.path.join(case_dir, 'frames', 'frame0000.nii.gz'),
+                                           os.path.join(case_dir, 'dicom'), dicom_out_dir)
+    else:
+        raise ValueError(f"Unknown operation: {operation}")
+
+
+def measure_operation(operation: str, case_dir: str) -> dict:
+    """
+    Measures an operation. Run it in a fresh process, so that the peak memory belongs to the operation only.
+    :param operation: One of OPERATIONS
+    :param case_dir: Folder of the case
+    :return: Dictionary with the wall time, the resident memory before the operation and the peak resident memory
+    """
+    # The libraries are imported before the baseline is taken, so that the peak reflects the data of the operation
+    import nibabel  # noqa: F401
+    import numpy  # noqa: F401
+    import pydicom  # noqa: F401
+    import SimpleITK  # noqa: F401
+    baseline_rss_mb = get_peak_rss()
+    start = timeit.default_timer()
+    try:
+        run_operation(operation, case_dir)
+    except (Exception, SystemExit) as error:
+        return {'error': f"{type(error).__name__}: {error}"}
+    return {'wall_s': timeit.default_timer() - start, 'baseline_rss_mb': baseline_rss_mb,
+            'peak_rss_mb': get_peak_rss(), 'output_mb': get_folder_size(os.path.join(case_dir, 'out'))}
+
+
+def get_git_commit() -> str:
+    """
+    Gets the commit of the FALCON checkout, so that results of different commits can be told apart
+    :return: Commit hash, None if FALCON is not run from a git checkout
+    """
+    git_process = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SRC_DIR, capture_output=True, text=True)
+    return git_process.stdout.strip() if git_process.returncode == 0 else None
+
+
+def benchmark_io(work_dir: str, sizes: list, frame_counts: list, operations: list) -> dict:
+    """
+    Runs the I/O benchmarks for every combination of image size and number of frames
+    :param work_dir: Folder for the generated data (needs room for the largest case)
+    :param sizes: Names of the image sizes, see SIZES
+    :param frame_counts: Numbers of frames
+    :param operations: Operations to benchmark, see OPERATIONS
+    :return: Results and a description of the machine and commit
+    """
+    results = {'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                           'cpu_count': os.cpu_count()},
+               'commit': get_git_commit(),
+               'date': datetime.now().isoformat(timespec='seconds'),
+               'cases': []}
+    fork_context = multiprocessing.get_context('fork')
+    for size in sizes:
+        shape, spacing = SIZES[size]
+        for num_frames in frame_counts:
+            case_dir = os.path.join(work_dir, f"{size}-{num_frames}")
+            print(f"Generating {size} data with {num_frames} frames of {shape}...")
+            with ProcessPoolExecutor(max_workers=1, mp_context=fork_context) as case_pool:
+                input_mb = case_pool.submit(generate_case, case_dir, shape, spacing, num_frames, operations).result()
+            for operation in operations:
+                case = {'size': size, 'shape': list(shape), 'frames': num_frames, 'operation': operation}
+                tool = REQUIRED_TOOLS.get(operation)
+                if tool is not None and shutil.which(tool) is None:
+                    case['skipped'] = f"{tool} not found"
+                else:
+                    with ProcessPoolExecutor(max_workers=1, mp_context=fork_context) as operation_pool:
+                        case.update(operation_pool.submit(measure_operation, operation, case_dir).result())
+                    shutil.rmtree(os.path.join(case_dir, 'out'))
+                    os.makedirs(os.path.join(case_dir, 'out'))
+                case['input_mb'] = input_mb
+                results['cases'].append(case)
+                print(format_case(case))
+            shutil.rmtree(case_dir)
+    return results
+
+
+def format_case(case: dict) -> str:
+    """
+    Formats the result of one operation for the console
+    :param case: Result of one operation, see benchmark_io
+    :return: Line of text
+    """
+    name = f"{case['size']:<11} {case['frames']:>4} frames | {case['operation']:<18}"
+    if 'skipped' in case:
+        return f"{name} | skipped: {case['skipped']}"
+    if 'error' in case:
+        return f"{name} | failed: {case['error']}"
+    return (f"{name} | {case['wall_s']:9.2f} s | peak RSS: {case['peak_rss_mb']:9.1f} MB (baseline "
+            f"{case['baseline_rss_mb']:.1f} MB)")
+
+
+def compare_results(previous_results: dict, results: dict, tolerance: float) -> list:
+    """
+    Compares the results with the results of a previous run (e.g. of another commit)
+    :param previous_results: Previous results, see benchmark_io
+    :param results: Current results
+    :param tolerance: Relative increase of the wall time or the peak memory that counts as a regression
+    :return: List of the regressions found
+    """
+    previous_cases = {(case['size'], case['frames'], case['operation']): case for case in previous_results['cases']
+                      if 'wall_s' in case}
+    regressions = []
+    for case in results['cases']:
+        previous_case = previous_cases.get((case['size'], case['frames'], case['operation']))
+        if previous_case is None or 'wall_s' not in case:
+            continue
+        for metric in ('wall_s', 'peak_rss_mb'):
+            if case[metric] > previous_case[metric] * (1 + tolerance):
+                regressions.append(f"{case['size']} {case['frames']} frames {case['operation']}: {metric} "
+                                   f"{previous_case[metric]:.2f} -> {case[metric]:.2f}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sizes", type=str, nargs='+', choices=list(SIZES), default=['brain'],
+                        help="image sizes to benchmark")
+    parser.add_argument("-f", "--frames", type=int, nargs='+', default=[20, 200],
+                        help="numbers of frames to benchmark")
+    parser.add_argument("--operations", type=str, nargs='+', choices=OPERATIONS, default=list(OPERATIONS),
+                        help="operations to benchmark")
+    parser.add_argument("-d", "--work_dir", type=str, default=None,
+                        help="folder for the generated data [default: a temporary folder]")
+    parser.add_argument("-o", "--output_file", type=str, default=None,
+                        help="optional JSON file to store the results in")
+    parser.add_argument("-c", "--compare", type=str, default=None,
+                        help="JSON results of a previous run to compare with; exits with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative increase of the wall time or peak memory that counts as a regression")
+    args = parser.parse_args()
+
+    benchmark_dir = tempfile.mkdtemp(prefix='falcon-benchmark-io-', dir=args.work_dir)
+    try:
+        io_results = benchmark_io(benchmark_dir, args.sizes, args.frames, args.operations)
+    finally:
+        shutil.rmtree(benchmark_dir)
+    if args.output_file:
+        with open(args.output_file, 'w') as output_file:
+            json.dump(io_results, output_file, indent=4)
+    if args.compare:
+        with open(args.compare, 'r') as compare_file:
+            found_regressions = compare_results(json.load(compare_file), io_results, args.tolerance)
+        for regression in found_regressions:
+            print(f"Regression | {regression}")
+        if found_regressions:
+            exit(1)
+        print("No regressions found")
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: benchmarkStartup.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: Startup benchmark of the FALCON entry points. Measures the time of '--help' and the time until the
+# entry points do their first piece of work (checking the input arguments), which is dominated by imports.
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+# Imported Libraries
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import timeit
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Entry points and the arguments that make them stop right after their first piece of work (the input checks fail on
+# a folder that does not exist)
+ENTRY_POINTS = {
+    'falcon': ('run_falcon.py', ['-m', 'does-not-exist']),
+    'falcon-cardiac': ('run_falcon_cardiac.py', ['-rfd', 'does-not-exist', '-sfd', 'does-not-exist']),
+    'falcon-apply': ('run_falcon_apply.py', ['-m', 'does-not-exist', '-i', 'does-not-exist', '-o', 'out'])
+}
+
+
+def time_command(cmd: list, repetitions: int, work_dir: str) -> dict:
+    """
+    Times a command several times
+    :param cmd: Command to time as a list of arguments
+    :param repetitions: Number of repetitions
+    :param work_dir: Working directory of the command (log files end up here)
+    :return: Dictionary with the minimum, median and maximum wall time in seconds and the last return code
+    """
+    durations = []
+    return_code = None
+    for _ in range(repetitions):
+        start = timeit.default_timer()
+        return_code = subprocess.run(cmd, cwd=work_dir, capture_output=True).returncode
+        durations.append(timeit.default_timer() - start)
+    return {'min': min(durations), 'median': statistics.median(durations), 'max': max(durations),
+            'return_code': return_code}
+
+
+def benchmark_startup(repetitions: int) -> dict:
+    """
+    Benchmarks the startup of all FALCON entry points
+    :param repetitions: Number of repetitions per measurement
+    :return: Dictionary with the timings per entry point and measurement
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        results['python'] = {'interpreter': time_command([sys.executable, '-c', 'pass'], repetitions, work_dir)}
+        for entry_point, (script, first_work_args) in ENTRY_POINTS.items():
+            script_path = os.path.join(SRC_DIR, script)
+            results[entry_point] = {
+                'help': time_command([sys.executable, script_path, '--help'], repetitions, work_dir),
+                'first_work': time_command([sys.executable, script_path] + first_work_args, repetitions, work_dir)
+            }
+        results['falcon-api'] = {
+            'import': time_command([sys.executable, '-c', f"import sys; sys.path.insert(0, {SRC_DIR!r}); "
+                                                          f"import falcon"], repetitions, work_dir)
+        }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n",
+        "--repetitions",
+        type=int,
+        default=5,
+        help="number of repetitions per measurement"
+    )
+    parser.add_argument(
+        "-o",
+        "--output_file",
+        type=str,
+        default=None,
+        help="optional JSON file to store the results in"
+    )
+    args = parser.parse_args()
+
+    startup_results = benchmark_startup(args.repetitions)
+    for name, measurements in startup_results.items():
+        for measurement, timings in measurements.items():
+            print(f"{name:<16} {measurement:<12} min: {timings['min']:.3f} s | median: {timings['median']:.3f} s | "
+                  f"max: {timings['max']:.3f} s | return code: {timings['return_code']}")
+    if args.output_file:
+        with open(args.output_file, 'w') as output_file:
+            json.dump(startup_results, output_file, indent=4)
@@ -28,3 +28,61 @@ NCC_THRESHOLD = 0.6  # Normalized cross correlation threshold
 NCC_RADIUS = '4x4x4'  # Normalized cross correlation radius
 
 MOCO_FILE_PATTERN = "moco-*.*"
+
+# Motion triage: frames whose rigid motion, estimated on 8x downsampled images, stays below the threshold (in voxels
+# of the original image) are not registered but get an identity transform
+TRIAGE_SHRINK_LEVEL = SHRINK_LEVEL_8x
+TRIAGE_ITERATIONS = '100x50'
+TRIAGE_MOTION_THRESHOLD = 0.5  # in voxels
+
+# Slab-wise deformable registration: the axial field of view is split into slabs that extend this many slices into
+# their neighbours, and the per-slab warps are blended over the shared slices
+SLAB_OVERLAP = 8  # in slices
+
+# Job control of the registration jobs: once JOB_MIN_SAMPLES jobs finished, a job attempt is cancelled and retried
+# when it runs longer than JOB_TIMEOUT_FACTOR times the median job (at least JOB_MIN_TIMEOUT seconds), and re-issued
+# on an idle worker when it runs longer than JOB_STRAGGLER_FACTOR times the median job
+JOB_MIN_SAMPLES = 3
+JOB_STRAGGLER_FACTOR = 2.0
+JOB_TIMEOUT_FACTOR = 6.0
+JOB_MIN_TIMEOUT = 120  # in seconds
+JOB_MAX_ATTEMPTS = 3  # per job, including speculative copies
+TOOL_RETRIES = 1  # reruns of a failed external tool within a job attempt
+
+# Number of jobs a distributed run (see distributed.py) keeps in its queue at a time unless set explicitly: more than a
+# dynamic PET study has frames, so that all frames are queued at once and every worker finds work
+DISTRIBUTED_NJOBS = 1000
+
+# Cost-aware ordering of the registration jobs (longest first): the measured job durations of earlier runs are kept
+# in this file in the moco folder; frames without a measurement are estimated from their file size, and frames that
+# moved more in the motion triage count up to 1 + JOB_COST_MOTION_WEIGHT times as expensive
+JOB_HISTORY_FILE = 'job-history.json'
+JOB_COST_MOTION_WEIGHT = 1.0
+
+# Autotuning of the iteration schedule (see tune.py): candidate schedules and linear shrink levels are timed on a
+# sample of frames and compared with a high-iteration reference registration; the cheapest candidate whose resampled
+# frames differ from the reference by at most TUNE_TOLERANCE (RMS difference relative to the frame's intensity range)
+# is recommended
+TUNE_REFERENCE_ITERATIONS = {'rigid': '200x200x100', 'affine': '200x200x100', 'deformable': '200x100x50'}
+TUNE_SCHEDULES = ['100x50x25', '100x50x10', '100x50x0', '50x25x10', '50x25x0', '25x10x5', '25x10x0', '10x5x0']
+TUNE_SHRINK_LEVELS = [1, SHRINK_LEVEL_2x, SHRINK_LEVEL_4x]
+TUNE_NUM_FRAMES = 5
+TUNE_TOLERANCE = 0.01
+
+# Phase-correlation initializer of the linear registrations (see greedy.get_initialization): the initial transform
+# is estimated on images downsampled by INIT_SHRINK_LEVEL; with rotation, these angles (in degrees) are also tried
+# about each axis
+INIT_SHRINK_LEVEL = SHRINK_LEVEL_4x
+INIT_ROTATION_ANGLES = [-6, -3, 3, 6]
+# The cross-power spectrum is whitened down to this fraction of its largest magnitude only, and low-pass filtered with
+# a Gaussian of this width (in cycles per voxel); estimates that translate by more than INIT_MAX_TRANSLATION are
+# implausible and fall back to the image centers
+INIT_WHITENING_FLOOR = 0.01
+INIT_LOWPASS_SIGMA = 0.15  # in cycles per voxel
+INIT_MAX_TRANSLATION = 25  # in mm
+
+# Motion parameters of the linear transforms (see greedy.get_motion_parameters), saved per run in the transforms
+# folder; with skip_identity_resample, frames whose body moves by less than RESAMPLE_SKIP_THRESHOLD voxels are linked
+# instead of resampled
+MOTION_PARAMETERS_FILE = 'motion-parameters'  # .csv and .npy
+RESAMPLE_SKIP_THRESHOLD = 0.1  # in voxels
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: distributed.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: Distributed execution of the frame-level jobs of FALCON. The driver puts the jobs into an SQLite queue
+# on shared storage and any number of workers, on any host that sees the same paths, claim them with leases that they
+# keep alive with heartbeats. Jobs of workers that died are claimed again once their lease expired.
+# The jobs are pickled into the queue and unpickled by the workers, so anyone who can write the queue file can run
+# code on every worker: the queue file is created readable and writable by its owner only, and workers refuse queue
+# files that others can write. SQLite relies on POSIX file locks, which are unreliable on many NFS setups; put the
+# queue on a file system with working locks (e.g. a cluster file system or an NFS mount with a lock manager).
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+# Imported Libraries
+
+import logging
+import os
+import pickle
+import socket
+import sqlite3
+import stat
+import threading
+import time
+from concurrent.futures import Executor, Future
+
+# Number of times a job is handed out before it is considered failed (e.g. because it kills every worker)
+MAX_ATTEMPTS = 3
+
+# Time in seconds a claimed job belongs to a worker without a heartbeat
+LEASE_TIME = 60.0
+
+QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload BLOB NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    result BLOB,
+    error TEXT,
+    submitted REAL,
+    finished REAL
+)
+"""
+
+
+def connect(queue_file: str) -> sqlite3.Connection:
+    """
+    Connects to a queue and creates it if needed, readable and writable by its owner only
+    :param queue_file: SQLite file of the queue (on storage shared by the driver and all workers)
+    :return: Connection to the queue
+    """
+    try:
+        os.close(os.open(queue_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600))
+    except FileExistsError:
+        pass
+    connection = sqlite3.connect(queue_file, timeout=60, isolation_level=None)
+    connection.execute(QUEUE_SCHEMA)
+    return connection
+
+
+class DistributedExecutor(Executor):
+    """
+    concurrent.futures.Executor that runs the submitted jobs on the workers of an SQLite queue. It can be passed as
+    executor to falcon.run, greedy.align and the other functions that accept one; the results are collected by a
+    polling thread and the driver merges them as usual.
+    """
+
+    def __init__(self, queue_file: str, poll_interval: float = 1.0):
+        """
+        :param queue_file: SQLite file of the queue (on storage shared by the driver and all workers)
+        :param poll_interval: Time between two checks for finished jobs in seconds
+        """
+        self.queue_file = os.path.abspath(queue_file)
+        self.poll_interval = poll_interval
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        connect(self.queue_file).close()
+        self.poller = threading.Thread(target=self.collect_results, daemon=True)
+        self.poller.start()
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        """
+        Puts a job into the queue
+        :param fn: Module-level function to run (it is pickled by reference)
+        :return: Future of the result of the job
+        """
+        if self.stopped.is_set():
+            raise RuntimeError('Cannot submit jobs after shutdown')
+        future = Future()
+        payload = pickle.dumps((fn, args, kwargs))
+        with self.lock:
+            connection = connect(self.queue_file)
+            try:
+                task_id = connection.execute('INSERT INTO tasks (payload, submitted) VALUES (?, ?)',
+                                             (payload, time.time())).lastrowid
+            finally:
+                connection.close()
+            self.pending[task_id] = future
+        return future
+
+    def collect_results(self) -> None:
+        """
+        Marks the futures of claimed jobs as running and resolves the futures of finished jobs and removes the jobs
+        from the queue, until the executor is shut down. A job counts as running from when a worker claimed it, not
+        from when it was queued, so that the driver does not time jobs that are still waiting for a worker.
+        """
+        while not self.stopped.is_set() or self.pending:
+            with self.lock:
+                task_ids = list(self.pending)
+            if task_ids:
+                connection = connect(self.queue_file)
+                try:
+                    claimed_tasks = connection.execute(
+                        f"SELECT task_id, state, result, error FROM tasks WHERE state IN ('running', 'done', 'failed') "
+                        f"AND task_id IN ({','.join('?' * len(task_ids))})", task_ids).fetchall()
+                    for task_id, state, result, error in claimed_tasks:
+                        with self.lock:
+                            future = self.pending[task_id] if state == 'running' else self.pending.pop(task_id)
+                        if not future.running() and not future.set_running_or_notify_cancel():
+                            # Cancelled by the caller before a worker claimed it
+                            with self.lock:
+                                self.pending.pop(task_id, None)
+                            connection.execute('DELETE FROM tasks WHERE task_id = ?', (task_id,))
+                            continue
+                        if state == 'running':
+                            continue
+                        if state == 'done':
+                            future.set_result(pickle.loads(result))
+                        elif result is not None:
+                            future.set_exception(pickle.loads(result))
+                        else:
+                            future.set_exception(RuntimeError(error))
+                        connection.execute('DELETE FROM tasks WHERE task_id = ?', (task_id,))
+                finally:
+                    connection.close()
+            time.sleep(self.poll_interval)
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        """
+        Stops the executor. Jobs that are still queued are removed from the queue if cancel_futures is set.
+        :param wait: Wait until all submitted jobs are finished
+        :param cancel_futures: Remove the jobs that were not claimed by a worker yet
+        """
+        if cancel_futures:
+            with self.lock:
+                connection = connect(self.queue_file)
+                try:
+                    for task_id, future in list(self.pending.items()):
+                        if connection.execute("DELETE FROM tasks WHERE task_id = ? AND state = 'queued'",
+                                              (task_id,)).rowcount:
+                            self.pending.pop(task_id)
+                            future.set_exception(RuntimeError('Job was cancelled'))
+                finally:
+                    connection.close()
+        self.stopped.set()
+        if wait:
+            self.poller.join()
+
+
+def claim_task(connection: sqlite3.Connection, worker: str, lease_time: float) -> tuple:
+    """
+    Claims the oldest queued job, or a job whose lease expired, for a worker
+    :param connection: Connection to the queue
+    :param worker: Name of the worker
+    :param lease_time: Time in seconds the job belongs to the worker without a heartbeat
+    :return: Tuple of the task id and the payload of the job, or None if there is nothing to do
+    """
+    while True:
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            task = connection.execute(
+                "SELECT task_id, payload, attempts FROM tasks WHERE state = 'queued' OR "
+                "(state = 'running' AND lease_expires < ?) ORDER BY task_id LIMIT 1", (now,)).fetchone()
+            if task is None:
+                connection.execute('COMMIT')
+                return None
+            task_id, payload, attempts = task
+            if attempts >= MAX_ATTEMPTS:
+                connection.execute("UPDATE tasks SET state = 'failed', error = ?, finished = ? WHERE task_id = ?",
+                                   (f"Job was lost by {attempts} workers", now, task_id))
+                connection.execute('COMMIT')
+                logging.error(f"Job {task_id} was lost by {attempts} workers and is marked as failed")
+                continue
+            connection.execute("UPDATE tasks SET state = 'running', worker = ?, lease_expires = ?, "
+                               "attempts = attempts + 1 WHERE task_id = ?", (worker, now + lease_time, task_id))
+            connection.execute('COMMIT')
+            return task_id, payload
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+
+def keep_lease(queue_file: str, task_id: int, worker: str, lease_time: float, done: threading.Event) -> None:
+    """
+    Extends the lease of a job until it is done (heartbeat)
+    :param queue_file: SQLite file of the queue
+    :param task_id: Id of the job
+    :param worker: Name of the worker that owns the job
+    :param lease_time: Time in seconds the job belongs to the worker without a heartbeat
+    :param done: Event that is set once the job is done
+    :return: None
+    """
+    connection = connect(queue_file)
+    try:
+        while not done.wait(lease_time / 4):
+            connection.execute("UPDATE tasks SET lease_expires = ? WHERE task_id = ? AND worker = ?",
+                               (time.time() + lease_time, task_id, worker))
+    finally:
+        connection.close()
+
+
+def work(queue_file: str, lease_time: float = LEASE_TIME, poll_interval: float = 1.0, idle_timeout: float = None,
+         max_tasks: int = None) -> int:
+    """
+    Runs the jobs of a queue one after the other
+    :param queue_file: SQLite file of the queue (on storage shared by the driver and all workers)
+    :param lease_time: Time in seconds a claimed job belongs to this worker without a heartbeat
+    :param poll_interval: Time between two polls of an empty queue in seconds
+    :param idle_timeout: Optional time in seconds with an empty queue after which the worker stops
+    :param max_tasks: Optional number of jobs after which the worker stops
+    :return: Number of jobs the worker ran
+    """
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    connection = connect(os.path.abspath(queue_file))
+    # Unpickling a job runs code, so the jobs must come from the owner of the queue only
+    if os.stat(queue_file).st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        connection.close()
+        raise PermissionError(f"Queue file {queue_file} is writable by other users; restrict it with chmod 600")
+    logging.info(f"Worker {worker} started on {queue_file}")
+    num_tasks = 0
+    last_task = time.time()
+    try:
+        while max_tasks is None or num_tasks < max_tasks:
+            task = claim_task(connection, worker, lease_time)
+            if task is None:
+                if idle_timeout is not None and time.time() - last_task > idle_timeout:
+                    logging.info(f"Worker {worker} is idle for {idle_timeout} s and stops")
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            task_id, payload = task
+            done = threading.Event()
+            heartbeat = threading.Thread(target=keep_lease, args=(queue_file, task_id, worker, lease_time, done),
+                                         daemon=True)
+            heartbeat.start()
+            try:
+                fn, args, kwargs = pickle.loads(payload)
+                logging.info(f"Worker {worker} runs job {task_id}: {fn.__module__}.{fn.__name__}")
+                result, state, error = pickle.dumps(fn(*args, **kwargs)), 'done', None
+            except Exception as job_error:
+                logging.error(f"Job {task_id} failed on {worker}: {job_error}")
+                try:
+                    result = pickle.dumps(job_error)
+                except Exception:
+                    result = None
+                state, error = 'failed', f"{type(job_error).__name__}: {job_error}"
+            finally:
+                done.set()
+                heartbeat.join()
+            # Only the current owner may store the outcome: the job was handed out again if the lease expired
+            connection.execute("UPDATE tasks SET state = ?, result = ?, error = ?, finished = ? WHERE task_id = ? "
+                               "AND worker = ?", (state, result, error, time.time(), task_id, worker))
+            num_tasks += 1
+            last_task = time.time()
+    finally:
+        connection.close()
+    logging.info(f"Worker {worker} stops after {num_tasks} jobs")
+    return num_tasks
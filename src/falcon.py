@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: falcon.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: Importable FALCON API. falcon.run(config) performs the complete motion correction of a study inside
+# the calling process, so that services can keep one warm process (and worker pool) and run many studies in it.
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+# Imported Libraries
+
+import logging
+import dataclasses
+import os
+import pathlib
+import shutil
+import tempfile
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import checkArgs
+import constants as c
+import distributed
+import fileOp as fop
+import greedy
+import imageIO
+import imageOp
+import jobControl
+import perfTrace
+import preProcessing as pp
+import sysUtil as su
+
+
+class FalconError(Exception):
+    """
+    Raised when a study cannot be motion corrected with the given configuration
+    """
+
+
+@dataclass
+class RunConfig:
+    """
+    Configuration of a FALCON run
+    :param main_folder: Path containing the images to motion correct
+    :param reference_frame_index: Index of the reference frame [index starts from 0]
+    :param start_frame: Frame from which the motion correction will be performed, None to determine it automatically
+    :param registration: Type of registration: rigid | affine | deformable
+    :param multi_resolution_iterations: Number of iterations for each resolution level
+    :param registration_options: Optional registration settings, see greedy.get_registration_options
+    :param njobs: Number of jobs to run in parallel, None to derive it from the available resources
+    :param scratch_dir: Optional fast local folder (e.g. NVMe or /dev/shm) the study is staged to; only the moco folder
+    is copied back into the study folder
+    :param link_unregistered: If True, the frames before the start frame are placed in the moco folder as symbolic links
+    (recorded in its symlink manifest, see fileOp.symlink_file) instead of copies
+    :param trace_file: Optional JSON lines file the performance trace of the run is appended to (see perfTrace)
+    """
+    main_folder: str
+    reference_frame_index: int = -1
+    start_frame: int = None
+    registration: str = 'affine'
+    multi_resolution_iterations: str = '100x50x25'
+    registration_options: dict = None
+    njobs: int = None
+    scratch_dir: str = None
+    link_unregistered: bool = False
+    trace_file: str = None
+
+
+@dataclass
+class RunResult:
+    """
+    Result of a FALCON run
+    :param working_dir: Absolute path of the study folder
+    :param input_image_type: Image type of the input images (e.g. Dicom, Nifti)
+    :param nifti_dir: Directory containing the nifti images
+    :param split3d_dir: Directory containing the 3d frames that were motion corrected
+    :param moco_dir: Directory containing the motion corrected frames
+    :param transform_dir: Directory containing the transforms
+    :param moco_4d_file: Motion corrected 4d image
+    :param reference_image: Motion corrected reference frame (the fixed image)
+    :param start_frame: Frame from which the motion correction was performed
+    :param njobs: Number of jobs that were run in parallel
+    :param frame_transforms: Dictionary mapping each registered frame to its transform files
+    :param motion_parameters_file: CSV file of the motion parameters of the registered frames (an NPY file of the same
+    name holds the array), see greedy.save_motion_parameters
+    :param timings: Wall time in seconds of every phase of the run
+    :param pipeline_stats: Queue depths of the prefetching pipeline, if it was used (see pipeline.align_pipelined)
+    """
+    working_dir: str
+    input_image_type: str = ''
+    nifti_dir: str = ''
+    split3d_dir: str = ''
+    moco_dir: str = ''
+    transform_dir: str = ''
+    moco_4d_file: str = ''
+    reference_image: str = ''
+    start_frame: int = None
+    njobs: int = 1
+    frame_transforms: dict = field(default_factory=dict)
+    motion_parameters_file: str = ''
+    timings: dict = field(default_factory=dict)
+    pipeline_stats: dict = None
+
+
+def get_number_of_jobs(registration: str) -> int:
+    """
+    Figures out the number of registration jobs that can run in parallel on this machine
+    :param registration: Type of registration: rigid | affine | deformable
+    :return: Number of jobs
+    """
+    if registration == 'rigid':
+        return su.get_number_of_possible_jobs(process_memory=c.MINIMUM_RAM_REQUIRED_RIGID,
+                                              process_threads=c.MINIMUM_THREADS_REQUIRED_RIGID)
+    elif registration == 'affine':
+        return su.get_number_of_possible_jobs(process_memory=c.MINIMUM_RAM_REQUIRED_AFFINE,
+                                              process_threads=c.MINIMUM_THREADS_REQUIRED_AFFINE)
+    elif registration == 'deformable':
+        return su.get_number_of_possible_jobs(process_memory=c.MINIMUM_RAM_REQUIRED_DEFORMABLE,
+                                              process_threads=c.MINIMUM_THREADS_REQUIRED_DEFORMABLE)
+    else:
+        raise FalconError("Registration type not recognized")
+
+
+def check_config(config: RunConfig) -> None:
+    """
+    Checks if the configuration of a run is valid
+    :param config: Configuration of the run
+    :return: None
+    """
+    if not checkArgs.dir_exists(config.main_folder):
+        raise FalconError("Main folder does not exist")
+    if config.start_frame is not None and not checkArgs.is_non_negative(config.start_frame):
+        raise FalconError("Start frame must be non-negative")
+    if config.registration not in ('rigid', 'affine', 'deformable'):
+        raise FalconError("Registration type not recognized")
+    if checkArgs.is_string_alpha(checkArgs.remove_char(config.multi_resolution_iterations, 'x')):
+        raise FalconError("Multi-resolution iterations must be a string of integers separated by 'x'")
+    if config.scratch_dir is not None and not checkArgs.dir_exists(config.scratch_dir):
+        raise FalconError("Scratch folder does not exist")
+    if config.registration_options and config.registration_options.get('slabs', 1) < 1:
+        raise FalconError("Number of slabs must be at least 1")
+
+
+def run(config: RunConfig, executor=None) -> RunResult:
+    """
+    Performs the motion correction of a study
+    :param config: Configuration of the run
+    :param executor: Optional caller-provided concurrent.futures.Executor on which all parallel jobs are run. If None,
+    a worker pool with config.njobs workers is created for every parallel phase.
+    :return: Result of the run
+    """
+    check_config(config)
+    if config.trace_file is not None:
+        perfTrace.enable(config.trace_file)
+    if config.scratch_dir is not None:
+        return run_on_scratch(config, executor)
+    start = timeit.default_timer()
+    result = RunResult(working_dir=os.path.abspath(config.main_folder))
+    registration = config.registration
+    multi_resolution_iterations = config.multi_resolution_iterations
+    registration_options = greedy.get_registration_options(config.registration_options)
+    result.njobs = config.njobs if config.njobs else get_number_of_jobs(registration)
+    if isinstance(executor, distributed.DistributedExecutor):
+        # The jobs run on the workers of the queue, one at a time per worker: the resources of this host neither limit
+        # the number of queued jobs nor the threads of a job
+        result.njobs = config.njobs if config.njobs else c.DISTRIBUTED_NJOBS
+        if registration_options['threads_per_job'] is None:
+            registration_options['threads_per_job'] = 0
+
+    logging.info('****************************************************************************************************')
+    logging.info(
+        '                                       STARTING FALCON V.01                                             ')
+    logging.info('****************************************************************************************************')
+    logging.info(' ')
+    logging.info('INPUT ARGUMENTS')
+    logging.info('-----------------')
+    logging.info(' - Working directory: ' + result.working_dir)
+    logging.info(' - Registration type: ' + registration)
+    logging.info(' - Multi-resolution iterations: ' + multi_resolution_iterations)
+    logging.info(f" - Registration options: {registration_options}")
+    logging.info(' ')
+    logging.info('SANITY CHECKS AND DATA PREPARATION')
+    logging.info('-----------------------------------')
+    logging.info(' ')
+    print(' ')
+    if executor is not None:
+        logging.info("FALCON will run its parallel jobs on the provided worker pool")
+    elif result.njobs > 1:
+        logging.info(
+            f"Based on the available RAM and available threads, FALCON will run in parallel with {result.njobs} jobs "
+            f"at a time")
+        print(
+            f"Based on the available RAM and available threads, FALCON will run in parallel with {result.njobs} jobs "
+            f"at a time")
+    else:
+        logging.info("Due to the available RAM and available threads, FALCON will run in serial")
+        print("Due to the available RAM and available threads, FALCON will run in serial")
+
+    with perfTrace.phase('conversion', result.timings):
+        result.nifti_dir, result.input_image_type = imageIO.convert_all_non_nifti(result.working_dir)
+
+    # Check if the nifti files are 3d or 4d
+
+    with perfTrace.phase('split', result.timings):
+        nifti_files = fop.get_files(result.nifti_dir, '*nii*')
+        if len(nifti_files) == 1:
+            logging.info(f"Number of nifti files: {len(nifti_files)}")
+            img_dimensions = imageOp.get_dimensions(nifti_files[0])
+            if img_dimensions == 3:
+                logging.error('Single 3d nifti file found: Cannot perform motion correction!')
+                raise FalconError('Single 3d nifti file found: Cannot perform motion correction!')
+            elif img_dimensions == 4:
+                logging.info('Type of nifti file : 4d')
+                imageIO.split4d(nifti_files[0], result.nifti_dir)
+                result.split3d_dir = fop.make_dir(result.nifti_dir, 'split3d')
+                fop.move_files(result.nifti_dir, result.split3d_dir, 'vol*.nii*')
+                logging.info(f"PET files to motion correct are stored here: {result.split3d_dir}")
+        elif len(nifti_files) > 1:
+            logging.info('Multiple nifti files found, assuming we have 3d nifti files!')
+            result.split3d_dir = result.nifti_dir
+            logging.info(f"PET files to motion correct are stored here: {result.split3d_dir}")
+        else:
+            logging.error('No nifti files found: Cannot perform motion correction!')
+            raise FalconError('No nifti files found: Cannot perform motion correction!')
+
+    logging.info(' ')
+
+    # Motion correction starts here
+
+    logging.info('MOTION CORRECTION')
+    print('')
+    print("Initiating motion correction...")
+    print()
+    logging.info('--------------------')
+    logging.info('Resampling parameters - Images: Linear interpolation  | Segmentations: Nearest neighbor ')
+    split3d_folder = result.split3d_dir
+    non_moco_files = fop.get_files(split3d_folder, '*nii*')
+    reference_frame_index = config.reference_frame_index
+
+    # Determine the start frame from which motion correction needs to be performed.
+    with perfTrace.phase('start_frame_detection', result.timings):
+        start_frame = config.start_frame
+        if start_frame is None:
+            logging.info('Starting frame not provided by user! Calculating the starting frame from which motion '
+                         'correction can be performed')
+            print('Starting frame not provided by user...')
+            reference_frame_for_ncc_calc = non_moco_files[reference_frame_index]
+            candidate_files_for_ncc_calc = non_moco_files[:]
+            candidate_files_for_ncc_calc.remove(reference_frame_for_ncc_calc)
+            start_frame = pp.determine_candidate_frames(candidate_files=candidate_files_for_ncc_calc,
+                                                        reference_file=reference_frame_for_ncc_calc,
+                                                        njobs=result.njobs, executor=executor,
+                                                        threads_per_job=registration_options['threads_per_job'])
+            print(f"Starting frame for motion correction is {start_frame}")
+        logging.info(f'Starting frame index: {start_frame}')
+        result.start_frame = start_frame
+    print(' ')
+
+    # Allocating the fixed and moving frames for motion correction
+
+    result.moco_dir = fop.make_dir(split3d_folder, 'moco')
+    moco_dir = result.moco_dir
+    # Outputs of a previous run may be links to the input frames and must not be overwritten in place
+    fop.delete_files(moco_dir, c.MOCO_FILE_PATTERN)
+    fop.delete_files(moco_dir, fop.SYMLINK_MANIFEST)
+    fixed_img_filename = pathlib.Path(non_moco_files[reference_frame_index]).name
+    result.reference_image = fop.copy_file(non_moco_files[reference_frame_index],
+                                           os.path.join(moco_dir, 'moco-' + fixed_img_filename))
+    reference_img = result.reference_image
+
+    # Parallelized alignment based on the resources available: Reference image is always the last file in the list
+
+    logging.info(f"Reference image (is fixed): {reference_img}")
+    print(f"Reference image (is fixed): {reference_img}")
+    moving_imgs = []
+    for y in range(start_frame, len(non_moco_files)):
+        moving_imgs.append(non_moco_files[y])
+    # remove the reference image from the moving images list
+    if non_moco_files[reference_frame_index] in moving_imgs:
+        moving_imgs.remove(non_moco_files[reference_frame_index])
+
+    with perfTrace.phase('registration', result.timings):
+        try:
+            result.pipeline_stats = greedy.align(fixed_img=reference_img, moving_imgs=moving_imgs,
+                                                 registration_type=registration,
+                                                 multi_resolution_iterations=multi_resolution_iterations,
+                                                 njobs=result.njobs, moco_dir=moco_dir,
+                                                 registration_options=registration_options, executor=executor)
+        except jobControl.JobError as error:
+            raise FalconError(str(error)) from error
+
+    with perfTrace.phase('copy_unregistered', result.timings):
+        if start_frame != 0:
+            for x in range(0, start_frame):
+                non_moco_filename = pathlib.Path(non_moco_files[x]).name
+                if config.link_unregistered:
+                    fop.symlink_file(non_moco_files[x], os.path.join(moco_dir, 'moco-' + non_moco_filename))
+                else:
+                    fop.copy_file(non_moco_files[x], os.path.join(moco_dir, 'moco-' + non_moco_filename))
+                logging.info(f"Copying files {non_moco_filename} to {moco_dir}")
+                print(f"Copying files {non_moco_filename} to {moco_dir}")
+        else:
+            logging.info('No files to copy! Motion correction is being performed from first frame.')
+            print(' ')
+            print('Motion correction is being performed from first frame...')
+
+    # Merge the split 3d motion corrected file into a single 4d file
+
+    with perfTrace.phase('merge', result.timings):
+        imageIO.merge3d(nifti_dir=moco_dir, wild_card='moco-*nii*', nifti_outfile='4d-moco.nii.gz')
+        result.moco_4d_file = os.path.join(moco_dir, '4d-moco.nii.gz')
+        logging.info(f"Merged 3d motion corrected files into a single 4d file: {result.moco_4d_file}")
+        print(f"Merged 3d motion corrected files into a single 4d file: {result.moco_4d_file}")
+
+    # Clean up measures: Moving the generated transform files to the 'transform' folder for subsequent use.
+
+    with perfTrace.phase('transform_moves', result.timings):
+        result.transform_dir = fop.make_dir(moco_dir, 'transforms')
+        transform_dir = result.transform_dir
+        if registration == 'rigid':
+            fop.move_files(src_dir=split3d_folder, dest_dir=transform_dir, wildcard='*rigid*.mat')
+            logging.info(f"Moved rigid transform files to {transform_dir}")
+            print(f"Moved rigid transform files to {transform_dir}")
+        elif registration == 'affine':
+            fop.move_files(src_dir=split3d_folder, dest_dir=transform_dir, wildcard='*affine*.mat')
+            logging.info(f"Moved affine transform files to {transform_dir}")
+            print(f"Moved affine transform files to {transform_dir}")
+        elif registration == 'deformable':
+            fop.move_files(src_dir=split3d_folder, dest_dir=transform_dir, wildcard='*affine*.mat')
+            fop.move_files(src_dir=split3d_folder, dest_dir=transform_dir, wildcard='*warp*.nii.gz')
+            logging.info(f"Moved deformable warp files to {transform_dir}")
+            print(f"Moved deformable warp files to {transform_dir}")
+        result.frame_transforms = greedy.get_frame_transforms(transform_dir, registration)
+
+    # Motion parameters of all frames, parsed from their linear transforms in one pass
+
+    with perfTrace.phase('motion_parameters', result.timings):
+        result.motion_parameters_file = greedy.save_motion_parameters(reference_img, result.frame_transforms,
+                                                                      transform_dir)
+        logging.info(f"Saved the motion parameters of the frames to {result.motion_parameters_file}")
+        print(f"Saved the motion parameters of the frames to {result.motion_parameters_file}")
+
+    stop = timeit.default_timer()
+    result.timings['total'] = stop - start
+    logging.info(' ')
+    logging.info('MOTION CORRECTION DONE!')
+    print('MOTION CORRECTION DONE!')
+    logging.info(f"Total time taken for motion correction: {(stop - start) / 60:.2f} minutes")
+    print(f"Total time taken for motion correction: {(stop - start) / 60:.2f} minutes")
+    logging.info(' ')
+    return result
+
+
+def relocate(path: str, src_dir: str, dest_dir: str) -> str:
+    """
+    Maps a path below one folder to the same relative path below another folder
+    :param path: Path to map
+    :param src_dir: Folder the path is below
+    :param dest_dir: Folder the path is mapped to
+    :return: Mapped path, or the path itself if it is not below src_dir
+    """
+    if not path or os.path.commonpath([path, src_dir]) != src_dir:
+        return path
+    return os.path.join(dest_dir, os.path.relpath(path, src_dir))
+
+
+def run_on_scratch(config: RunConfig, executor=None) -> RunResult:
+    """
+    Performs the motion correction of a study on a scratch folder: the study folder is staged to the scratch folder,
+    the whole pipeline runs there, and only the moco folder (motion corrected frames, 4d image and transforms) is
+    copied back to the same place in the study folder. The staged copy is removed on success and kept on failure.
+    :param config: Configuration of the run, with config.scratch_dir set
+    :param executor: Optional caller-provided concurrent.futures.Executor on which all parallel jobs are run
+    :return: Result of the run, with the paths pointing into the study folder
+    """
+    start = timeit.default_timer()
+    working_dir = os.path.abspath(config.main_folder)
+    scratch_root = tempfile.mkdtemp(prefix='falcon-', dir=os.path.abspath(config.scratch_dir))
+    scratch_working_dir = os.path.join(scratch_root, pathlib.Path(working_dir).name)
+    logging.info(f"Staging {working_dir} to {scratch_working_dir}")
+    print(f"Staging {working_dir} to {scratch_working_dir}")
+    shutil.copytree(working_dir, scratch_working_dir, copy_function=fop.copy_file)
+    stage_in_time = timeit.default_timer() - start
+
+    try:
+        result = run(dataclasses.replace(config, main_folder=scratch_working_dir, scratch_dir=None), executor)
+    except BaseException:
+        logging.error(f"Motion correction of {working_dir} failed, the intermediate files are kept in "
+                      f"{scratch_working_dir}")
+        print(f"Motion correction of {working_dir} failed, the intermediate files are kept in {scratch_working_dir}")
+        raise
+
+    phase_start = timeit.default_timer()
+    moco_dir = relocate(result.moco_dir, scratch_working_dir, working_dir)
+    # Symbolic links would point into the scratch folder, which is removed
+    fop.materialize_symlinks(result.moco_dir)
+    shutil.copytree(result.moco_dir, moco_dir, dirs_exist_ok=True, copy_function=fop.copy_file)
+    logging.info(f"Copied the motion corrected files back to {moco_dir}")
+    print(f"Copied the motion corrected files back to {moco_dir}")
+    shutil.rmtree(scratch_root)
+
+    for path_field in ('nifti_dir', 'split3d_dir', 'moco_dir', 'transform_dir', 'moco_4d_file', 'reference_image',
+                       'motion_parameters_file'):
+        setattr(result, path_field, relocate(getattr(result, path_field), scratch_working_dir, working_dir))
+    result.working_dir = working_dir
+    result.frame_transforms = {frame: [relocate(transform_file, scratch_working_dir, working_dir)
+                                       for transform_file in transform_files]
+                               for frame, transform_files in result.frame_transforms.items()}
+    result.timings['stage_in'] = stage_in_time
+    result.timings['stage_out'] = timeit.default_timer() - phase_start
+    result.timings['total'] = timeit.default_timer() - start
+    return result
+
+
+def run_study(config: RunConfig, executor=None) -> RunResult:
+    """
+    Performs the motion correction of a study like run, for callers that process many studies in one process (batch,
+    server): the sys.exit calls of the lower level modules (e.g. mixed file formats) are turned into a FalconError,
+    so that one bad study does not end the others
+    :param config: Configuration of the run
+    :param executor: Optional caller-provided concurrent.futures.Executor, see run
+    :return: Result of the run
+    """
+    try:
+        return run(config, executor)
+    except SystemExit as error:
+        raise FalconError(str(error.code)) from error
+
+
+def run_batch(configs: list, njobs: int = None, concurrent_studies: int = 2, log_file: str = None,
+              trace_file: str = None) -> list:
+    """
+    Performs the motion correction of several studies with one global worker pool. Up to concurrent_studies studies
+    are processed at the same time, so the serial phases of one study (conversion, splitting, start frame detection,
+    merging) overlap with the registrations of the others, while all frame-level jobs share the global pool.
+    :param configs: List of run configurations, one per study
+    :param njobs: Number of workers of the global pool, None to derive it from the available resources
+    :param concurrent_studies: Number of studies that are processed at the same time
+    :param log_file: Optional log file the workers write their log messages to
+    :param trace_file: Optional JSON lines file the performance trace of all studies and workers is appended to
+    :return: List of results (RunResult, or the exception that stopped the study) in the order of the configurations
+    """
+    if trace_file is not None:
+        # Enabled before the pool is created, so that the workers inherit it
+        trace_file = perfTrace.enable(trace_file)
+        for config in configs:
+            config.trace_file = trace_file
+    if njobs is None:
+        njobs = max(get_number_of_jobs(config.registration) for config in configs)
+    for config in configs:
+        config.njobs = njobs
+    logging.info(f"Batch of {len(configs)} studies | Global worker pool: {njobs} jobs | Concurrent studies: "
+                 f"{concurrent_studies}")
+    # The studies share the pool, so its workers are pinned here instead of in greedy.align
+    core_sets = None
+    if any((config.registration_options or {}).get('pin_cores') for config in configs):
+        threads_per_job = max((config.registration_options or {}).get('threads_per_job') or 0 for config in configs)
+        core_sets = su.get_core_sets(njobs, threads_per_job or su.get_threads_per_job(njobs))
+    with su.create_worker_pool(njobs, log_file, core_sets=core_sets) as worker_pool, \
+            ThreadPoolExecutor(max_workers=concurrent_studies) as study_pool:
+        futures = [study_pool.submit(run_study, config, worker_pool) for config in configs]
+        results = []
+        for config, future in zip(configs, futures):
+            try:
+                results.append(future.result())
+            except Exception as error:
+                logging.error(f"Motion correction of {config.main_folder} failed: {error}")
+                results.append(error)
+    return results
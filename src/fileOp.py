@@ -14,6 +14,7 @@
 # License: Apache 2.0
 # **********************************************************************************************************************
 
+import errno
 import glob
 import json
 import os
@@ -22,6 +23,18 @@ from pathlib import Path
 import natsort
 import pyfiglet
 
+import perfTrace
+
+# ioctl request of Linux to share the extents of one file with another (reflink, copy-on-write: btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+# Errors that mean a file system or a pair of files does not support a link type, so the next one is tried
+LINK_UNSUPPORTED_ERRORS = (errno.EXDEV, errno.EPERM, errno.EACCES, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP,
+                           errno.EINVAL, errno.ENOTTY, errno.EBADF, errno.ENOSYS)
+
+# Manifest of the symbolic links among the outputs of a folder, see symlink_file
+SYMLINK_MANIFEST = 'symlinks.json'
+
 
 def display_logo_FALCON():
     """
@@ -111,7 +124,7 @@ def move_files(src_dir: str, dest_dir: str, wildcard: str) -> None:
 
 def copy_files(src_dir: str, dest_dir: str, wildcard: str) -> None:
     """
-    Copies files from one directory to another
+    Copies files from one directory to another (as reflinks or hardlinks where possible, see copy_file)
     :param src_dir: Source directory from which files are copied
     :param dest_dir: Target directory to which files are copied
     :param wildcard: Wildcard to filter files that are copied
@@ -121,22 +134,97 @@ def copy_files(src_dir: str, dest_dir: str, wildcard: str) -> None:
     files = get_files(src_dir, wildcard)
     # Copy each file from source directory to destination directory
     for file in files:
-        shutil.copy(file, dest_dir)
+        copy_file(file, dest_dir)
+
+
+def reflink_file(source_file_path: str, target_file_path: str) -> bool:
+    """
+    Creates a reflink (copy-on-write clone) of a file, which shares the data of the source until either is modified
+    :param source_file_path: File to clone
+    :param target_file_path: Path of the clone
+    :return: True if the clone was created, False if the file system does not support reflinks
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(source_file_path, 'rb') as source_file, open(target_file_path, 'wb') as target_file:
+        try:
+            fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+            return True
+        except OSError as error:
+            if error.errno not in LINK_UNSUPPORTED_ERRORS:
+                raise
+    os.remove(target_file_path)
+    return False
 
 
 def copy_file(source_file_path: str, target_path: str) -> str:
     """
-    Copies a source file to the specified destination
+    Copies a source file to the specified destination. The copy is made as a reflink if the file system supports it,
+    else as a hardlink, and only falls back to copying the data if neither works. Hardlinks share their data with the
+    source, so the copy must never be modified in place; an existing target is unlinked first for that reason.
     @rtype: str
     @param source_file_path: the absolute path and file to copy
     @param target_path: the destination where the file will be copied to
     @return: a string containing the absolute path to the just copied file
     """
-    if os.path.isfile(source_file_path):
-        file_path = shutil.copy(source_file_path, target_path)
-        return file_path
-    else:
+    if not os.path.isfile(source_file_path):
         print(f'Error: {source_file_path} is not a file!')
+        return None
+    # Links are made to the data, never to a symbolic link that may dangle later
+    source_file_path = os.path.realpath(source_file_path)
+    if os.path.isdir(target_path):
+        target_path = os.path.join(target_path, os.path.basename(source_file_path))
+    if os.path.lexists(target_path):
+        os.remove(target_path)
+    if reflink_file(source_file_path, target_path):
+        return target_path
+    try:
+        os.link(source_file_path, target_path)
+        return target_path
+    except OSError as error:
+        if error.errno not in LINK_UNSUPPORTED_ERRORS:
+            raise
+    return shutil.copy(source_file_path, target_path)
+
+
+def symlink_file(source_file_path: str, target_path: str) -> str:
+    """
+    Makes a file available under another path as a symbolic link and records the link in the symlink manifest of the
+    target folder, so that consumers that need real files can resolve them (see materialize_symlinks). Use this only
+    where the consumer allows links, e.g. for unregistered frames that are only merged into the 4d image.
+    :param source_file_path: File to link to
+    :param target_path: Path of the symbolic link
+    :return: Path of the symbolic link
+    """
+    source_file_path = os.path.abspath(source_file_path)
+    target_path = os.path.abspath(target_path)
+    if os.path.lexists(target_path):
+        os.remove(target_path)
+    os.symlink(source_file_path, target_path)
+    manifest_file = os.path.join(os.path.dirname(target_path), SYMLINK_MANIFEST)
+    manifest = read_json(manifest_file) if os.path.exists(manifest_file) else {}
+    manifest[os.path.basename(target_path)] = source_file_path
+    with open(manifest_file, 'w') as manifest_out:
+        json.dump(manifest, manifest_out, indent=4)
+    return target_path
+
+
+def materialize_symlinks(dir_path: str) -> None:
+    """
+    Replaces the symbolic links recorded in the symlink manifest of a folder with copies of their targets
+    :param dir_path: Folder containing the symlink manifest
+    :return: None
+    """
+    manifest_file = os.path.join(dir_path, SYMLINK_MANIFEST)
+    if not os.path.exists(manifest_file):
+        return
+    for link_name, source_file_path in read_json(manifest_file).items():
+        link_path = os.path.join(dir_path, link_name)
+        if os.path.islink(link_path):
+            copy_file(source_file_path, link_path)
+    os.remove(manifest_file)
 
 
 def delete_files(dir_path: str, wildcard: str) -> None:
@@ -164,7 +252,7 @@ def compress_files(dir_path: str, wildcard: str) -> None:
     files = get_files(dir_path, wildcard)
     # Compress each file using pigz
     for file in files:
-        os.system("pigz " + file)
+        perfTrace.run_tool("pigz " + file, frame=os.path.basename(file))
 
 
 def read_json(file_path: str) -> dict:
@@ -186,10 +274,9 @@ def organise_nii_files_in_folders(dir_path: str, json_files: list) -> None:
     :param json_files: Path to the JSON file
     :return: None
     """
-    os.chdir(dir_path)
     for json_file in json_files:
         nifti_file = Path(json_file).stem + ".nii"
-        if os.path.exists(nifti_file):
+        if os.path.exists(os.path.join(dir_path, nifti_file)):
             # Get the modality from the json file
             modality = read_json(json_file)["modality"]
             # Create a new directory for the modality if it does not exist
@@ -18,116 +18,262 @@
 
 # Libraries to import
 
+import csv
+import functools
+import itertools
+import json
 import logging
 import os
 import pathlib
 import re
-import subprocess
+import shutil
 import sys
+import tempfile
 
-from mpire import WorkerPool
+import natsort
 
+import constants as c
+import fileOp as fop
+import imageOp as iop
+import jobControl
+import perfTrace
+import preProcessing as pp
+import sysUtil as su
 
-def rigid(fixed_img: str, moving_img: str, cost_function: str, multi_resolution_iterations: str) -> str:
+# Columns of the motion parameter table of a run, see get_motion_parameters (translations in mm, rotations in degrees)
+MOTION_PARAMETERS = ['translation_x', 'translation_y', 'translation_z', 'rotation_x', 'rotation_y', 'rotation_z',
+                     'scale_x', 'scale_y', 'scale_z', 'max_displacement']
+
+
+def get_threads_option() -> str:
+    """
+    Gets the greedy option that limits a call to the thread budget of the current job, see sysUtil.set_thread_budget
+    :return: ' -threads N', or '' if the job has no thread budget (greedy then uses every CPU it may run on)
+    """
+    threads = os.environ.get(su.THREADS_ENV_VARIABLE)
+    return f" -threads {threads}" if threads else ""
+
+
+def rigid(fixed_img: str, moving_img: str, cost_function: str, multi_resolution_iterations: str,
+          shrink_factor: int = 1, initializer: str = 'image-centers') -> str:
     """ Performs rigid registration between a fixed and moving image using the greedy registration toolkit.
     :param fixed_img: Reference image
     :param moving_img: Moving image
     :param cost_function: Cost function
     :param multi_resolution_iterations: Amount of iterations for each resolution level
+    :param shrink_factor: If > 1, the transform is estimated on smoothed images downsampled by this factor
+    :param initializer: Initial alignment, see get_initialization
     :return str
     """
     out_dir = pathlib.Path(moving_img).parent
     moving_img_filename = pathlib.Path(moving_img).name
     rigid_transform_file = os.path.join(out_dir, f"{moving_img_filename}_rigid.mat")
-    cmd_to_run = f"greedy -d 3 -a -i " \
-                 f"{re.escape(fixed_img)} {re.escape(moving_img)} -ia-image-centers -dof 6 -o " \
+    estimation_fixed_img, estimation_moving_img = get_estimation_images(fixed_img, moving_img, shrink_factor)
+    initial_option, initial_alignment, initial_transform_file = get_initialization(fixed_img, moving_img, initializer)
+    cmd_to_run = f"greedy -d 3{get_threads_option()} -a -i " \
+                 f"{re.escape(estimation_fixed_img)} {re.escape(estimation_moving_img)} {initial_option} -dof 6 -o " \
                  f"{re.escape(rigid_transform_file)} -n " \
                  f"{multi_resolution_iterations} " \
                  f"-m {cost_function}"
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    try:
+        jobControl.run_checked(cmd_to_run, [rigid_transform_file], frame=pathlib.Path(moving_img).name)
+    finally:
+        if initial_transform_file is not None:
+            os.remove(initial_transform_file)
     logging.info(f"Aligning: {pathlib.Path(moving_img).name} -> {pathlib.Path(fixed_img).name} | Aligned image: "
-                 f"moco-{pathlib.Path(moving_img).name} | Cost function: {cost_function} | Initial alignment: Image "
-                 f"centers | Transform file: {pathlib.Path(rigid_transform_file).name}")
+                 f"moco-{pathlib.Path(moving_img).name} | Cost function: {cost_function} | Initial alignment: "
+                 f"{initial_alignment} | Transform file: {pathlib.Path(rigid_transform_file).name}")
     print(f"Rigid alignment: {pathlib.Path(moving_img).name} -> {pathlib.Path(fixed_img).name} | Aligned image: moco-"
-          f"{pathlib.Path(moving_img).name} | Cost function: {cost_function} | Initial alignment: Image centers | "
-          f"Transform file: {pathlib.Path(rigid_transform_file).name}")
+          f"{pathlib.Path(moving_img).name} | Cost function: {cost_function} | Initial alignment: "
+          f"{initial_alignment} | Transform file: {pathlib.Path(rigid_transform_file).name}")
     return rigid_transform_file
 
 
-def affine(fixed_img: str, moving_img: str, cost_function: str, multi_resolution_iterations: str) -> str:
+def affine(fixed_img: str, moving_img: str, cost_function: str, multi_resolution_iterations: str,
+           shrink_factor: int = 1, initializer: str = 'image-centers') -> str:
     """ Performs affine registration between a fixed and moving image using the greedy registration toolkit.
     :param fixed_img: Reference image
     :param moving_img: Moving image
     :param cost_function: Cost function
     :param multi_resolution_iterations: Amount of iterations for each resolution level
+    :param shrink_factor: If > 1, the transform is estimated on smoothed images downsampled by this factor
+    :param initializer: Initial alignment, see get_initialization
     :return str : Path of the Affine transform file generated
     """
     out_dir = pathlib.Path(moving_img).parent
     moving_img_filename = pathlib.Path(moving_img).name
     affine_transform_file = os.path.join(out_dir, f"{moving_img_filename}_affine.mat")
-    cmd_to_run = f"greedy -d 3 -a -i {re.escape(fixed_img)} {re.escape(moving_img)} -ia-image-centers -dof 12 -o " \
+    estimation_fixed_img, estimation_moving_img = get_estimation_images(fixed_img, moving_img, shrink_factor)
+    initial_option, initial_alignment, initial_transform_file = get_initialization(fixed_img, moving_img, initializer)
+    cmd_to_run = f"greedy -d 3{get_threads_option()} " \
+                 f"-a -i {re.escape(estimation_fixed_img)} {re.escape(estimation_moving_img)} " \
+                 f"{initial_option} -dof 12 -o " \
                  f"{re.escape(affine_transform_file)} -n " \
                  f"{multi_resolution_iterations} " \
                  f"-m {cost_function} "
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    try:
+        jobControl.run_checked(cmd_to_run, [affine_transform_file], frame=pathlib.Path(moving_img).name)
+    finally:
+        if initial_transform_file is not None:
+            os.remove(initial_transform_file)
     logging.info(f"Affine alignment: {pathlib.Path(moving_img).name} -> {pathlib.Path(fixed_img).name} | Aligned "
                  f"image: moco-{pathlib.Path(moving_img).name} | Cost function: {cost_function} | Initial alignment: "
-                 f"Image centers | Transform file: {pathlib.Path(affine_transform_file).name}")
+                 f"{initial_alignment} | Transform file: {pathlib.Path(affine_transform_file).name}")
     print(f"Affine alignment: {pathlib.Path(moving_img).name} -> {pathlib.Path(fixed_img).name} | Aligned image: moco-"
-          f"{pathlib.Path(moving_img).name} | Cost function: {cost_function} | Initial alignment: Image centers | "
-          f"Transform file: {pathlib.Path(affine_transform_file).name}")
+          f"{pathlib.Path(moving_img).name} | Cost function: {cost_function} | Initial alignment: "
+          f"{initial_alignment} | Transform file: {pathlib.Path(affine_transform_file).name}")
     return affine_transform_file
 
 
-def deformable(fixed_img: str, moving_img: str, cost_function: str, multi_resolution_iterations: str) -> tuple:
+def deformable(fixed_img: str, moving_img: str, cost_function: str, multi_resolution_iterations: str,
+               compute_inverse: bool = True, shrink_factor: int = 1, initializer: str = 'image-centers') -> tuple:
     """
     Performs deformable registration between a fixed and moving image using the greedy registration toolkit.
     :param fixed_img: Reference image
     :param moving_img: Moving image
     :param cost_function: Cost function
     :param multi_resolution_iterations: Amount of iterations for each resolution level
-    :return:
+    :param compute_inverse: If False, the inverse warp is not written and can be computed later with invert_warp
+    :param shrink_factor: If > 1, the initial affine transform is estimated on downsampled images
+    :param initializer: Initial alignment of the affine transform, see get_initialization
+    :return: Tuple of the affine transform file, the warp file and the inverse warp file (None if not computed)
     """
     out_dir = pathlib.Path(moving_img).parent
     moving_img_filename = pathlib.Path(moving_img).name
     warp_file = os.path.join(out_dir, f"{moving_img_filename}_warp.nii.gz")
     inverse_warp_file = os.path.join(out_dir, f"{moving_img_filename}_inverse_warp.nii.gz")
-    affine_transform_file = affine(fixed_img, moving_img, cost_function, multi_resolution_iterations)
-    cmd_to_run = f"greedy -d 3 -m {cost_function} -i {re.escape(fixed_img)} {re.escape(moving_img)} -it " \
+    affine_transform_file = affine(fixed_img, moving_img, cost_function, multi_resolution_iterations,
+                                   shrink_factor=shrink_factor, initializer=initializer)
+    inverse_warp_option = f"-oinv {re.escape(inverse_warp_file)} " if compute_inverse else ""
+    cmd_to_run = f"greedy -d 3{get_threads_option()} " \
+                 f"-m {cost_function} -i {re.escape(fixed_img)} {re.escape(moving_img)} -it " \
                  f"{re.escape(affine_transform_file)} -o " \
-                 f"{re.escape(warp_file)} -oinv " \
-                 f"{re.escape(inverse_warp_file)} " \
+                 f"{re.escape(warp_file)} {inverse_warp_option}" \
                  f"-sv -n {multi_resolution_iterations}"
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    jobControl.run_checked(cmd_to_run, [warp_file] + ([inverse_warp_file] if compute_inverse else []),
+                           frame=pathlib.Path(moving_img).name)
     logging.info(f"Deformable alignment (log-diff): {pathlib.Path(moving_img).name} -> {pathlib.Path(fixed_img).name} | Aligned "
                  f"image: moco-{pathlib.Path(moving_img).name} | Cost function: {cost_function} | Initial "
                  f"alignment:{pathlib.Path(affine_transform_file).name} | warp file: {pathlib.Path(warp_file).name}")
     print(f"Deformable alignment: {pathlib.Path(moving_img).name} -> {pathlib.Path(fixed_img).name} | Aligned image: "
           f"moco-{pathlib.Path(moving_img).name} | Cost function: {cost_function} | Initial alignment:{pathlib.Path(affine_transform_file).name} | "
           f"warp file: {pathlib.Path(warp_file).name}")
+    if not compute_inverse:
+        inverse_warp_file = None
     return affine_transform_file, warp_file, inverse_warp_file
 
 
-def registration(fixed_img: str, moving_img: str, registration_type: str, multi_resolution_iterations: str) -> None:
+def registration(fixed_img: str, moving_img: str, registration_type: str, multi_resolution_iterations: str,
+                 compute_inverse: bool = True, linear_shrink_factor: int = 1,
+                 initializer: str = 'image-centers') -> None:
     """
     Registers the fixed and the moving image using the greedy registration toolkit based on the user given cost function
     :param fixed_img: Reference image
     :param moving_img: Moving image
     :param registration_type: Type of registration ('rigid', 'affine' or 'deformable')
     :param multi_resolution_iterations: Amount of iterations for each resolution level
+    :param compute_inverse: Deformable only, if False the inverse warp is not written
+    :param linear_shrink_factor: If > 1, rigid and affine transforms are estimated on downsampled images
+    :param initializer: Initial alignment, see get_initialization
     :return: None
     """
     if registration_type == 'rigid':
-        rigid(fixed_img, moving_img, cost_function='NMI', multi_resolution_iterations=multi_resolution_iterations)
+        rigid(fixed_img, moving_img, cost_function='NMI', multi_resolution_iterations=multi_resolution_iterations,
+              shrink_factor=linear_shrink_factor, initializer=initializer)
     elif registration_type == 'affine':
-        affine(fixed_img, moving_img, cost_function='NMI', multi_resolution_iterations=multi_resolution_iterations)
+        affine(fixed_img, moving_img, cost_function='NMI', multi_resolution_iterations=multi_resolution_iterations,
+               shrink_factor=linear_shrink_factor, initializer=initializer)
     elif registration_type == 'deformable':
         deformable(fixed_img, moving_img, cost_function='NCC 2x2x2',
-                   multi_resolution_iterations=multi_resolution_iterations)
+                   multi_resolution_iterations=multi_resolution_iterations, compute_inverse=compute_inverse,
+                   shrink_factor=linear_shrink_factor, initializer=initializer)
     else:
         sys.exit("Registration type not supported!")
 
 
+def get_initialization(fixed_img: str, moving_img: str, initializer: str) -> tuple:
+    """
+    Gets the initial alignment of a linear registration:
+    - 'image-centers': greedy aligns the centers of the images (-ia-image-centers)
+    - 'phase-correlation': the translation is estimated by phase correlation on images downsampled by
+      c.INIT_SHRINK_LEVEL (see imageOp.estimate_initial_transform) and passed to greedy as initial transform (-ia);
+      implausible estimates fall back to the image centers
+    - 'phase-correlation-rotation': like 'phase-correlation', also trying the rotations c.INIT_ROTATION_ANGLES
+    :param fixed_img: Reference image
+    :param moving_img: Moving image
+    :param initializer: 'image-centers', 'phase-correlation' or 'phase-correlation-rotation'
+    :return: Tuple of the greedy option, a description for the log and the initial transform file to remove after
+    the registration (None for 'image-centers')
+    """
+    if initializer == 'image-centers':
+        return "-ia-image-centers", "Image centers", None
+    if initializer not in ('phase-correlation', 'phase-correlation-rotation'):
+        sys.exit(f"Initializer {initializer} not supported!")
+    import numpy as np
+    initial_transform = iop.estimate_initial_transform(
+        get_downscaled_image(fixed_img, c.INIT_SHRINK_LEVEL), get_downscaled_image(moving_img, c.INIT_SHRINK_LEVEL),
+        rotation_angles=c.INIT_ROTATION_ANGLES if initializer == 'phase-correlation-rotation' else None)
+    if initial_transform is None:
+        return "-ia-image-centers", "Image centers (phase correlation rejected)", None
+    # Every call gets its own file, so that a speculative copy of the job (see jobControl.map_jobs) cannot remove it
+    # while greedy reads it
+    file_descriptor, initial_transform_file = tempfile.mkstemp(prefix=f".{pathlib.Path(moving_img).name}-",
+                                                               suffix='_init.mat', dir=pathlib.Path(moving_img).parent)
+    os.close(file_descriptor)
+    np.savetxt(initial_transform_file, initial_transform, fmt='%.8g')
+    return f"-ia {re.escape(initial_transform_file)}", "Phase correlation", initial_transform_file
+
+
+def get_downscaled_image(img: str, shrink_factor: int) -> str:
+    """
+    Gets a smoothed copy of an image downsampled by the shrink factor. The copies are cached in a 'downscaled' folder
+    next to the image, or next to the moco folder for the reference image, because the moco folder only holds the
+    results of a run. A cached copy is keyed on the modification time of the image, so it is recreated when the image
+    changes, and it is written under a temporary name and then moved into place, so that workers downscaling the same
+    image at the same time never read a partially written copy.
+    :param img: Path to the image
+    :param shrink_factor: Factor by which the image is downsampled
+    :return: Path to the downscaled image
+    """
+    image = pathlib.Path(img)
+    image_dir = image.parent.parent if image.parent.name == 'moco' else image.parent
+    downscaled_dir = os.path.join(image_dir, 'downscaled')
+    os.makedirs(downscaled_dir, exist_ok=True)
+    cache_prefix = f"{shrink_factor}x_downscaled_"
+    downscaled_img = os.path.join(downscaled_dir, f"{cache_prefix}{os.stat(img).st_mtime_ns}_{image.name}")
+    if os.path.exists(downscaled_img):
+        return downscaled_img
+    work_dir = tempfile.mkdtemp(prefix='.downscaling-', dir=downscaled_dir)
+    try:
+        os.replace(pp.downscale_image((work_dir, shrink_factor), img), downscaled_img)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    # Copies of earlier versions of the image are stale
+    for cached_file in os.listdir(downscaled_dir):
+        version, _, cached_name = cached_file[len(cache_prefix):].partition('_')
+        if cached_file.startswith(cache_prefix) and version.isdigit() and cached_name == image.name and \
+                cached_file != os.path.basename(downscaled_img):
+            try:
+                os.remove(os.path.join(downscaled_dir, cached_file))
+            except FileNotFoundError:
+                pass
+    return downscaled_img
+
+
+def get_estimation_images(fixed_img: str, moving_img: str, shrink_factor: int) -> tuple:
+    """
+    Gets the images a linear transform is estimated on. Rigid and affine transforms live in physical space, so a
+    transform estimated on downsampled images applies unchanged to the original resolution images.
+    :param fixed_img: Reference image
+    :param moving_img: Moving image
+    :param shrink_factor: If > 1, downsampled copies of both images are used
+    :return: Tuple of the fixed and the moving image to estimate the transform on
+    """
+    if shrink_factor <= 1:
+        return fixed_img, moving_img
+    return get_downscaled_image(fixed_img, shrink_factor), get_downscaled_image(moving_img, shrink_factor)
+
+
 def resample(fixed_img: str, moving_img: str, resampled_moving_img: str, registration_type: str, segmentation="",
              resampled_seg="") -> None:
     """
@@ -143,44 +289,471 @@ def resample(fixed_img: str, moving_img: str, resampled_moving_img: str, registr
     moving_img_file = pathlib.Path(moving_img).name
     out_dir = pathlib.Path(moving_img).parent
     if registration_type == 'rigid':
-        rigid_transform_file = os.path.join(out_dir, f"{moving_img_file}_rigid.mat")
+        rigid_transform_file, = get_transform_files(moving_img_file, out_dir, registration_type)
         if segmentation and resampled_seg:
-            cmd_to_run = f"greedy -d 3 -rf {re.escape(fixed_img)} -ri LINEAR -rm {re.escape(moving_img)} " \
+            cmd_to_run = f"greedy -d 3{get_threads_option()} " \
+                         f"-rf {re.escape(fixed_img)} -ri LINEAR -rm {re.escape(moving_img)} " \
                          f"{re.escape(resampled_moving_img)} -ri LABEL " \
                          f"0.2vox -rm {re.escape(segmentation)} {re.escape(resampled_seg)} -r " \
                          f"{re.escape(rigid_transform_file)}"
         else:
-            cmd_to_run = f"greedy -d 3 -rf {re.escape(fixed_img)} -ri LINEAR -rm {re.escape(moving_img)} " \
+            cmd_to_run = f"greedy -d 3{get_threads_option()} " \
+                         f"-rf {re.escape(fixed_img)} -ri LINEAR -rm {re.escape(moving_img)} " \
                          f"{re.escape(resampled_moving_img)} -r {re.escape(rigid_transform_file)} "
     elif registration_type == 'affine':
-        affine_transform_file = os.path.join(out_dir, f"{moving_img_file}_affine.mat")
+        affine_transform_file, = get_transform_files(moving_img_file, out_dir, registration_type)
         if segmentation and resampled_seg:
-            cmd_to_run = f"greedy -d 3 -rf {re.escape(fixed_img)} -ri LINEAR -rm {re.escape(moving_img)} " \
+            cmd_to_run = f"greedy -d 3{get_threads_option()} " \
+                         f"-rf {re.escape(fixed_img)} -ri LINEAR -rm {re.escape(moving_img)} " \
                          f"{re.escape(resampled_moving_img)} -ri LABEL " \
                          f"0.2vox -rm {re.escape(segmentation)} {re.escape(resampled_seg)} -r " \
                          f"{re.escape(affine_transform_file)}"
         else:
-            cmd_to_run = f"greedy -d 3 -rf {re.escape(fixed_img)} -ri NN -rm {re.escape(moving_img)} " \
+            cmd_to_run = f"greedy -d 3{get_threads_option()} " \
+                         f"-rf {re.escape(fixed_img)} -ri NN -rm {re.escape(moving_img)} " \
                          f"{re.escape(resampled_moving_img)} -r {re.escape(affine_transform_file)}"
     elif registration_type == 'deformable':
-        warp_file = os.path.join(out_dir, f"{moving_img_file}_warp.nii.gz")
-        affine_transform_file = os.path.join(out_dir, f"{moving_img_file}_affine.mat")
+        warp_file, affine_transform_file = get_transform_files(moving_img_file, out_dir, registration_type)
+        (warp_file, affine_transform_file), temporary_files = expand_compact_warps(
+            fixed_img, [warp_file, affine_transform_file])
         if segmentation and resampled_seg:
-            cmd_to_run = f"greedy -d 3 -rf {re.escape(fixed_img)} -ri LINEAR -rm {re.escape(moving_img)} " \
+            cmd_to_run = f"greedy -d 3{get_threads_option()} " \
+                         f"-rf {re.escape(fixed_img)} -ri LINEAR -rm {re.escape(moving_img)} " \
                          f"{re.escape(resampled_moving_img)} -ri LABEL " \
                          f"0.2vox -rm {re.escape(segmentation)} {re.escape(resampled_seg)} -r {re.escape(warp_file)} " \
                          f"{re.escape(affine_transform_file)}"
         else:
-            cmd_to_run = f"greedy -d 3 -rf {re.escape(fixed_img)} -ri NN -rm {re.escape(moving_img)} " \
+            cmd_to_run = f"greedy -d 3{get_threads_option()} " \
+                         f"-rf {re.escape(fixed_img)} -ri NN -rm {re.escape(moving_img)} " \
                          f"{re.escape(resampled_moving_img)} -r {re.escape(warp_file)} " \
                          f"{re.escape(affine_transform_file)}"
     else:
         sys.exit("Registration type not supported!")
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    outputs = [resampled_moving_img, resampled_seg] if segmentation and resampled_seg else [resampled_moving_img]
+    jobControl.run_checked(cmd_to_run, outputs, frame=moving_img_file)
+    if registration_type == 'deformable':
+        for temporary_file in temporary_files:
+            os.remove(temporary_file)
+
+
+def get_transform_files(moving_img_file: str, transform_dir: str, registration_type: str) -> list:
+    """
+    Gets the transform files of a moving image in the order greedy expects them after '-r'
+    :param moving_img_file: File name of the moving image the transforms were estimated for
+    :param transform_dir: Directory containing the transform files
+    :param registration_type: 'rigid', 'affine', or 'deformable'
+    :return: List of transform file paths (warp first, then the linear transform)
+    """
+    if registration_type == 'rigid':
+        return [os.path.join(transform_dir, f"{moving_img_file}_rigid.mat")]
+    elif registration_type == 'affine':
+        return [os.path.join(transform_dir, f"{moving_img_file}_affine.mat")]
+    elif registration_type == 'deformable':
+        warp_file = os.path.join(transform_dir, f"{moving_img_file}_warp.nii.gz")
+        compact_warp_file = os.path.join(transform_dir, f"{moving_img_file}_warp_compact.nii.gz")
+        if not os.path.exists(warp_file) and os.path.exists(compact_warp_file):
+            warp_file = compact_warp_file
+        return [warp_file, os.path.join(transform_dir, f"{moving_img_file}_affine.mat")]
+    else:
+        sys.exit("Registration type not supported!")
+
+
+def compact_warp(warp_file: str, shrink_factor: int, quantize: bool) -> str:
+    """
+    Replaces a full resolution warp with its compact version (see imageOp.compact_warp for the precision).
+    :param warp_file: Path to the warp file written by deformable
+    :param shrink_factor: Factor by which the warp is downsampled (1 keeps the resolution)
+    :param quantize: If True, the warp is stored as 16-bit integers
+    :return: Path to the compact warp file
+    """
+    compact_warp_file = warp_file.replace('_warp.nii.gz', '_warp_compact.nii.gz')
+    iop.compact_warp(warp_file, compact_warp_file, shrink_factor=shrink_factor, quantize=quantize)
+    os.remove(warp_file)
+    logging.info(f"Compacted {pathlib.Path(warp_file).name} -> {pathlib.Path(compact_warp_file).name} | Shrink "
+                 f"factor: {shrink_factor} | 16 bit: {quantize}")
+    return compact_warp_file
+
+
+def expand_compact_warps(fixed_img: str, transform_files: list) -> tuple:
+    """
+    Replaces compact warps in a list of transform files with temporary full resolution copies greedy can apply.
+    :param fixed_img: Reference image that defines the full resolution grid
+    :param transform_files: Transform files in the order greedy expects them after '-r'
+    :return: Tuple of the transform files to pass to greedy and the temporary files to remove afterwards
+    """
+    expanded_files = []
+    temporary_files = []
+    for transform_file in transform_files:
+        if transform_file.endswith('_warp_compact.nii.gz'):
+            file_descriptor, expanded_file = tempfile.mkstemp(suffix='_warp.nii.gz',
+                                                              dir=os.path.dirname(transform_file))
+            os.close(file_descriptor)
+            iop.expand_warp(transform_file, fixed_img, expanded_file)
+            temporary_files.append(expanded_file)
+            transform_file = expanded_file
+        expanded_files.append(transform_file)
+    return expanded_files, temporary_files
+
+
+def expand_warp_mp(fixed_img: str, compact_warp_file: str) -> str:
+    """
+    Expands a compact warp into a temporary full resolution warp next to it
+    :param fixed_img: Reference image that defines the full resolution grid
+    :param compact_warp_file: Path to the compact warp
+    :return: Path to the temporary full resolution warp
+    """
+    (expanded_file,), _ = expand_compact_warps(fixed_img, [compact_warp_file])
+    return expanded_file
+
+
+def expand_job_warps(jobs: list, njobs: int, executor=None) -> tuple:
+    """
+    Expands every compact warp used by a list of apply_transforms jobs once, in parallel, so that jobs sharing the warp
+    of a frame reuse one full resolution copy instead of expanding it per job
+    :param jobs: List of apply_transforms argument tuples
+    :param njobs: Number of jobs to run in parallel
+    :param executor: Optional caller-provided concurrent.futures.Executor to run the jobs on
+    :return: Tuple of the jobs with the compact warps replaced and the temporary files to remove afterwards
+    """
+    compact_warps = {}
+    for fixed_img, _, _, transform_files, _ in jobs:
+        for transform_file in transform_files:
+            if transform_file.endswith('_warp_compact.nii.gz'):
+                compact_warps.setdefault(transform_file, fixed_img)
+    if not compact_warps:
+        return jobs, []
+    expanded_files = su.map_jobs(expand_warp_mp, [(fixed_img, compact_warp_file) for compact_warp_file, fixed_img in
+                                                  compact_warps.items()], njobs, executor=executor)
+    expanded_warps = dict(zip(compact_warps, expanded_files))
+    expanded_jobs = [(fixed_img, moving_img, resampled_moving_img,
+                      [expanded_warps.get(transform_file, transform_file) for transform_file in transform_files],
+                      interpolation)
+                     for fixed_img, moving_img, resampled_moving_img, transform_files, interpolation in jobs]
+    return expanded_jobs, expanded_files
+
+
+def invert_warp(fixed_img: str, warp_file: str, inverse_warp_file: str = None) -> str:
+    """
+    Computes the inverse of a stored (full resolution or compact) warp on demand, for runs that skipped the inverse.
+    :param fixed_img: Reference image the warp was estimated on
+    :param warp_file: Path to the warp file
+    :param inverse_warp_file: Path to the inverse warp file [default: <frame>_inverse_warp.nii.gz next to the warp]
+    :return: Path to the inverse warp file
+    """
+    if inverse_warp_file is None:
+        inverse_warp_file = re.sub(r'_warp(_compact)?\.nii\.gz$', '_inverse_warp.nii.gz', warp_file)
+    (full_warp_file,), temporary_files = expand_compact_warps(fixed_img, [warp_file])
+    cmd_to_run = f"greedy -d 3{get_threads_option()} -iw {re.escape(full_warp_file)} {re.escape(inverse_warp_file)}"
+    jobControl.run_checked(cmd_to_run, [inverse_warp_file], frame=pathlib.Path(warp_file).name)
+    for temporary_file in temporary_files:
+        os.remove(temporary_file)
+    logging.info(f"Inverted warp: {pathlib.Path(warp_file).name} -> {pathlib.Path(inverse_warp_file).name}")
+    return inverse_warp_file
+
+
+def get_frame_transforms(transform_dir: str, registration_type: str) -> dict:
+    """
+    Maps the frames of a finished run to their transform files stored in the transforms directory
+    :param transform_dir: Directory containing the transform files (moco/transforms)
+    :param registration_type: 'rigid', 'affine', or 'deformable'
+    :return: Dictionary mapping each frame file name to its transform files
+    """
+    suffix = '_rigid.mat' if registration_type == 'rigid' else '_affine.mat'
+    frame_transforms = {}
+    for transform_file in fop.get_files(transform_dir, f"*{suffix}"):
+        frame = pathlib.Path(transform_file).name[:-len(suffix)]
+        transform_files = get_transform_files(frame, transform_dir, registration_type)
+        if registration_type == 'deformable' and not os.path.exists(transform_files[0]):
+            # Frames triaged as motionless only have an (identity) affine transform
+            logging.info(f"No warp for {frame} in {transform_dir}, applying its affine transform only")
+            transform_files = transform_files[1:]
+        if all(os.path.exists(file) for file in transform_files):
+            frame_transforms[frame] = transform_files
+        else:
+            logging.warning(f"Incomplete transforms for {frame} in {transform_dir}, skipping frame")
+    return frame_transforms
+
+
+def get_registration_type(transform_dir: str) -> str:
+    """
+    Infers the registration type of a finished run from the transform files it left behind
+    :param transform_dir: Directory containing the transform files (moco/transforms)
+    :return: 'rigid', 'affine', or 'deformable'
+    """
+    if fop.get_files(transform_dir, '*_warp*.nii.gz'):
+        return 'deformable'
+    elif fop.get_files(transform_dir, '*_affine.mat'):
+        return 'affine'
+    elif fop.get_files(transform_dir, '*_rigid.mat'):
+        return 'rigid'
+    else:
+        sys.exit(f"No transform files found in {transform_dir}!")
+
+
+def apply_transforms(fixed_img: str, moving_img: str, resampled_moving_img: str, transform_files: list,
+                     interpolation: str = 'LINEAR') -> str:
+    """
+    Applies a chain of stored transforms to an image using the greedy registration toolkit.
+    :param fixed_img: Reference image that defines the output grid
+    :param moving_img: Image (or label map) to transform
+    :param resampled_moving_img: Transformed output image
+    :param transform_files: Transform files in the order greedy expects them after '-r'
+    :param interpolation: Greedy interpolation mode: 'LINEAR', 'NN' or 'LABEL' (label maps)
+    :return: Path of the transformed image
+    """
+    if interpolation == 'LABEL':
+        interpolation = 'LABEL 0.2vox'
+    transform_files, temporary_files = expand_compact_warps(fixed_img, transform_files)
+    transforms = ' '.join(re.escape(transform_file) for transform_file in transform_files)
+    cmd_to_run = f"greedy -d 3{get_threads_option()} " \
+                 f"-rf {re.escape(fixed_img)} -ri {interpolation} -rm {re.escape(moving_img)} " \
+                 f"{re.escape(resampled_moving_img)} -r {transforms}"
+    jobControl.run_checked(cmd_to_run, [resampled_moving_img], frame=pathlib.Path(moving_img).name)
+    for temporary_file in temporary_files:
+        os.remove(temporary_file)
+    return resampled_moving_img
+
+
+def read_transform(transform_file: str) -> 'np.ndarray':
+    """
+    Reads a greedy (RAS, 4x4) transform file
+    :param transform_file: Path to the *.mat transform file
+    :return: 4x4 transform matrix
+    """
+    import numpy as np
+    return np.loadtxt(transform_file).reshape(4, 4)
+
+
+def write_identity_transform(transform_file: str) -> str:
+    """
+    Writes an identity transform in greedy's *.mat format
+    :param transform_file: Path to the *.mat transform file
+    :return: Path to the *.mat transform file
+    """
+    import numpy as np
+    np.savetxt(transform_file, np.eye(4), fmt='%g')
+    return transform_file
+
+
+def get_corner_points(img: str) -> 'np.ndarray':
+    """
+    Gets the physical (RAS) coordinates of the eight corners of an image, the coordinate system of greedy's transforms
+    :param img: Path to the image
+    :return: 8x3 array of corner points
+    """
+    import numpy as np
+    img_grid = iop.get_image_grid(img)
+    corner_indices = itertools.product(*[(0, size - 1) for size in img_grid.GetSize()])
+    corners_lps = np.array([img_grid.TransformIndexToPhysicalPoint([int(index) for index in corner_index])
+                            for corner_index in corner_indices])
+    return corners_lps * np.array([-1, -1, 1])
+
+
+def get_max_displacement(transform: 'np.ndarray', points: 'np.ndarray') -> float:
+    """
+    Gets the largest displacement a linear transform causes at a set of points
+    :param transform: 4x4 transform matrix
+    :param points: Nx3 array of physical (RAS) points
+    :return: Largest displacement in mm
+    """
+    import numpy as np
+    homogeneous_points = np.hstack([points, np.ones((len(points), 1))])
+    displaced_points = homogeneous_points @ transform.T
+    return float(np.max(np.linalg.norm(displaced_points[:, :3] - points, axis=1)))
+
+
+@functools.lru_cache(maxsize=4)
+def get_body_points(img: str) -> 'np.ndarray':
+    """
+    Gets the physical (RAS) coordinates of the eight corners of the bounding box of the body (Otsu foreground) of an
+    image; a linear transform moves no point of the body farther than the farthest of these corners. Cached, since
+    every frame of a study is compared with the same reference frame.
+    :param img: Path to the image
+    :return: 8x3 array of corner points, the corners of the field of view if the image has no foreground
+    """
+    import numpy as np
+    import SimpleITK
+    image = SimpleITK.ReadImage(img, SimpleITK.sitkFloat32)
+    label_statistics = SimpleITK.LabelShapeStatisticsImageFilter()
+    label_statistics.Execute(SimpleITK.OtsuThreshold(image, 0, 1))
+    if not label_statistics.HasLabel(1):
+        return get_corner_points(img)
+    bounding_box = label_statistics.GetBoundingBox(1)
+    corner_indices = itertools.product(*[(start, start + size - 1) for start, size in
+                                         zip(bounding_box[:3], bounding_box[3:])])
+    corners_lps = np.array([image.TransformIndexToPhysicalPoint([int(index) for index in corner_index])
+                            for corner_index in corner_indices])
+    return corners_lps * np.array([-1, -1, 1])
+
+
+def get_motion_parameters(transform: 'np.ndarray', points: 'np.ndarray') -> list:
+    """
+    Decomposes a linear transform into the motion parameters of MOTION_PARAMETERS: the translation, the rotation about
+    the x, y and z axes (R = Rz Ry Rx, taken from the polar decomposition of the linear part), the scales along the
+    rotated axes and the largest displacement at a set of points (e.g. get_body_points)
+    :param transform: 4x4 transform matrix
+    :param points: Nx3 array of physical (RAS) points
+    :return: List of the motion parameters
+    """
+    import numpy as np
+    linear = transform[:3, :3]
+    left, _, right = np.linalg.svd(linear)
+    if np.linalg.det(left @ right) < 0:
+        left[:, -1] *= -1
+    rotation = left @ right
+    rotation_angles = np.degrees([np.arctan2(rotation[2, 1], rotation[2, 2]),
+                                  np.arcsin(np.clip(-rotation[2, 0], -1, 1)),
+                                  np.arctan2(rotation[1, 0], rotation[0, 0])])
+    scales = np.diag(rotation.T @ linear)
+    return [*transform[:3, 3].tolist(), *rotation_angles.tolist(), *scales.tolist(),
+            get_max_displacement(transform, points)]
+
+
+def get_motion_threshold(img: str) -> float:
+    """
+    Gets the displacement below which a frame is not resampled, see is_near_identity
+    :param img: Path to the fixed image
+    :return: c.RESAMPLE_SKIP_THRESHOLD voxels of the image in mm
+    """
+    return c.RESAMPLE_SKIP_THRESHOLD * min(iop.get_image_grid(img).GetSpacing())
+
+
+def is_near_identity(fixed_img: str, moving_img: str, transform_file: str) -> bool:
+    """
+    Checks if resampling a frame with its linear transform would only interpolate it: the frame is on the grid of the
+    fixed image and its transform moves no corner of the body by c.RESAMPLE_SKIP_THRESHOLD voxels or more
+    :param fixed_img: Path to the fixed image
+    :param moving_img: Path to the moving image
+    :param transform_file: Path to the linear transform of the moving image
+    :return: True if the frame can be used as it is
+    """
+    import numpy as np
+    fixed_grid = iop.get_image_grid(fixed_img)
+    moving_grid = iop.get_image_grid(moving_img)
+    if fixed_grid.GetSize() != moving_grid.GetSize() or not all(
+            np.allclose(getattr(fixed_grid, getter)(), getattr(moving_grid, getter)(), atol=1e-4)
+            for getter in ('GetSpacing', 'GetOrigin', 'GetDirection')):
+        return False
+    displacement = get_max_displacement(read_transform(transform_file), get_body_points(fixed_img))
+    return displacement < get_motion_threshold(fixed_img)
+
+
+def get_motion_table(fixed_img: str, frame_transforms: dict) -> tuple:
+    """
+    Parses the linear transforms of all frames of a run into a table of motion parameters
+    :param fixed_img: Path to the fixed (reference) image, its body corners are used for the displacement
+    :param frame_transforms: Dictionary mapping each frame to its transform files, see get_frame_transforms
+    :return: Tuple of the naturally sorted frame names and a frames x MOTION_PARAMETERS array
+    """
+    import numpy as np
+    body_points = get_body_points(fixed_img)
+    frames = natsort.natsorted(frame_transforms)
+    motion_table = np.array([get_motion_parameters(read_transform(frame_transforms[frame][-1]), body_points)
+                             for frame in frames], dtype=float).reshape(len(frames), len(MOTION_PARAMETERS))
+    return frames, motion_table
+
+
+def save_motion_parameters(fixed_img: str, frame_transforms: dict, out_dir: str) -> str:
+    """
+    Saves the motion parameters of all frames of a run as CSV (with the frame names) and as NPY (the array only, rows
+    in the order of the CSV), named c.MOTION_PARAMETERS_FILE
+    :param fixed_img: Path to the fixed (reference) image
+    :param frame_transforms: Dictionary mapping each frame to its transform files, see get_frame_transforms
+    :param out_dir: Directory the files are written to
+    :return: Path of the CSV file
+    """
+    import numpy as np
+    frames, motion_table = get_motion_table(fixed_img, frame_transforms)
+    csv_file = os.path.join(out_dir, f"{c.MOTION_PARAMETERS_FILE}.csv")
+    with open(csv_file, 'w', newline='') as csv_out:
+        csv_writer = csv.writer(csv_out)
+        csv_writer.writerow(['frame'] + MOTION_PARAMETERS)
+        for frame, motion_parameters in zip(frames, motion_table):
+            csv_writer.writerow([frame] + [f"{value:.6g}" for value in motion_parameters])
+    np.save(os.path.join(out_dir, f"{c.MOTION_PARAMETERS_FILE}.npy"), motion_table)
+    if frames:
+        displacements = motion_table[:, -1]
+        logging.info(f"Motion parameters of {len(frames)} frames saved to {csv_file} | Maximum displacement: mean "
+                     f"{displacements.mean():.2f} mm, max {displacements.max():.2f} mm "
+                     f"({frames[int(displacements.argmax())]})")
+    return csv_file
+
+
+def triage(fixed_img: str, moving_imgs: list, njobs: int, executor=None, threads_per_job: int = None) -> tuple:
+    """
+    Splits the moving images into frames that moved and frames that did not, based on a fast rigid registration on
+    downsampled images. A frame is motionless if no corner of the field of view moves by more than
+    c.TRIAGE_MOTION_THRESHOLD voxels.
+    :param fixed_img: Path to the fixed image
+    :param moving_imgs: List of paths to the moving images
+    :param njobs: Number of jobs to run in parallel
+    :param executor: Optional caller-provided concurrent.futures.Executor to run the jobs on
+    :param threads_per_job: Optional thread budget of every job, see sysUtil.set_thread_budget
+    :return: Tuple of the moving images that need registration, the motionless moving images and a dictionary
+    mapping each moving image to its maximum displacement in mm
+    """
+    triage_dir = fop.make_dir(str(pathlib.Path(moving_imgs[0]).parent), 'triage')
+    downscaled_fixed_img = get_downscaled_image(fixed_img, c.TRIAGE_SHRINK_LEVEL)
+    corner_points = get_corner_points(fixed_img)
+    motion_threshold = c.TRIAGE_MOTION_THRESHOLD * min(iop.get_image_grid(fixed_img).GetSpacing())
+    triage_transforms = su.map_jobs(triage_mp, moving_imgs, njobs, shared_objects=(
+        downscaled_fixed_img, triage_dir, threads_per_job), executor=executor)
+
+    moved_imgs = []
+    motionless_imgs = []
+    displacements = {}
+    for moving_img, triage_transform in zip(moving_imgs, triage_transforms):
+        displacement = get_max_displacement(read_transform(triage_transform), corner_points)
+        displacements[moving_img] = displacement
+        if displacement < motion_threshold:
+            motionless_imgs.append(moving_img)
+        else:
+            moved_imgs.append(moving_img)
+        logging.info(f"Triage: {pathlib.Path(moving_img).name} | Maximum displacement: {displacement:.2f} mm | "
+                     f"{'motionless' if displacement < motion_threshold else 'moved'}")
+    logging.info(f"Triage: {len(motionless_imgs)} of {len(moving_imgs)} frames are motionless (< "
+                 f"{motion_threshold:.2f} mm) and will not be registered")
+    return moved_imgs, motionless_imgs, displacements
+
+
+def triage_mp(triage_param: tuple, moving_img: str) -> str:
+    """
+    Estimates the rigid motion of a single image on downsampled images.
+    :param triage_param: Tuple containing the downsampled fixed image, the triage directory and the thread budget
+    :param moving_img: Path to the moving image
+    :return: Path to the rigid transform file of the downsampled registration
+    """
+    downscaled_fixed_img, triage_dir, threads_per_job = triage_param
+    if threads_per_job:
+        su.set_thread_budget(threads_per_job)
+    downscaled_moving_img = get_downscaled_image(moving_img, c.TRIAGE_SHRINK_LEVEL)
+    triage_transform_file = os.path.join(triage_dir, f"{pathlib.Path(moving_img).name}_triage_rigid.mat")
+    cmd_to_run = f"greedy -d 3{get_threads_option()} " \
+                 f"-a -i {re.escape(downscaled_fixed_img)} {re.escape(downscaled_moving_img)} " \
+                 f"-ia-image-centers -dof 6 -o {re.escape(triage_transform_file)} -n {c.TRIAGE_ITERATIONS} -m NMI"
+    jobControl.run_checked(cmd_to_run, [triage_transform_file], frame=pathlib.Path(moving_img).name)
+    return triage_transform_file
+
+
+def copy_motionless(moving_img: str, registration_type: str, moco_dir: str) -> None:
+    """
+    Handles a motionless frame: writes identity transforms and copies the frame to the moco directory unchanged.
+    Deformable frames only get an identity affine transform and no warp.
+    :param moving_img: Path to the motionless moving image
+    :param registration_type: Type of registration that was skipped
+    :param moco_dir: Directory where the output files will be saved
+    :return:
+    """
+    moving_img_filename = pathlib.Path(moving_img).name
+    transform_files = get_transform_files(moving_img_filename, pathlib.Path(moving_img).parent, registration_type)
+    write_identity_transform(transform_files[-1])
+    fop.copy_file(moving_img, os.path.join(moco_dir, 'moco-' + moving_img_filename))
+    logging.info(f"Motionless frame: {moving_img_filename} copied to moco-{moving_img_filename} | Transform file: "
+                 f"{pathlib.Path(transform_files[-1]).name} (identity)")
 
 
 def align(fixed_img: str, moving_imgs: list, registration_type: str, multi_resolution_iterations: str, njobs: int,
-          moco_dir: str) -> None:
+          moco_dir: str, registration_options: dict = None, executor=None) -> None:
     """
     Aligns the images in the moving_imgs list to a fixed image.
     :param moco_dir: Directory where the output files will be saved
@@ -189,25 +762,457 @@ def align(fixed_img: str, moving_imgs: list, registration_type: str, multi_resol
     :param registration_type: Type of registration to be performed
     :param multi_resolution_iterations: Number of iterations for multi-resolution
     :param njobs: Number of jobs to run in parallel
-    :return:
+    :param registration_options: Optional settings for the registration, see get_registration_options
+    :param executor: Optional caller-provided concurrent.futures.Executor to run the jobs on
+    :return: Queue depth statistics of the prefetching pipeline (see pipeline.align_pipelined), None if not used
     """
     logging.info(f"Aligning images...")
-    with WorkerPool(n_jobs=njobs, shared_objects=(fixed_img, registration_type, multi_resolution_iterations, moco_dir),
-                    start_method='fork', ) as pool:
-        pool.map(align_mp, moving_imgs, progress_bar=False)
+    registration_options = get_registration_options(registration_options)
+    if registration_options['threads_per_job'] is None:
+        registration_options['threads_per_job'] = su.get_threads_per_job(njobs)
+    logging.info(f"Thread budget: {registration_options['threads_per_job'] or 'all CPUs'} threads per registration "
+                 f"job | Pinned workers: {registration_options['pin_cores']}")
+    displacements = {}
+    if registration_options['triage'] and moving_imgs:
+        moving_imgs, motionless_imgs, displacements = triage(fixed_img, moving_imgs, njobs, executor=executor,
+                                                             threads_per_job=registration_options['threads_per_job'])
+        for motionless_img in motionless_imgs:
+            copy_motionless(motionless_img, registration_type, moco_dir)
+    if registration_options['linear_shrink_factor'] > 1:
+        # Downscale the fixed image once, before the workers would all try to create it at the same time
+        get_downscaled_image(fixed_img, registration_options['linear_shrink_factor'])
+    if registration_options['initializer'] != 'image-centers':
+        get_downscaled_image(fixed_img, c.INIT_SHRINK_LEVEL)
+    if registration_type == 'deformable' and registration_options['slabs'] > 1:
+        if moving_imgs:
+            align_slabs(fixed_img, moving_imgs, multi_resolution_iterations, njobs, moco_dir, registration_options,
+                        executor=executor)
+        return None
+    history_file = registration_options['job_history'] or os.path.join(moco_dir, c.JOB_HISTORY_FILE)
+    costs = get_job_costs(moving_imgs, load_job_history(history_file, registration_type), displacements)
+    if registration_options['prefetch'] and moving_imgs:
+        import pipeline  # pipeline builds on this module
+        # The pipeline stages and registers the frames in the order it gets them
+        moving_imgs = [moving_img for _, moving_img in sorted(zip(costs, moving_imgs), key=lambda job: -job[0])]
+        durations = []
+        pipeline_stats = pipeline.align_pipelined(fixed_img, moving_imgs, registration_type,
+                                                  multi_resolution_iterations, njobs, moco_dir, registration_options,
+                                                  executor=executor, durations=durations)
+        save_job_history(history_file, registration_type, moving_imgs, durations)
+        return pipeline_stats
+    durations = []
+    core_sets = su.get_core_sets(njobs, registration_options['threads_per_job']) \
+        if registration_options['pin_cores'] else None
+    # Compacting removes the full resolution warp, which a speculative copy of the frame could rewrite afterwards
+    compacts_warps = registration_type == 'deformable' and (registration_options['warp_shrink_factor'] > 1 or
+                                                            registration_options['warp_16bit'])
+    jobControl.map_jobs(align_mp, moving_imgs, njobs, shared_objects=(
+        fixed_img, registration_type, multi_resolution_iterations, moco_dir, registration_options), executor=executor,
+                        control_root=moco_dir, costs=costs, durations=durations, core_sets=core_sets,
+                        speculate=not compacts_warps)
+    save_job_history(history_file, registration_type, moving_imgs, durations)
+    return None
+
+
+def load_job_history(history_file: str, registration_type: str) -> dict:
+    """
+    Loads the job durations measured in earlier runs
+    :param history_file: JSON file of the job durations, see save_job_history
+    :param registration_type: Type of registration the durations are needed for
+    :return: Dictionary mapping frame names to their last measured duration in seconds
+    """
+    if not os.path.exists(history_file):
+        return {}
+    try:
+        with open(history_file, 'r') as history_in:
+            return json.load(history_in).get(registration_type, {})
+    except (OSError, ValueError) as error:
+        logging.warning(f"Job history {history_file} ignored: {error}")
+        return {}
+
+
+def save_job_history(history_file: str, registration_type: str, moving_imgs: list, durations: list) -> None:
+    """
+    Adds the job durations of this run to the job history (the file is replaced atomically, so that concurrent
+    studies sharing one history never read a partial file)
+    :param history_file: JSON file of the job durations
+    :param registration_type: Type of registration that was performed
+    :param moving_imgs: List of paths to the registered moving images
+    :param durations: Durations of their registration jobs in seconds
+    :return: None
+    """
+    history = {}
+    if os.path.exists(history_file):
+        try:
+            with open(history_file, 'r') as history_in:
+                history = json.load(history_in)
+        except (OSError, ValueError):
+            history = {}
+    frame_durations = history.setdefault(registration_type, {})
+    for moving_img, duration in zip(moving_imgs, durations):
+        frame_durations[pathlib.Path(moving_img).name] = round(duration, 2)
+    temporary_file = f"{history_file}.{os.getpid()}.tmp"
+    with open(temporary_file, 'w') as history_out:
+        json.dump(history, history_out, indent=1, sort_keys=True)
+    os.replace(temporary_file, history_file)
+
+
+def get_job_costs(moving_imgs: list, history: dict, displacements: dict = None) -> list:
+    """
+    Estimates the cost of registering every moving image, to hand out the most expensive frames first. Frames with a
+    measured duration in the job history cost that many seconds. The others are estimated from their file size,
+    relative to the frames with a measured duration (or to the median frame without history), and count up to
+    1 + c.JOB_COST_MOTION_WEIGHT times as expensive the more they moved in the motion triage.
+    :param moving_imgs: List of paths to the moving images
+    :param history: Dictionary mapping frame names to measured durations in seconds, see load_job_history
+    :param displacements: Optional dictionary mapping moving images to their triage displacement in mm
+    :return: List of the estimated costs, in seconds if there is a history
+    """
+    import statistics
+    if not moving_imgs:
+        return []
+    displacements = displacements or {}
+    sizes = {moving_img: os.path.getsize(moving_img) for moving_img in moving_imgs}
+    measured_imgs = [moving_img for moving_img in moving_imgs if pathlib.Path(moving_img).name in history]
+    if measured_imgs:
+        seconds_per_byte = statistics.median(history[pathlib.Path(moving_img).name] / max(sizes[moving_img], 1)
+                                             for moving_img in measured_imgs)
+    else:
+        seconds_per_byte = 1 / max(statistics.median(sizes.values()), 1)
+    max_displacement = max(displacements.values(), default=0)
+
+    costs = []
+    for moving_img in moving_imgs:
+        if pathlib.Path(moving_img).name in history:
+            costs.append(history[pathlib.Path(moving_img).name])
+            continue
+        cost = sizes[moving_img] * seconds_per_byte
+        if max_displacement > 0:
+            cost *= 1 + c.JOB_COST_MOTION_WEIGHT * displacements.get(moving_img, 0) / max_displacement
+        costs.append(cost)
+    longest_imgs = [pathlib.Path(moving_img).name for _, moving_img in sorted(zip(costs, moving_imgs),
+                                                                              key=lambda job: -job[0])]
+    logging.info(f"Job costs: {len(measured_imgs)} of {len(moving_imgs)} frames from the job history | Longest "
+                 f"first: {', '.join(longest_imgs[:5])}{', ...' if len(longest_imgs) > 5 else ''}")
+    return costs
+
+
+def get_registration_options(registration_options: dict = None) -> dict:
+    """
+    Completes user given registration options with their defaults.
+    - compute_inverse: Deformable only, write the inverse warp during the run (default: True)
+    - warp_shrink_factor: Deformable only, store the warp downsampled by this factor (default: 1, full resolution)
+    - warp_16bit: Deformable only, store the warp as 16-bit integers (default: False)
+    - triage: skip the registration of frames without motion, see triage (default: False)
+    - linear_shrink_factor: estimate rigid/affine transforms on images downsampled by this factor (default: 1)
+    - slabs: Deformable only, register this many overlapping axial slabs as independent jobs, see align_slabs
+      (default: 1, the whole field of view at once)
+    - slab_overlap: Deformable only, slices a slab extends into each of its neighbours (default: c.SLAB_OVERLAP)
+    - prefetch: decompress upcoming frames and compress outputs in I/O pools while the registrations run, see
+      pipeline.align_pipelined; the staging folder must be visible to the workers (default: False)
+    - io_jobs: number of prefetch and of writer threads (default: 2)
+    - staging_dir: folder for the uncompressed frames (default: None, tmpfs if available)
+    - job_history: JSON file of the job durations of earlier runs, used to register the longest frames first; studies
+      of the same protocol can share one (default: None, c.JOB_HISTORY_FILE in the moco folder)
+    - threads_per_job: threads of each registration job (greedy -threads and the ITK/OpenMP variables); 0 lets every
+      job use all CPUs (default: None, the available CPUs divided by the number of jobs)
+    - initializer: initial alignment of the linear registrations, 'image-centers', 'phase-correlation' or
+      'phase-correlation-rotation', see get_initialization (default: 'image-centers')
+    - skip_identity_resample: Rigid/affine only, link frames whose transform moves the body by less than
+      c.RESAMPLE_SKIP_THRESHOLD voxels into the moco folder instead of resampling them, see is_near_identity
+      (default: False)
+    - pin_cores: pin every worker to its own NUMA-local core set, see sysUtil.get_core_sets; only for the worker
+      pools FALCON creates itself, a caller-provided pool is pinned with sysUtil.create_worker_pool (default: False)
+    :param registration_options: User given registration options
+    :return: Complete registration options
+    """
+    complete_options = {'compute_inverse': True, 'warp_shrink_factor': 1, 'warp_16bit': False, 'triage': False,
+                        'linear_shrink_factor': 1, 'slabs': 1, 'slab_overlap': c.SLAB_OVERLAP, 'prefetch': False,
+                        'io_jobs': 2, 'staging_dir': None, 'job_history': None, 'threads_per_job': None,
+                        'pin_cores': False, 'initializer': 'image-centers', 'skip_identity_resample': False}
+    if registration_options:
+        complete_options.update(registration_options)
+    if complete_options['pin_cores'] and complete_options['threads_per_job'] == 0:
+        complete_options['threads_per_job'] = None
+    return complete_options
 
 
 def align_mp(align_param: tuple, moving_img: str) -> None:
     """
     Aligns a single image to a fixed image.
-    :param align_param: Tuple containing the fixed image, the registration type, the number of iterations and the
-    output directory
+    :param align_param: Tuple containing the fixed image, the registration type, the number of iterations, the
+    output directory and the registration options
     :param moving_img: Path to the moving image
     :return:
     """
-    reference_img, registration_type, multi_resolution_iterations, moco_dir = align_param
-    registration(fixed_img=reference_img, moving_img=moving_img,
-                 registration_type=registration_type, multi_resolution_iterations=multi_resolution_iterations)
+    reference_img, registration_type, multi_resolution_iterations, moco_dir, registration_options = align_param
+    if registration_options['threads_per_job']:
+        su.set_thread_budget(registration_options['threads_per_job'])
+    with perfTrace.phase('register', frame=pathlib.Path(moving_img).name):
+        registration(fixed_img=reference_img, moving_img=moving_img,
+                     registration_type=registration_type, multi_resolution_iterations=multi_resolution_iterations,
+                     compute_inverse=registration_options['compute_inverse'],
+                     linear_shrink_factor=registration_options['linear_shrink_factor'],
+                     initializer=registration_options['initializer'])
+    finish_frame(reference_img, moving_img, registration_type, moco_dir, registration_options)
+
+
+def finish_frame(reference_img: str, moving_img: str, registration_type: str, moco_dir: str,
+                 registration_options: dict) -> None:
+    """
+    Resamples a registered image into the moco directory and compacts its warp if requested. With
+    skip_identity_resample, a rigid/affine frame whose transform is near identity (see is_near_identity) is linked
+    into the moco directory instead.
+    :param reference_img: Path to the fixed image
+    :param moving_img: Path to the registered moving image
+    :param registration_type: Type of registration that was performed
+    :param moco_dir: Directory where the output files will be saved
+    :param registration_options: Complete registration options, see get_registration_options
+    :return:
+    """
     moving_img_filename = pathlib.Path(moving_img).name
-    resample(fixed_img=reference_img, moving_img=moving_img, resampled_moving_img=os.path.join(
-        moco_dir, 'moco-' + moving_img_filename), registration_type=registration_type)
+    if registration_type != 'deformable' and registration_options['skip_identity_resample']:
+        transform_file = get_transform_files(moving_img_filename, pathlib.Path(moving_img).parent,
+                                             registration_type)[-1]
+        if is_near_identity(reference_img, moving_img, transform_file):
+            fop.copy_file(moving_img, os.path.join(moco_dir, 'moco-' + moving_img_filename))
+            logging.info(f"Near-identity frame: {moving_img_filename} linked to moco-{moving_img_filename} without "
+                         f"resampling | Transform file: {pathlib.Path(transform_file).name}")
+            return
+    with perfTrace.phase('resample', frame=moving_img_filename):
+        resample(fixed_img=reference_img, moving_img=moving_img, resampled_moving_img=os.path.join(
+            moco_dir, 'moco-' + moving_img_filename), registration_type=registration_type)
+    # The warp is compacted only after resampling, so the frame itself is resampled with the full precision warp
+    if registration_type == 'deformable' and (registration_options['warp_shrink_factor'] > 1 or
+                                              registration_options['warp_16bit']):
+        warp_file, _ = get_transform_files(moving_img_filename, pathlib.Path(moving_img).parent, registration_type)
+        compact_warp(warp_file, shrink_factor=registration_options['warp_shrink_factor'],
+                     quantize=registration_options['warp_16bit'])
+
+
+def get_slab_file(slab_dir: str, moving_img: str, slab: int, suffix: str) -> str:
+    """
+    Gets the path of a per-slab file of a moving image
+    :param slab_dir: Directory containing the slab files
+    :param moving_img: Path to the moving image
+    :param slab: Index of the slab
+    :param suffix: Suffix of the file (e.g. '.nii.gz' or '_warp.nii.gz')
+    :return: Path to the slab file
+    """
+    return os.path.join(slab_dir, f"{pathlib.Path(moving_img).name}_slab{slab}{suffix}")
+
+
+def align_slabs(fixed_img: str, moving_imgs: list, multi_resolution_iterations: str, njobs: int, moco_dir: str,
+                registration_options: dict, executor=None) -> None:
+    """
+    Deformable alignment in overlapping axial slabs, for fields of view too large for one deformable job per frame.
+    The affine transform of every frame is estimated on the whole image; the residual deformation is then estimated
+    independently per slab, and the slab warps are blended into one warp on the fixed grid that is stored and applied
+    like a regular deformable warp (warp first, then the affine transform). The slab registrations need a fraction
+    of the memory and threads of a whole-image registration, so more of them run at the same time.
+    :param fixed_img: Path to the fixed image
+    :param moving_imgs: List of paths to the moving images
+    :param multi_resolution_iterations: Number of iterations for multi-resolution
+    :param njobs: Number of whole-frame jobs to run in parallel
+    :param moco_dir: Directory where the output files will be saved
+    :param registration_options: Complete registration options, see get_registration_options
+    :param executor: Optional caller-provided concurrent.futures.Executor to run the jobs on
+    :return:
+    """
+    import math
+    num_slices = iop.get_image_grid(fixed_img).GetSize()[2]
+    num_slabs = registration_options['slabs']
+    overlap = registration_options['slab_overlap']
+    # Only neighbouring slabs may overlap, otherwise the blending weights do not add up to 1
+    if 2 * overlap > num_slices // num_slabs:
+        overlap = num_slices // num_slabs // 2
+        logging.warning(f"Slab overlap reduced to {overlap} slices for {num_slabs} slabs of {num_slices} slices")
+    slab_ranges = iop.get_slab_ranges(num_slices, num_slabs, overlap)
+    slab_dir = fop.make_dir(str(pathlib.Path(moving_imgs[0]).parent), 'slabs')
+    fixed_slabs = iop.extract_slabs(fixed_img, [os.path.join(slab_dir, f"fixed_slab{slab}.nii.gz")
+                                                for slab in range(num_slabs)], slab_ranges)
+    logging.info(f"Slab-wise deformable alignment: {num_slabs} slabs {slab_ranges} | Overlap: {overlap} slices")
+
+    su.map_jobs(prepare_slabs_mp, moving_imgs, njobs, shared_objects=(
+        fixed_img, slab_dir, slab_ranges, overlap, multi_resolution_iterations, registration_options),
+                executor=executor)
+
+    slab_jobs = [(fixed_slabs[slab], get_slab_file(slab_dir, moving_img, slab, '.nii.gz'),
+                  get_slab_file(slab_dir, moving_img, slab, '_warp.nii.gz'))
+                 for moving_img in moving_imgs for slab in range(num_slabs)]
+    slab_fraction = max(stop_slice - first_slice for first_slice, stop_slice in slab_ranges) / num_slices
+    slab_njobs = max(njobs, su.get_number_of_possible_jobs(
+        process_memory=math.ceil(c.MINIMUM_RAM_REQUIRED_DEFORMABLE * slab_fraction),
+        process_threads=math.ceil(c.MINIMUM_THREADS_REQUIRED_DEFORMABLE * slab_fraction)))
+    # More slabs than frames run at a time, so each gets a share of the frame budget (0 keeps all CPUs)
+    slab_threads = registration_options['threads_per_job']
+    if slab_threads:
+        slab_threads = min(slab_threads, su.get_threads_per_job(slab_njobs))
+    logging.info(f"Registering {len(slab_jobs)} slabs with {slab_njobs} jobs at a time | Thread budget: "
+                 f"{slab_threads or 'all CPUs'} threads per slab job")
+    jobControl.map_jobs(register_slab_mp, slab_jobs, slab_njobs, shared_objects=(multi_resolution_iterations,
+                                                                                  slab_threads),
+                        executor=executor, control_root=slab_dir)
+
+    su.map_jobs(blend_slabs_mp, moving_imgs, njobs, shared_objects=(
+        fixed_img, slab_dir, slab_ranges, overlap, moco_dir, registration_options), executor=executor)
+    fop.delete_files(slab_dir, '*')
+    os.rmdir(slab_dir)
+
+
+def prepare_slabs_mp(slab_param: tuple, moving_img: str) -> None:
+    """
+    Estimates the affine transform of a moving image on the whole image and cuts the affinely aligned image into
+    slabs. The moving slabs extend by the overlap beyond the fixed slabs, so that structures moving across a slab
+    border are still found.
+    :param slab_param: Tuple containing the fixed image, the slab directory, the slab ranges, the overlap, the number
+    of iterations and the registration options
+    :param moving_img: Path to the moving image
+    :return:
+    """
+    fixed_img, slab_dir, slab_ranges, overlap, multi_resolution_iterations, registration_options = slab_param
+    if registration_options['threads_per_job']:
+        su.set_thread_budget(registration_options['threads_per_job'])
+    affine_transform_file = affine(fixed_img, moving_img, cost_function='NCC 2x2x2',
+                                   multi_resolution_iterations=multi_resolution_iterations,
+                                   shrink_factor=registration_options['linear_shrink_factor'],
+                                   initializer=registration_options['initializer'])
+    affine_moving_img = os.path.join(slab_dir, f"{pathlib.Path(moving_img).name}_affine.nii.gz")
+    apply_transforms(fixed_img, moving_img, affine_moving_img, [affine_transform_file])
+    num_slices = slab_ranges[-1][1]
+    iop.extract_slabs(affine_moving_img,
+                      [get_slab_file(slab_dir, moving_img, slab, '.nii.gz') for slab in range(len(slab_ranges))],
+                      [(max(0, first_slice - overlap), min(num_slices, stop_slice + overlap))
+                       for first_slice, stop_slice in slab_ranges])
+    os.remove(affine_moving_img)
+
+
+def register_slab_mp(slab_param: tuple, fixed_slab: str, moving_slab: str, slab_warp_file: str) -> str:
+    """
+    Estimates the residual deformation of a single slab of an affinely aligned moving image.
+    :param slab_param: Tuple containing the number of iterations for multi-resolution and the thread budget
+    :param fixed_slab: Path to the slab of the fixed image
+    :param moving_slab: Path to the slab of the affinely aligned moving image
+    :param slab_warp_file: Path to the warp of the slab
+    :return: Path to the warp of the slab
+    """
+    multi_resolution_iterations, threads_per_job = slab_param
+    if threads_per_job:
+        su.set_thread_budget(threads_per_job)
+    cmd_to_run = f"greedy -d 3{get_threads_option()} " \
+                 f"-m NCC 2x2x2 -i {re.escape(fixed_slab)} {re.escape(moving_slab)} -o " \
+                 f"{re.escape(slab_warp_file)} -sv -n {multi_resolution_iterations}"
+    jobControl.run_checked(cmd_to_run, [slab_warp_file], frame=pathlib.Path(moving_slab).name)
+    logging.info(f"Deformable slab alignment: {pathlib.Path(moving_slab).name} -> {pathlib.Path(fixed_slab).name} | "
+                 f"warp file: {pathlib.Path(slab_warp_file).name}")
+    return slab_warp_file
+
+
+def blend_slabs_mp(blend_param: tuple, moving_img: str) -> None:
+    """
+    Blends the slab warps of a moving image into its warp, then resamples the image like align_mp.
+    :param blend_param: Tuple containing the fixed image, the slab directory, the slab ranges, the overlap, the output
+    directory and the registration options
+    :param moving_img: Path to the moving image
+    :return:
+    """
+    fixed_img, slab_dir, slab_ranges, overlap, moco_dir, registration_options = blend_param
+    if registration_options['threads_per_job']:
+        su.set_thread_budget(registration_options['threads_per_job'])
+    moving_img_filename = pathlib.Path(moving_img).name
+    warp_file = os.path.join(pathlib.Path(moving_img).parent, f"{moving_img_filename}_warp.nii.gz")
+    slab_warp_files = [get_slab_file(slab_dir, moving_img, slab, '_warp.nii.gz') for slab in range(len(slab_ranges))]
+    iop.blend_slab_warps(fixed_img, slab_warp_files, slab_ranges, overlap, warp_file)
+    for slab in range(len(slab_ranges)):
+        os.remove(get_slab_file(slab_dir, moving_img, slab, '.nii.gz'))
+        os.remove(slab_warp_files[slab])
+    logging.info(f"Blended {len(slab_ranges)} slab warps of {moving_img_filename} into {pathlib.Path(warp_file).name}")
+    print(f"Deformable slab alignment: {moving_img_filename} -> {pathlib.Path(fixed_img).name} | Aligned image: "
+          f"moco-{moving_img_filename} | warp file: {pathlib.Path(warp_file).name}")
+    if registration_options['compute_inverse']:
+        invert_warp(fixed_img, warp_file)
+    finish_frame(fixed_img, moving_img, 'deformable', moco_dir, registration_options)
+
+
+def apply_transforms_mp(threads_per_job: int, fixed_img: str, moving_img: str, resampled_moving_img: str,
+                        transform_files: list, interpolation: str) -> str:
+    """
+    Runs apply_transforms as a job with a thread budget
+    :param threads_per_job: Thread budget of the job, see sysUtil.set_thread_budget
+    :param fixed_img: Reference image that defines the output grid
+    :param moving_img: Image (or label map) to transform
+    :param resampled_moving_img: Transformed output image
+    :param transform_files: Transform files in the order greedy expects them after '-r'
+    :param interpolation: Greedy interpolation mode: 'LINEAR', 'NN' or 'LABEL' (label maps)
+    :return: Path of the transformed image
+    """
+    su.set_thread_budget(threads_per_job)
+    return apply_transforms(fixed_img, moving_img, resampled_moving_img, transform_files, interpolation)
+
+
+def get_inverse_transform_files(transform_files: list) -> list:
+    """
+    Gets the chain that maps an image in reference space into the space of a frame: the stored transforms of the frame
+    in reversed order, each inverted (linear transforms as 'file,-1', warps replaced by their inverse warps)
+    :param transform_files: Transform files of the frame in the order greedy expects them after '-r'
+    :return: Inverse transform chain in the order greedy expects it after '-r'
+    """
+    inverse_transform_files = []
+    for transform_file in reversed(transform_files):
+        if transform_file.endswith('.mat'):
+            inverse_transform_files.append(f"{transform_file},-1")
+            continue
+        inverse_warp_file = re.sub(r'_warp(_compact)?\.nii\.gz$', '_inverse_warp.nii.gz', transform_file)
+        if not os.path.exists(inverse_warp_file):
+            raise FileNotFoundError(f"Inverse warp {inverse_warp_file} not found, compute it with invert_warp "
+                                    f"(falcon-apply --invert_warps)")
+        inverse_transform_files.append(inverse_warp_file)
+    return inverse_transform_files
+
+
+def apply_all(fixed_img: str, frame_transforms: dict, frames: list, images: list, out_dir: str, interpolation: str,
+              njobs: int, executor=None) -> list:
+    """
+    Applies stored per-frame transforms to a list of images in parallel. Frames without transforms (the reference frame
+    and the frames before the start frame) are treated as identity.
+    :param fixed_img: Reference image, the output grid of images mapped onto the reference
+    :param frame_transforms: Dictionary mapping each frame file name to its transform files, see get_frame_transforms
+    :param frames: Paths to all 3d frames of the study; they define the order of the frames and the grid of each frame
+    :param images: Either a single image in reference space (e.g. an atlas or a CT aligned to the reference frame) that
+    is mapped into the space of every frame with the inverse transforms, on the grid of the frame; or one image per
+    frame, in the (natural) order of the frames, that is mapped onto the reference with the transforms of its frame
+    :param out_dir: Directory where the transformed images will be saved
+    :param interpolation: Greedy interpolation mode: 'LINEAR', 'NN' or 'LABEL' (label maps)
+    :param njobs: Number of jobs to run in parallel
+    :param executor: Optional caller-provided concurrent.futures.Executor to run the jobs on
+    :return: List of paths to the transformed images
+    """
+    frames = natsort.natsorted(frames)
+    if len(images) != 1 and len(images) != len(frames):
+        raise ValueError(f"Number of images ({len(images)}) does not match the number of frames ({len(frames)})")
+    temporary_files = []
+    file_descriptor, identity_file = tempfile.mkstemp(suffix='_identity.mat', dir=out_dir)
+    os.close(file_descriptor)
+    write_identity_transform(identity_file)
+    try:
+        jobs = []
+        if len(images) == 1:
+            image_name = pathlib.Path(images[0]).name
+            for frame in frames:
+                frame_name = pathlib.Path(frame).name
+                transform_files = get_inverse_transform_files(frame_transforms.get(frame_name, [identity_file]))
+                jobs.append((frame, images[0], os.path.join(out_dir, f"{frame_name.split('.')[0]}-{image_name}"),
+                             transform_files, interpolation))
+        else:
+            for frame, image in zip(frames, images):
+                jobs.append((fixed_img, image, os.path.join(out_dir, f"moco-{pathlib.Path(image).name}"),
+                             frame_transforms.get(pathlib.Path(frame).name, [identity_file]), interpolation))
+        jobs, temporary_files = expand_job_warps(jobs, njobs, executor)
+        logging.info(f"Applying transforms of {len(frame_transforms)} of {len(frames)} frames (identity for the others)"
+                     f" to {len(images)} image(s)...")
+        return su.map_jobs(apply_transforms_mp, jobs, njobs, shared_objects=su.get_threads_per_job(njobs),
+                           executor=executor)
+    finally:
+        os.remove(identity_file)
+        for temporary_file in temporary_files:
+            os.remove(temporary_file)
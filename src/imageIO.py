@@ -20,17 +20,15 @@ import logging
 import os
 import pathlib
 import re
-import subprocess
 import sys
 
-import SimpleITK as sitk
-import nibabel as nib
-import numpy as np
-import pydicom as dicom
 from halo import Halo
-from tqdm import tqdm
 
 import fileOp as fop
+import perfTrace
+
+# SimpleITK, nibabel, numpy, pydicom and tqdm are imported inside the functions that need them, so that the CLI entry
+# points do not pay for importing them on every start
 
 
 def check_unique_extensions(directory: str) -> list:
@@ -88,7 +86,7 @@ def nondcm2nii(medimg_dir: str, file_extension: str, new_dir: str) -> None:
         logging.info(f"Converting {file} to {nifti_file}")
         spinner = Halo(text=f"Running command: {cmd_to_run}", spinner='dots')
         spinner.start()
-        os.system(cmd_to_run)
+        perfTrace.run_tool(cmd_to_run, frame=pathlib.Path(file).name)
         spinner.succeed()
         logging.info("Done")
 
@@ -101,7 +99,7 @@ def dcm2nii(dicom_dir: str) -> None:
     logging.info(f"Converting DICOM images in {dicom_dir} to NIFTI")
     spinner = Halo(text=f"Converting DICOM images in {dicom_dir} to NIFTI", spinner='dots')
     spinner.start()
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    perfTrace.run_tool(cmd_to_run)
     spinner.succeed()
     logging.info("Done")
 
@@ -111,6 +109,7 @@ def split4d(nifti_file: str, out_dir: str) -> None:
     :param nifti_file: 4D NIFTI file to split
     :param out_dir: Directory to save the split NIFTI files
     """
+    import nibabel as nib
     logging.info(f"Splitting {nifti_file} into 3D nifti files")
     spinner = Halo(text=f"Splitting {nifti_file} into 3D nifti files", spinner='dots')
     spinner.start()
@@ -128,12 +127,13 @@ def merge3d(nifti_dir: str, wild_card: str, nifti_outfile: str) -> None:
     Merge 3D NIFTI files into a 4D NIFTI file using nibabel
     :param nifti_dir: Directory containing the 3D NIFTI files
     :param wild_card: Wildcard to use to find the 3D NIFTI files
-    :param nifti_outfile: User-defined output file name for the 4D NIFTI file
+    :param nifti_outfile: User-defined output file name for the 4D NIFTI file (relative paths are relative to
+    nifti_dir)
     """
+    import nibabel as nib
     logging.info(f"Merging 3D nifti files in {nifti_dir} with wildcard {wild_card}")
     files_to_merge = fop.get_files(nifti_dir, wild_card)
-    nib.save(nib.funcs.concat_images(files_to_merge, False), nifti_outfile)
-    os.chdir(nifti_dir)
+    nib.save(nib.funcs.concat_images(files_to_merge, False), os.path.join(nifti_dir, nifti_outfile))
     logging.info("Done")
 
 
@@ -191,7 +191,7 @@ def nii2nondcm(nifti_file=str, new_img_type=str, new_dir=str) -> None:
     new_img_file = os.path.join(new_dir, file_stem + new_img_type)
     cmd_to_run = f"c3d {nifti_file} -o {new_img_file}"
     logging.info(f"Running command: {cmd_to_run}")
-    os.system(cmd_to_run)
+    perfTrace.run_tool(cmd_to_run, frame=pathlib.Path(nifti_file).name)
     logging.info("Done")
 
 
@@ -205,7 +205,7 @@ def nii2dcm(nifti_file=str) -> None:
     cmd_to_run = f"nii2dcm {nifti_file}"
     logging.info(f"Running command: {cmd_to_run}")
     print("Dicom conversion may take a while. Please wait...")
-    os.system(cmd_to_run)
+    perfTrace.run_tool(cmd_to_run, frame=pathlib.Path(nifti_file).name)
     print("Done, Dicom files (dir name = dcm_files) are saved in the same directory as the NIFTI file")
     logging.info("Done, Dicom files (dir name = dcm_files) are saved in the same directory as the NIFTI file")
 
@@ -236,6 +236,10 @@ def push_nii_pixel_data_to_dcm(nifti_file: str, dicom_dir: str, out_dir: str) ->
     :param out_dir: Path to the output directory
     :return out_dir: Path to the output directory
     """
+    import SimpleITK as sitk
+    import numpy as np
+    import pydicom as dicom
+    from tqdm import tqdm
     print("Reading nifti file as int16...")
     nii_img = sitk.ReadImage(nifti_file, sitk.sitkInt16)
     print("Flipping the nifti image to match the dicom orientation...")
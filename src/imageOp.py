@@ -17,14 +17,26 @@
 
 
 # Imports
-import subprocess
-import SimpleITK
-import nibabel
-import pandas as pd
-from nilearn.input_data import NiftiMasker
+import logging
+import os
+import tempfile
 
+import constants as c
+import perfTrace
 
-def sum_images_from_list(image_stack: list, summed_image_path: str = None) -> SimpleITK.Image:
+# SimpleITK, nibabel, numpy, pandas, nilearn and mpire are imported inside the functions that need them, so that the CLI
+# entry points do not pay for importing them on every start
+
+# c3d interpolation names mapped to their SimpleITK counterparts, so that callers of reslice_identity and
+# reslice_images can use the same vocabulary
+SITK_INTERPOLATORS = {
+    'NearestNeighbor': 'sitkNearestNeighbor',
+    'Linear': 'sitkLinear',
+    'Cubic': 'sitkBSpline'
+}
+
+
+def sum_images_from_list(image_stack: list, summed_image_path: str = None) -> 'SimpleITK.Image':
     """
     Sums all images from a list of image paths
     :param image_stack: List of paths to images that should be summed
@@ -32,6 +44,7 @@ def sum_images_from_list(image_stack: list, summed_image_path: str = None) -> Si
     :return: The summed image as SimpleITK.Image
     :rtype: SimpleITK.Image
     """
+    import SimpleITK
     # Start with the first image
     summed_image = SimpleITK.ReadImage(image_stack[0], SimpleITK.sitkFloat64)
 
@@ -46,7 +59,7 @@ def sum_images_from_list(image_stack: list, summed_image_path: str = None) -> Si
     return summed_image
 
 
-def create_mean_image_from_list(image_stack: list, mean_image_path: str = None) -> SimpleITK.Image:
+def create_mean_image_from_list(image_stack: list, mean_image_path: str = None) -> 'SimpleITK.Image':
     """
     Averages all images from a list of image paths
     :param image_stack: List of paths to images that should be averaged
@@ -54,6 +67,7 @@ def create_mean_image_from_list(image_stack: list, mean_image_path: str = None)
     :return: The averaged image as SimpleITK.Image
     :rtype: SimpleITK.Image
     """
+    import SimpleITK
     mean_image = sum_images_from_list(image_stack) / len(image_stack)
 
     if mean_image_path is not None:
@@ -67,6 +81,7 @@ def get_dimensions(nifti_file: str) -> int:
     Get the dimensions of a NIFTI image file
     :param nifti_file: NIFTI file to check
     """
+    import SimpleITK
     nifti_img = SimpleITK.ReadImage(nifti_file)
     img_dim = nifti_img.GetDimension()
     return img_dim
@@ -77,6 +92,7 @@ def get_pixel_id_type(nifti_file: str) -> str:
     Get the pixel id type of a NIFTI image file
     :param nifti_file: NIFTI file to check
     """
+    import SimpleITK
     nifti_img = SimpleITK.ReadImage(nifti_file)
     pixel_id_type = nifti_img.GetPixelIDTypeAsString()
     return pixel_id_type
@@ -89,6 +105,8 @@ def get_intensity_statistics(nifti_file: str, multi_label_file: str) -> object:
     :param multi_label_file: Multilabel file that is used to calculate the intensity statistics from nifti_file
     :return: stats_df, a dataframe with the intensity statistics
     """
+    import SimpleITK
+    import pandas as pd
     nifti_img = SimpleITK.ReadImage(nifti_file)
     multi_label_img = SimpleITK.ReadImage(multi_label_file)
     intensity_statistics = SimpleITK.LabelIntensityStatisticsImageFilter()
@@ -108,6 +126,8 @@ def get_body_mask(nifti_file: str, mask_file: str) -> str:
     :param mask_file: Name of the mask file that is derived from the 4d nifti file.
     :return: path of the mask file
     """
+    import nibabel
+    from nilearn.input_data import NiftiMasker
     nifti_masker = NiftiMasker(mask_strategy='epi', memory="nilearn_cache", memory_level=2, smoothing_fwhm=8)
     nifti_masker.fit(nifti_file)
     nibabel.save(nifti_masker.mask_img_, mask_file)
@@ -122,6 +142,7 @@ def mask_img(nifti_file: str, mask_file: str, masked_file: str) -> str:
     :param masked_file: Name of the masked file
     :return: path of the masked nifti file
     """
+    import SimpleITK
     img = SimpleITK.ReadImage(nifti_file)
     mask = SimpleITK.ReadImage(mask_file, SimpleITK.sitkFloat32)
     masked_img = SimpleITK.Compose(
@@ -141,4 +162,329 @@ def reslice_identity(reference_image: str, image_to_reslice: str, out_resliced_i
     """
     cmd_to_run = f"c3d {reference_image} {image_to_reslice} -interpolation {interpolation} -reslice-identity -o" \
                  f" {out_resliced_image}"
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    perfTrace.run_tool(cmd_to_run, frame=os.path.basename(image_to_reslice))
+
+
+def get_reslice_interpolator(interpolation: str = None) -> int:
+    """
+    Get the SimpleITK interpolator for reslicing an image
+    :param interpolation: Interpolation method to use (NearestNeighbor, Linear, Cubic). If None, linear interpolation is
+    used, also for integer images such as CT; label maps have to ask for NearestNeighbor explicitly
+    :return: SimpleITK interpolator
+    """
+    import SimpleITK
+    if interpolation is None:
+        return SimpleITK.sitkLinear
+    if interpolation not in SITK_INTERPOLATORS:
+        raise ValueError(f"Interpolation {interpolation} not supported! Choose from {list(SITK_INTERPOLATORS)}")
+    return getattr(SimpleITK, SITK_INTERPOLATORS[interpolation])
+
+
+def get_image_grid(nifti_file: str) -> 'SimpleITK.Image':
+    """
+    Get the grid (size, origin, spacing and direction) of an image without reading its voxel data
+    :param nifti_file: Image file whose grid is needed
+    :return: An empty image with the grid of nifti_file, usable as a reference for resampling
+    """
+    import SimpleITK
+    reader = SimpleITK.ImageFileReader()
+    reader.SetFileName(nifti_file)
+    reader.ReadImageInformation()
+    image_grid = SimpleITK.Image(reader.GetSize(), SimpleITK.sitkUInt8)
+    image_grid.SetOrigin(reader.GetOrigin())
+    image_grid.SetSpacing(reader.GetSpacing())
+    image_grid.SetDirection(reader.GetDirection())
+    return image_grid
+
+
+def reslice_images(reference_image: str, images_to_reslice: list, out_resliced_images: list,
+                   interpolations: list = None, njobs: int = 1) -> list:
+    """
+    Reslice a list of images to the same space as a reference image in-process, without spawning a c3d process per
+    image. The reference grid is read once and shared with all workers.
+    :param reference_image: Path to the reference image to reslice to
+    :param images_to_reslice: List of paths to the images to reslice
+    :param out_resliced_images: List of paths to the resliced images
+    :param interpolations: List of interpolation methods per image (NearestNeighbor, Linear, Cubic or None). If not
+    provided, all images are resliced linearly; pass NearestNeighbor for label maps
+    :param njobs: Number of images to reslice in parallel
+    :return: List of paths to the resliced images
+    """
+    if len(images_to_reslice) != len(out_resliced_images):
+        raise ValueError("Number of images to reslice and number of output images do not match")
+    if interpolations is None:
+        interpolations = [None] * len(images_to_reslice)
+    if len(interpolations) != len(images_to_reslice):
+        raise ValueError("Number of interpolations and number of images to reslice do not match")
+
+    from mpire import WorkerPool
+    reference_grid = get_image_grid(reference_image)
+    logging.info(f"Reslicing {len(images_to_reslice)} images to {reference_image} with {njobs} jobs")
+    with WorkerPool(n_jobs=njobs, shared_objects=reference_grid, start_method='fork') as pool:
+        resliced_images = pool.map(reslice_mp, list(zip(images_to_reslice, out_resliced_images, interpolations)),
+                                   progress_bar=False)
+    return resliced_images
+
+
+def reslice_mp(reference_grid: 'SimpleITK.Image', image_to_reslice: str, out_resliced_image: str,
+               interpolation: str) -> str:
+    """
+    Reslice a single image to the grid of a reference image
+    :param reference_grid: Image that defines the output grid
+    :param image_to_reslice: Path to the image to reslice
+    :param out_resliced_image: Path to the resliced image
+    :param interpolation: Interpolation method to use (NearestNeighbor, Linear, Cubic or None for Linear)
+    :return: Path to the resliced image
+    """
+    import SimpleITK
+    image = SimpleITK.ReadImage(image_to_reslice)
+    interpolator = get_reslice_interpolator(interpolation)
+    resliced_image = SimpleITK.Resample(image, reference_grid, SimpleITK.Transform(), interpolator, 0.0,
+                                        image.GetPixelID())
+    SimpleITK.WriteImage(resliced_image, out_resliced_image)
+    return out_resliced_image
+
+
+def compact_warp(warp_file: str, compact_warp_file: str, shrink_factor: int, quantize: bool) -> str:
+    """
+    Stores a displacement field compactly: smoothed and downsampled by the shrink factor and/or quantized to 16 bit.
+    Quantization stores the displacements as int16 with the NIfTI scl_slope/scl_inter scaling, because NIfTI has no
+    half-precision datatype. The quantization step is (max - min displacement) / 65535, i.e. about 0.0015 mm for a
+    field spanning +/- 50 mm, well below the voxel size of any PET image. Downsampling is lossy and the error depends on
+    how smooth the warp is: on synthetic fields (2 mm voxels) of Gaussian deformations of up to 5 mm with widths of 8,
+    5 and 3 voxels, compacting at 2x and expanding again gave an RMS error of 0.026, 0.031 and 0.043 mm with local
+    maxima of 0.22, 0.56 and 1.28 mm; at 4x 0.085, 0.094 and 0.108 mm RMS with maxima of 0.8, 1.7 and 3.0 mm.
+    :param warp_file: Path to the full resolution displacement field
+    :param compact_warp_file: Path to the compact displacement field
+    :param shrink_factor: Factor by which the displacement field is downsampled (1 keeps the resolution)
+    :param quantize: If True, the displacement field is stored as 16-bit integers
+    :return: Path to the compact displacement field
+    """
+    import SimpleITK
+    import nibabel
+    import numpy as np
+    warp = SimpleITK.ReadImage(warp_file, SimpleITK.sitkVectorFloat32)
+    if shrink_factor > 1:
+        spacing = warp.GetSpacing()
+        smoothed_warp = SimpleITK.SmoothingRecursiveGaussian(warp, [space * shrink_factor / 2 for space in spacing])
+        compact_grid = SimpleITK.Image([int(np.ceil(size / shrink_factor)) for size in warp.GetSize()],
+                                       SimpleITK.sitkUInt8)
+        compact_grid.SetSpacing([space * shrink_factor for space in spacing])
+        compact_grid.SetDirection(warp.GetDirection())
+        # Shift the origin so that the compact voxels are centred on the blocks of voxels they replace
+        compact_grid.SetOrigin(warp.TransformContinuousIndexToPhysicalPoint([(shrink_factor - 1) / 2] * 3))
+        warp = SimpleITK.Resample(smoothed_warp, compact_grid, SimpleITK.Transform(), SimpleITK.sitkLinear, 0.0,
+                                  SimpleITK.sitkVectorFloat32)
+    SimpleITK.WriteImage(warp, compact_warp_file)
+    if quantize:
+        compact_nifti = nibabel.load(compact_warp_file)
+        quantized_nifti = nibabel.Nifti1Image(compact_nifti.get_fdata(dtype=np.float32), compact_nifti.affine,
+                                              compact_nifti.header)
+        quantized_nifti.set_data_dtype(np.int16)
+        nibabel.save(quantized_nifti, compact_warp_file)
+    return compact_warp_file
+
+
+def expand_warp(compact_warp_file: str, reference_image: str, out_warp_file: str) -> str:
+    """
+    Restores a compact displacement field (see compact_warp) to the float32 grid of the reference image
+    :param compact_warp_file: Path to the compact displacement field
+    :param reference_image: Path to the image that defines the full resolution grid (the fixed image)
+    :param out_warp_file: Path to the full resolution displacement field
+    :return: Path to the full resolution displacement field
+    """
+    import SimpleITK
+    import nibabel
+    import numpy as np
+    compact_nifti = nibabel.load(compact_warp_file)
+    float_warp_file = compact_warp_file
+    if compact_nifti.get_data_dtype() != np.float32:
+        # ITK does not reliably apply the NIfTI scaling to vector images, so the scaling is resolved with nibabel
+        file_descriptor, float_warp_file = tempfile.mkstemp(suffix='.nii.gz', dir=os.path.dirname(out_warp_file))
+        os.close(file_descriptor)
+        float_nifti = nibabel.Nifti1Image(compact_nifti.get_fdata(dtype=np.float32), compact_nifti.affine,
+                                          compact_nifti.header)
+        float_nifti.set_data_dtype(np.float32)
+        nibabel.save(float_nifti, float_warp_file)
+    warp = SimpleITK.ReadImage(float_warp_file, SimpleITK.sitkVectorFloat32)
+    if float_warp_file != compact_warp_file:
+        os.remove(float_warp_file)
+
+    full_warp = SimpleITK.Resample(warp, get_image_grid(reference_image), SimpleITK.Transform(),
+                                   SimpleITK.sitkLinear, 0.0, SimpleITK.sitkVectorFloat32)
+    SimpleITK.WriteImage(full_warp, out_warp_file)
+    return out_warp_file
+
+
+def get_slab_ranges(num_slices: int, num_slabs: int, overlap: int) -> list:
+    """
+    Splits the axial field of view into overlapping slabs
+    :param num_slices: Number of axial slices of the image
+    :param num_slabs: Number of slabs
+    :param overlap: Number of slices a slab extends into each of its neighbours
+    :return: List of (first slice, last slice + 1) tuples, one per slab
+    """
+    boundaries = [round(slab * num_slices / num_slabs) for slab in range(num_slabs + 1)]
+    return [(max(0, boundaries[slab] - overlap), min(num_slices, boundaries[slab + 1] + overlap))
+            for slab in range(num_slabs)]
+
+
+def extract_slabs(nifti_file: str, slab_files: list, slab_ranges: list) -> list:
+    """
+    Extracts axial slabs of an image, reading the image only once; the slabs keep their position in physical space
+    :param nifti_file: Path to the image
+    :param slab_files: Paths to the slab images
+    :param slab_ranges: List of (first slice, last slice + 1) tuples, one per slab
+    :return: Paths to the slab images
+    """
+    import SimpleITK
+    image = SimpleITK.ReadImage(nifti_file)
+    size = list(image.GetSize())
+    for slab_file, (first_slice, stop_slice) in zip(slab_files, slab_ranges):
+        slab = SimpleITK.RegionOfInterest(image, size[:2] + [stop_slice - first_slice], [0, 0, first_slice])
+        SimpleITK.WriteImage(slab, slab_file)
+    return slab_files
+
+
+def get_slab_weights(first_slice: int, stop_slice: int, num_slices: int, overlap: int) -> 'np.ndarray':
+    """
+    Gets the blending weights of a slab: 1 in its core and linear ramps over the slices it shares with its neighbours,
+    such that the weights of two neighbouring slabs add up to 1 in their overlap
+    :param first_slice: First axial slice of the slab
+    :param stop_slice: Last axial slice of the slab + 1
+    :param num_slices: Number of axial slices of the whole image
+    :param overlap: Number of slices a slab extends into each of its neighbours
+    :return: Weight per slice of the slab
+    """
+    import numpy as np
+    slices = np.arange(first_slice, stop_slice)
+    weights = np.ones(len(slices), dtype=np.float32)
+    if first_slice > 0:
+        weights = np.minimum(weights, (slices - first_slice + 1) / (2 * overlap + 1))
+    if stop_slice < num_slices:
+        weights = np.minimum(weights, (stop_slice - slices) / (2 * overlap + 1))
+    return weights
+
+
+def blend_slab_warps(reference_image: str, slab_warp_files: list, slab_ranges: list, overlap: int,
+                     blended_warp_file: str) -> str:
+    """
+    Blends the displacement fields of overlapping axial slabs (see get_slab_ranges) into one smooth displacement field
+    on the grid of the reference image
+    :param reference_image: Path to the image that defines the grid of the blended field (the fixed image)
+    :param slab_warp_files: Paths to the displacement fields of the slabs
+    :param slab_ranges: Slice ranges of the slabs
+    :param overlap: Number of slices a slab extends into each of its neighbours
+    :param blended_warp_file: Path to the blended displacement field
+    :return: Path to the blended displacement field
+    """
+    import SimpleITK
+    import numpy as np
+    reference_grid = get_image_grid(reference_image)
+    num_slices = reference_grid.GetSize()[2]
+    blended_warp = None
+    slice_weights = np.zeros(num_slices, dtype=np.float32)
+    for slab_warp_file, (first_slice, stop_slice) in zip(slab_warp_files, slab_ranges):
+        slab_warp = SimpleITK.GetArrayFromImage(SimpleITK.ReadImage(slab_warp_file, SimpleITK.sitkVectorFloat32))
+        if blended_warp is None:
+            blended_warp = np.zeros((num_slices,) + slab_warp.shape[1:], dtype=np.float32)
+        weights = get_slab_weights(first_slice, stop_slice, num_slices, overlap)
+        blended_warp[first_slice:stop_slice] += slab_warp * weights[:, None, None, None]
+        slice_weights[first_slice:stop_slice] += weights
+    blended_warp /= slice_weights[:, None, None, None]
+    warp = SimpleITK.GetImageFromArray(blended_warp, isVector=True)
+    warp.SetOrigin(reference_grid.GetOrigin())
+    warp.SetSpacing(reference_grid.GetSpacing())
+    warp.SetDirection(reference_grid.GetDirection())
+    SimpleITK.WriteImage(warp, blended_warp_file)
+    return blended_warp_file
+
+
+def get_phase_correlation(fixed_array: 'np.ndarray', moving_array: 'np.ndarray') -> tuple:
+    """
+    Estimates the translation between two arrays of the same shape by phase correlation: the normalized (with a floor,
+    see c.INIT_WHITENING_FLOOR) and low-pass filtered cross-power spectrum of the arrays transforms back into a peak at
+    their shift, which is refined to sub-voxel precision with a parabola through the peak and its neighbours along
+    every axis
+    :param fixed_array: Fixed array
+    :param moving_array: Moving array, expected to be the fixed array shifted by the estimated shift, i.e.
+    moving[x + shift] = fixed[x]
+    :return: Tuple of the shift in voxels (in array axis order) and the height of the correlation peak (higher the
+    better the arrays agree)
+    """
+    import numpy as np
+    shape = np.array(fixed_array.shape)
+    # No apodization window: the background of PET frames is close to zero at the border of the field of view anyway,
+    # and a window fixed to the grid pulls the estimate of smooth, centered activity towards zero shift
+    fixed_spectrum = np.fft.rfftn(fixed_array - fixed_array.mean())
+    moving_spectrum = np.fft.rfftn(moving_array - moving_array.mean())
+    # conj(F) M peaks at +shift for moving(x + shift) = fixed(x)
+    cross_power = np.conj(fixed_spectrum) * moving_spectrum
+    # Whitening with a floor keeps the weak (noisy) frequencies from being amplified to full weight, and the Gaussian
+    # low-pass suppresses the noise that dominates the high frequencies of PET frames
+    magnitude = np.abs(cross_power)
+    cross_power /= np.maximum(magnitude, c.INIT_WHITENING_FLOOR * magnitude.max() + np.finfo(np.float64).tiny)
+    frequencies = np.meshgrid(*[np.fft.fftfreq(length) for length in shape[:-1]], np.fft.rfftfreq(shape[-1]),
+                              indexing='ij')
+    cross_power *= np.exp(-sum(frequency ** 2 for frequency in frequencies) / (2 * c.INIT_LOWPASS_SIGMA ** 2))
+    correlation = np.fft.irfftn(cross_power, s=fixed_array.shape, axes=range(len(shape)))
+
+    peak = np.array(np.unravel_index(np.argmax(correlation), correlation.shape))
+    shift = peak.astype(float)
+    for axis in range(len(shape)):
+        neighbours = [correlation[tuple(np.where(np.arange(len(shape)) == axis, (peak + offset) % shape, peak))]
+                      for offset in (-1, 0, 1)]
+        curvature = neighbours[0] - 2 * neighbours[1] + neighbours[2]
+        if curvature < 0:
+            shift[axis] += 0.5 * (neighbours[0] - neighbours[2]) / curvature
+    shift = np.where(shift > shape / 2, shift - shape, shift)
+    return shift, float(correlation[tuple(peak)])
+
+
+def estimate_initial_transform(fixed_img: str, moving_img: str, rotation_angles: list = None) -> 'np.ndarray':
+    """
+    Estimates a rigid initial transform from the moving to the fixed image by phase correlation, for downsampled
+    images. The moving image is resampled onto the grid of the fixed image first; with rotation angles, the moving
+    image is additionally rotated about each axis through the center of the fixed image by each angle, and the rotation
+    with the highest correlation peak wins.
+    :param fixed_img: Path to the (downsampled) fixed image
+    :param moving_img: Path to the (downsampled) moving image
+    :param rotation_angles: Optional rotation angles in degrees to try about each axis (0 is always tried)
+    :return: 4x4 transform matrix in greedy's convention (RAS, mapping fixed to moving physical points), None if the
+    translation exceeds c.INIT_MAX_TRANSLATION (implausible, e.g. on noisy early frames)
+    """
+    import numpy as np
+    import SimpleITK
+    fixed = SimpleITK.ReadImage(fixed_img, SimpleITK.sitkFloat64)
+    moving = SimpleITK.Resample(SimpleITK.ReadImage(moving_img, SimpleITK.sitkFloat64), fixed, SimpleITK.Transform(),
+                                SimpleITK.sitkLinear, 0.0)
+    fixed_array = SimpleITK.GetArrayFromImage(fixed)
+    direction = np.array(fixed.GetDirection()).reshape(3, 3)
+    center = np.array(fixed.TransformContinuousIndexToPhysicalPoint([(size - 1) / 2 for size in fixed.GetSize()]))
+
+    best = None
+    rotations = [(0, 0.0)] + [(axis, angle) for axis in range(3) for angle in (rotation_angles or []) if angle != 0]
+    for axis, angle in rotations:
+        rotation = SimpleITK.Euler3DTransform()
+        rotation.SetCenter(center.tolist())
+        rotation.SetRotation(*[np.deg2rad(angle) if index == axis else 0.0 for index in range(3)])
+        rotated_moving = SimpleITK.Resample(moving, fixed, rotation, SimpleITK.sitkLinear, 0.0) if angle else moving
+        shift, peak = get_phase_correlation(fixed_array, SimpleITK.GetArrayFromImage(rotated_moving))
+        if best is None or peak > best[2]:
+            best = (np.array(rotation.GetMatrix()).reshape(3, 3), shift, peak, axis, angle)
+    rotation_matrix, shift, peak, axis, angle = best
+
+    # The moving image rotated by R about the center c matches the fixed image shifted by d, so the fixed point x
+    # corresponds to the moving point R (x + d - c) + c
+    translation = direction @ (shift[::-1] * np.array(fixed.GetSpacing()))
+    transform_lps = np.eye(4)
+    transform_lps[:3, :3] = rotation_matrix
+    transform_lps[:3, 3] = rotation_matrix @ (translation - center) + center
+    lps_to_ras = np.diag([-1.0, -1.0, 1.0, 1.0])
+    logging.info(f"Phase correlation: {os.path.basename(moving_img)} -> {os.path.basename(fixed_img)} | Translation: "
+                 f"{np.round(translation, 2).tolist()} mm | Rotation: {angle} deg about axis {axis} | Peak: {peak:.3f}")
+    if np.linalg.norm(translation) > c.INIT_MAX_TRANSLATION:
+        logging.warning(f"Phase correlation: translation of {os.path.basename(moving_img)} exceeds "
+                        f"{c.INIT_MAX_TRANSLATION} mm and is rejected")
+        return None
+    return lps_to_ras @ transform_lps @ lps_to_ras
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: jobControl.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: Failure detection, retries, timeouts and speculative re-issue of the registration jobs. In the
+# workers, run_checked runs an external tool, checks its exit code and outputs, writes the outputs atomically and
+# retries; in the driver, map_jobs hands out the jobs one at a time, derives timeouts from the running median of the
+# job durations, re-issues stragglers on idle workers and retries failed jobs a bounded number of times. The driver
+# stops a job attempt through a cancel file in a control folder the workers can see.
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+# Imported Libraries
+
+import logging
+import multiprocessing
+import os
+import pathlib
+import re
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import constants as c
+import perfTrace
+import sysUtil as su
+
+# Control of the job attempt the current worker thread is running (its cancel file), set by run_job
+job_context = threading.local()
+
+
+class JobError(Exception):
+    """
+    Raised when an external tool or a job fails for good (after its retries)
+    """
+
+
+class JobCancelled(JobError):
+    """
+    Raised in a worker when the driver cancelled the job attempt (timed out or superseded by a faster copy)
+    """
+
+
+# Worker side
+
+
+def run_job(function, cancel_file: str, job_args: tuple):
+    """
+    Runs one attempt of a job in a worker, with its cancel file set for run_checked
+    :param function: Function of the job
+    :param cancel_file: File the driver creates to stop this attempt
+    :param job_args: Arguments of the function
+    :return: Tuple of the wall time of the attempt in seconds and the result of the function
+    """
+    job_context.cancel_file = cancel_file
+    start = time.perf_counter()
+    try:
+        result = function(*job_args)
+        return time.perf_counter() - start, result
+    finally:
+        job_context.cancel_file = None
+
+
+def get_stop_reason() -> str:
+    """
+    Checks whether the driver stopped the job attempt the current worker thread is running
+    :return: Reason to stop, None to go on (also outside of controlled jobs)
+    """
+    cancel_file = getattr(job_context, 'cancel_file', None)
+    if cancel_file is None:
+        return None
+    if not os.path.isdir(os.path.dirname(cancel_file)):
+        return 'job finished'
+    if os.path.exists(cancel_file):
+        with open(cancel_file, 'r') as cancel_in:
+            return cancel_in.read() or 'cancelled'
+    return None
+
+
+def get_temporary_output(output: str) -> str:
+    """
+    Gets the temporary name an output is written to before it is moved into place (the extension is kept, so that
+    the tools still recognize the file format)
+    :param output: Path of the output
+    :return: Path of the temporary output
+    """
+    return os.path.join(os.path.dirname(output), f".tmp-{os.getpid()}-{threading.get_ident()}-"
+                                                 f"{pathlib.Path(output).name}")
+
+
+def get_tool_error(completed_process, outputs: list) -> str:
+    """
+    Checks the outcome of an external tool
+    :param completed_process: Completed process of the tool
+    :param outputs: Files the tool must have written
+    :return: Description of the error, None if the tool succeeded
+    """
+    if completed_process.returncode != 0:
+        stderr = completed_process.stderr.decode(errors='replace').strip().splitlines()
+        return f"exit code {completed_process.returncode}" + (f": {stderr[-1]}" if stderr else "")
+    missing_outputs = [pathlib.Path(output).name for output in outputs
+                       if not os.path.exists(output) or os.path.getsize(output) == 0]
+    if missing_outputs:
+        return f"missing or empty outputs {missing_outputs}"
+    return None
+
+
+def run_checked(cmd: str, outputs: list, frame: str = None, retries: int = c.TOOL_RETRIES):
+    """
+    Runs an external tool like perfTrace.run_tool and makes sure it worked: a non-zero exit code or a missing output
+    is retried up to retries times and then raised. The outputs are written under temporary names and moved into
+    place only on success, so that readers (and a speculative copy of the same job) never see a partial file. Inside
+    a controlled job (see map_jobs) the tool is killed as soon as the driver cancels the attempt.
+    :param cmd: Command line to run; the outputs must appear in it as re.escape(output)
+    :param outputs: Files the tool writes
+    :param frame: Optional frame the command works on
+    :param retries: Number of times a failed tool is run again
+    :return: The completed process
+    """
+    tool = cmd.split()[0]
+    error = None
+    for attempt in range(retries + 1):
+        temporary_outputs = {output: get_temporary_output(output) for output in outputs}
+        attempt_cmd = cmd
+        for output, temporary_output in temporary_outputs.items():
+            attempt_cmd = re.sub(rf"(?<=\s){re.escape(re.escape(output))}(?=\s|$)",
+                                 lambda _: re.escape(temporary_output), attempt_cmd)
+        try:
+            completed_process = perfTrace.run_tool(attempt_cmd, frame=frame, stop_check=get_stop_reason)
+            stop_reason = get_stop_reason()
+            if stop_reason is not None:
+                raise JobCancelled(f"{tool} stopped for {frame}: {stop_reason}")
+            error = get_tool_error(completed_process, list(temporary_outputs.values()))
+            if error is None:
+                for output, temporary_output in temporary_outputs.items():
+                    os.replace(temporary_output, output)
+                return completed_process
+        finally:
+            for temporary_output in temporary_outputs.values():
+                if os.path.exists(temporary_output):
+                    os.remove(temporary_output)
+        logging.warning(f"{tool} failed for {frame} (attempt {attempt + 1} of {retries + 1}): {error}")
+    raise JobError(f"{tool} failed for {frame} after {retries + 1} attempts: {error} | Command: {cmd}")
+
+
+# Driver side
+
+
+def cancel_attempt(cancel_file: str, reason: str) -> None:
+    """
+    Asks the worker running a job attempt to stop it
+    :param cancel_file: Cancel file of the attempt
+    :param reason: Reason the worker reports
+    :return: None
+    """
+    with open(cancel_file, 'w') as cancel_out:
+        cancel_out.write(reason)
+
+
+def map_jobs(function, jobs: list, njobs: int, shared_objects=None, executor=None, control_root: str = None,
+             max_attempts: int = c.JOB_MAX_ATTEMPTS, costs: list = None, durations: list = None,
+             core_sets: list = None, speculate: bool = True) -> list:
+    """
+    Runs a function on a list of jobs like sysUtil.map_jobs, under job control:
+    - the jobs are handed out one at a time (chunk size 1), at most njobs at once, in the order of the list or, with
+      costs, the most expensive job first (longest processing time first, which keeps the makespan short)
+    - once c.JOB_MIN_SAMPLES jobs finished, an attempt that runs longer than c.JOB_TIMEOUT_FACTOR times their median
+      duration (at least c.JOB_MIN_TIMEOUT seconds) is cancelled and retried
+    - when no job is waiting any more and no attempt is still queued in the executor (i.e. a worker is idle), an attempt
+      that runs longer than c.JOB_STRAGGLER_FACTOR times the median is re-issued speculatively; the first copy that
+      finishes wins and the others are cancelled
+    - attempts are timed from when the executor reports them running (for a distributed.DistributedExecutor: from
+      when a worker claimed them), so jobs waiting for a free worker never time out
+    - failed attempts are retried until max_attempts, then JobError is raised
+    The function must be idempotent (a job may run more than once) and should run its tools through run_checked. A
+    cancelled attempt has stopped before its retry starts, but speculative copies run at the same time: jobs whose
+    copies would interfere (e.g. by removing or rewriting files they share) must be run with speculate=False.
+    :param function: Function to run; it receives the shared objects (if any) followed by the arguments of a job
+    :param jobs: List of jobs, each either a single argument or a tuple of arguments
+    :param njobs: Number of jobs to run in parallel
+    :param shared_objects: Object passed as first argument to every call of the function
+    :param executor: Optional caller-provided concurrent.futures.Executor
+    :param control_root: Folder for the cancel files, visible to all workers [default: the temp folder; use a folder
+    on shared storage with a distributed executor]
+    :param max_attempts: Number of times a job is started at most
+    :param costs: Optional estimated cost of every job, in any unit
+    :param durations: Optional list the wall time in seconds of the successful attempt of every job is appended to
+    :param core_sets: Optional core sets to pin the workers to, see sysUtil.get_core_sets (only used without executor)
+    :param speculate: If False, stragglers are not re-issued speculatively (timeouts and retries still apply)
+    :return: List of the results of the function, in the order of the jobs
+    """
+    job_args = [(job if isinstance(job, tuple) else (job,)) for job in jobs]
+    if shared_objects is not None:
+        job_args = [(shared_objects,) + args for args in job_args]
+    if not job_args:
+        return []
+    own_executor = executor is None
+    if own_executor and core_sets:
+        mp_context = multiprocessing.get_context('fork')
+        executor = ProcessPoolExecutor(max_workers=njobs, mp_context=mp_context, initializer=su.pin_worker,
+                                       initargs=(core_sets, mp_context.Value('i', 0)))
+    elif own_executor:
+        executor = ProcessPoolExecutor(max_workers=njobs, mp_context=multiprocessing.get_context('fork'))
+    control_dir = tempfile.mkdtemp(prefix='falcon-jobs-', dir=control_root)
+
+    results = [None] * len(job_args)
+    finished = [False] * len(job_args)
+    num_attempts = [0] * len(job_args)
+    waiting = list(range(len(job_args)))
+    if costs is not None:
+        waiting.sort(key=lambda job_index: -costs[job_index])
+    running = {}
+    started = {}
+    cancelled = set()
+    job_durations = [None] * len(job_args)
+
+    def submit(job_index: int) -> None:
+        cancel_file = os.path.join(control_dir, f"{job_index}-{num_attempts[job_index]}.cancel")
+        num_attempts[job_index] += 1
+        running[executor.submit(run_job, function, cancel_file, job_args[job_index])] = (job_index, cancel_file)
+
+    def copies_of(job_index: int) -> list:
+        return [future for future, (index, _) in running.items() if index == job_index]
+
+    try:
+        while not all(finished):
+            while waiting and len(running) < njobs:
+                submit(waiting.pop(0))
+            done_attempts, _ = wait(list(running), timeout=1.0, return_when=FIRST_COMPLETED)
+            now = time.time()
+
+            for future in done_attempts:
+                job_index, cancel_file = running.pop(future)
+                started.pop(future, None)
+                if finished[job_index]:
+                    continue
+                try:
+                    job_durations[job_index], results[job_index] = future.result()
+                except Exception as error:
+                    if copies_of(job_index):
+                        logging.info(f"Job {job_index} attempt failed, another copy is still running: {error}")
+                    elif num_attempts[job_index] < max_attempts:
+                        logging.warning(f"Job {job_index} failed (attempt {num_attempts[job_index]} of "
+                                        f"{max_attempts}), retrying: {error}")
+                        waiting.insert(0, job_index)
+                    else:
+                        raise JobError(f"Job {job_index} {job_args[job_index][-1]} failed after "
+                                       f"{num_attempts[job_index]} attempts: {error}") from error
+                    continue
+                finished[job_index] = True
+                for copy in copies_of(job_index):
+                    cancel_attempt(running[copy][1], 'superseded by a faster copy')
+                    cancelled.add(copy)
+
+            # A job attempt is timed from when it was first seen running, not from when it was queued
+            for future in running:
+                if future not in started and future.running():
+                    started[future] = now
+            finished_durations = [duration for duration in job_durations if duration is not None]
+            if len(finished_durations) < c.JOB_MIN_SAMPLES:
+                continue
+            median_duration = statistics.median(finished_durations)
+            worker_idle = all(future.running() or future.done() for future in running)
+            timeout = max(c.JOB_MIN_TIMEOUT, c.JOB_TIMEOUT_FACTOR * median_duration)
+            for future, (job_index, cancel_file) in list(running.items()):
+                elapsed = now - started.get(future, now)
+                if future in cancelled:
+                    continue
+                if elapsed > timeout:
+                    logging.warning(f"Job {job_index} runs for {elapsed:.0f} s, longer than its timeout of "
+                                    f"{timeout:.0f} s (median job: {median_duration:.0f} s), cancelling it")
+                    cancel_attempt(cancel_file, f"timed out after {elapsed:.0f} s")
+                    cancelled.add(future)
+                elif (speculate and not waiting and len(running) < njobs and worker_idle
+                      and elapsed > c.JOB_STRAGGLER_FACTOR * median_duration and len(copies_of(job_index)) == 1
+                      and num_attempts[job_index] < max_attempts):
+                    logging.info(f"Job {job_index} is a straggler ({elapsed:.0f} s, median job: "
+                                 f"{median_duration:.0f} s), starting a speculative copy")
+                    submit(job_index)
+    except BaseException:
+        for future, (_, cancel_file) in running.items():
+            cancel_attempt(cancel_file, 'run failed')
+        raise
+    finally:
+        if own_executor:
+            executor.shutdown(wait=True, cancel_futures=True)
+        # Attempts that are still running see the missing control folder and stop
+        shutil.rmtree(control_dir, ignore_errors=True)
+    logging.info(f"Job control: {len(job_args)} jobs | {sum(num_attempts)} attempts | median job: "
+                 f"{statistics.median(job_durations):.1f} s | longest job: {max(job_durations):.1f} s")
+    if durations is not None:
+        durations.extend(job_durations)
+    return results
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: perfTrace.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: Structured performance trace of FALCON. Every phase and every external tool invocation (greedy, c3d,
+# dcm2niix, ...) is recorded with its wall time, CPU time and peak RSS as one JSON line in the Chrome trace event
+# format, so the trace can be summarized here or loaded into chrome://tracing or Perfetto after export_chrome_trace.
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+# Imported Libraries
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import signal
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+# The trace file is passed to the worker processes through the environment, so enable tracing before creating pools
+TRACE_ENV_VARIABLE = 'FALCON_TRACE'
+
+# Longest time in seconds between two checks whether a running tool has to be stopped
+STOP_POLL_INTERVAL = 0.5
+
+# Phases that are active in this process, per thread (several studies can run in threads of one process)
+active_phases = {}
+active_phases_lock = threading.Lock()
+
+
+def enable(trace_file: str) -> str:
+    """
+    Enables tracing for this process and the worker processes it starts from now on
+    :param trace_file: JSON lines file the trace events are appended to
+    :return: Absolute path of the trace file
+    """
+    trace_file = os.path.abspath(trace_file)
+    os.environ[TRACE_ENV_VARIABLE] = trace_file
+    return trace_file
+
+
+def get_trace_file() -> str:
+    """
+    Gets the trace file of this process
+    :return: Path of the trace file, None if tracing is disabled
+    """
+    return os.environ.get(TRACE_ENV_VARIABLE)
+
+
+def get_worker_id() -> str:
+    """
+    Gets the id of the current worker
+    :return: Host name and process id
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def get_active_phases() -> list:
+    """
+    Gets the innermost active phase of every thread of this process
+    :return: Sorted list of the names of the active phases
+    """
+    with active_phases_lock:
+        return sorted(set(phases[-1] for phases in active_phases.values() if phases))
+
+
+def write_event(name: str, category: str, start: float, duration: float, args: dict) -> None:
+    """
+    Appends a complete event in the Chrome trace event format to the trace file. Each event is written with a single
+    append, so several processes can trace into the same file.
+    :param name: Name of the event (phase or tool)
+    :param category: 'phase' or 'tool'
+    :param start: Start time (seconds since the epoch)
+    :param duration: Duration in seconds
+    :param args: Additional fields of the event
+    :return: None
+    """
+    trace_file = get_trace_file()
+    if trace_file is None:
+        return
+    event = {'name': name, 'cat': category, 'ph': 'X', 'ts': round(start * 1e6), 'dur': round(duration * 1e6),
+             'pid': os.getpid(), 'tid': threading.get_native_id(), 'args': {'worker': get_worker_id(), **args}}
+    line = (json.dumps(event) + '\n').encode()
+    file_descriptor = os.open(trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(file_descriptor, line)
+    finally:
+        os.close(file_descriptor)
+
+
+def get_cpu_times() -> tuple:
+    """
+    Gets the CPU time used so far by this process and by its children that have finished
+    :return: Tuple of the CPU time of this process and of its children in seconds
+    """
+    own_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own_usage.ru_utime + own_usage.ru_stime, children_usage.ru_utime + children_usage.ru_stime
+
+
+@contextlib.contextmanager
+def phase(name: str, timings: dict = None, **args):
+    """
+    Records a phase and marks it as active while it runs (see get_active_phases). The CPU time includes the children
+    that finished within the phase (external tools and forked worker pools, not the workers of a shared pool); the peak
+    RSS is the high-water mark of this process and of its children at the end of the phase.
+    :param name: Name of the phase
+    :param timings: Optional dictionary the wall time of the phase is stored in under its name
+    :param args: Additional fields of the event, e.g. frame='vol0001.nii.gz'
+    """
+    start = time.time()
+    start_counter = time.perf_counter()
+    own_cpu_start, children_cpu_start = get_cpu_times()
+    thread_id = threading.get_ident()
+    with active_phases_lock:
+        active_phases.setdefault(thread_id, []).append(name)
+    try:
+        yield
+    finally:
+        with active_phases_lock:
+            active_phases[thread_id].pop()
+            if not active_phases[thread_id]:
+                del active_phases[thread_id]
+        wall_time = time.perf_counter() - start_counter
+        if timings is not None:
+            timings[name] = wall_time
+        if get_trace_file() is not None:
+            own_cpu, children_cpu = get_cpu_times()
+            write_event(name, 'phase', start, wall_time, {
+                'wall_s': round(wall_time, 3),
+                'cpu_s': round(own_cpu - own_cpu_start, 3),
+                'children_cpu_s': round(children_cpu - children_cpu_start, 3),
+                'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                'children_peak_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+                **args})
+
+
+def wait_or_stop(process: subprocess.Popen, stop_check) -> tuple:
+    """
+    Waits for a tool that runs in its own process group, and kills the group as soon as stop_check returns a reason
+    :param process: Process of the tool
+    :param stop_check: Function that returns a reason to stop the tool, or None to let it run
+    :return: Tuple of the wait status and the resource usage of the process
+    """
+    poll_interval = 0.01
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid != 0:
+            return status, usage
+        if stop_check() is not None:
+            os.killpg(process.pid, signal.SIGKILL)
+            _, status, usage = os.wait4(process.pid, 0)
+            return status, usage
+        time.sleep(poll_interval)
+        poll_interval = min(poll_interval * 2, STOP_POLL_INTERVAL)
+
+
+def run_tool(cmd: str, frame: str = None, stop_check=None) -> subprocess.CompletedProcess:
+    """
+    Runs an external tool through the shell, like subprocess.run(cmd, shell=True, capture_output=True), and records
+    its wall time, CPU time and peak RSS (taken from the rusage of exactly this child)
+    :param cmd: Command line to run
+    :param frame: Optional frame the command works on
+    :param stop_check: Optional function polled while the tool runs; once it returns a reason, the tool and everything
+    it started are killed (see jobControl)
+    :return: The completed process with its captured output
+    """
+    if get_trace_file() is None and stop_check is None:
+        return subprocess.run(cmd, shell=True, capture_output=True)
+
+    start = time.time()
+    start_counter = time.perf_counter()
+    with tempfile.TemporaryFile() as stdout_file, tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(cmd, shell=True, stdout=stdout_file, stderr=stderr_file,
+                                   start_new_session=stop_check is not None)
+        if stop_check is None:
+            _, status, usage = os.wait4(process.pid, 0)
+        else:
+            status, usage = wait_or_stop(process, stop_check)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        wall_time = time.perf_counter() - start_counter
+        stdout_file.seek(0)
+        stderr_file.seek(0)
+        completed_process = subprocess.CompletedProcess(cmd, process.returncode, stdout_file.read(),
+                                                        stderr_file.read())
+    if get_trace_file() is not None:
+        write_event(cmd.split()[0], 'tool', start, wall_time, {
+            'wall_s': round(wall_time, 3),
+            'cpu_s': round(usage.ru_utime + usage.ru_stime, 3),
+            'peak_rss_mb': round(usage.ru_maxrss / 1024, 1),
+            'return_code': process.returncode,
+            'frame': frame,
+            'cmd': cmd})
+    return completed_process
+
+
+def read_trace(trace_file: str) -> list:
+    """
+    Reads the events of a trace file
+    :param trace_file: JSON lines trace file
+    :return: List of events
+    """
+    with open(trace_file, 'r') as trace_in:
+        return [json.loads(line) for line in trace_in if line.strip()]
+
+
+def export_chrome_trace(trace_file: str, chrome_trace_file: str) -> str:
+    """
+    Converts a JSON lines trace into a Chrome trace file (chrome://tracing, Perfetto)
+    :param trace_file: JSON lines trace file
+    :param chrome_trace_file: Chrome trace file to write
+    :return: Path of the Chrome trace file
+    """
+    with open(chrome_trace_file, 'w') as chrome_trace_out:
+        json.dump({'traceEvents': read_trace(trace_file), 'displayTimeUnit': 'ms'}, chrome_trace_out)
+    return chrome_trace_file
+
+
+def summarize(trace_file: str) -> dict:
+    """
+    Summarizes a trace per phase and per tool
+    :param trace_file: JSON lines trace file
+    :return: Dictionary mapping 'category:name' to the count, total wall time, total CPU time and largest peak RSS
+    """
+    summary = {}
+    for event in read_trace(trace_file):
+        entry = summary.setdefault(f"{event['cat']}:{event['name']}",
+                                   {'count': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'peak_rss_mb': 0.0})
+        entry['count'] += 1
+        entry['wall_s'] += event['args']['wall_s']
+        entry['cpu_s'] += event['args']['cpu_s'] + event['args'].get('children_cpu_s', 0.0)
+        entry['peak_rss_mb'] = max(entry['peak_rss_mb'], event['args']['peak_rss_mb'],
+                                   event['args'].get('children_peak_rss_mb', 0.0))
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "trace_file",
+        type=str,
+        help="JSON lines trace file written by a traced FALCON run"
+    )
+    parser.add_argument(
+        "-o",
+        "--chrome_trace_file",
+        type=str,
+        default=None,
+        help="optional Chrome trace file to export the trace to"
+    )
+    args = parser.parse_args()
+
+    for event_name, totals in sorted(summarize(args.trace_file).items(), key=lambda item: -item[1]['wall_s']):
+        print(f"{event_name:<40} count: {totals['count']:>5} | wall: {totals['wall_s']:10.2f} s | cpu: "
+              f"{totals['cpu_s']:10.2f} s | peak RSS: {totals['peak_rss_mb']:9.1f} MB")
+    if args.chrome_trace_file:
+        export_chrome_trace(args.trace_file, args.chrome_trace_file)
+        print(f"Chrome trace written to {args.chrome_trace_file}")
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: phantom.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: Synthetic dynamic PET phantoms with known motion. A body with blobs that follow tracer-like
+# time-activity curves is sampled on a frame schedule, moved by a known rigid, affine or smooth deformable motion per
+# frame and corrupted with noise that grows as the frames get shorter. The motion-free, noise-free frames and the
+# motion of every frame are stored as ground truth next to the study.
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+# Imported Libraries
+
+import argparse
+import json
+import logging
+import os
+
+# numpy, SimpleITK and nibabel are imported inside the functions that need them, like in imageOp
+
+MOTION_TYPES = ('rigid', 'affine', 'deformable')
+
+# Name of the ground truth file in the ground truth folder
+GROUND_TRUTH_FILE = 'ground-truth.json'
+
+# Blobs of the phantom: name, center (offset from the center of the field of view as a fraction of its extent),
+# radius in mm and time-activity curve
+BLOBS = [
+    {'name': 'blood_pool', 'center': (0.0, -0.12, 0.22), 'radius': 14.0, 'tac': 'blood'},
+    {'name': 'liver', 'center': (-0.14, 0.06, -0.2), 'radius': 24.0, 'tac': 'reversible'},
+    {'name': 'tumor', 'center': (0.16, 0.1, -0.08), 'radius': 10.0, 'tac': 'irreversible'},
+    {'name': 'lesion', 'center': (0.12, -0.04, 0.36), 'radius': 7.0, 'tac': 'irreversible'}
+]
+
+
+def get_frame_durations(num_frames: int) -> list:
+    """
+    Gets a typical dynamic PET frame schedule: short frames during the bolus, long frames at the end
+    :param num_frames: Number of frames
+    :return: List of frame durations in seconds
+    """
+    import numpy as np
+    return [float(round(duration)) for duration in np.geomspace(10, 600, num_frames)]
+
+
+def get_activity(tac: str, time_s: float) -> float:
+    """
+    Evaluates a time-activity curve
+    :param tac: 'blood' (bolus peak and washout), 'reversible' (uptake and washout), 'irreversible' (trapping) or
+    'background'
+    :param time_s: Time after injection in seconds
+    :return: Activity concentration (arbitrary units)
+    """
+    import numpy as np
+    if tac == 'blood':
+        return float(20 * (time_s / 30) * np.exp(1 - time_s / 30) + 1.5)
+    elif tac == 'reversible':
+        return float(6 * (np.exp(-time_s / 1800) - np.exp(-time_s / 60)))
+    elif tac == 'irreversible':
+        return float(8 * (1 - np.exp(-time_s / 400)))
+    elif tac == 'background':
+        return float(1 - np.exp(-time_s / 120))
+    raise ValueError(f"Unknown time-activity curve: {tac}")
+
+
+def get_shapes(size: tuple, spacing: float) -> tuple:
+    """
+    Creates the body and the blob shapes of the phantom (soft-edged, like after the point spread function of a scanner)
+    :param size: Number of voxels along x, y and z
+    :param spacing: Voxel size in mm
+    :return: Tuple of the body shape, the list of blob shapes and the physical centers of the blobs (numpy arrays
+    indexed z, y, x)
+    """
+    import numpy as np
+    extent = np.array(size) * spacing
+    z, y, x = np.meshgrid(*[(np.arange(n) - (n - 1) / 2) * spacing for n in size[::-1]], indexing='ij')
+    body_distance = np.sqrt((x / (0.42 * extent[0])) ** 2 + (y / (0.3 * extent[1])) ** 2 +
+                            (z / (0.47 * extent[2])) ** 2)
+    body = 1 / (1 + np.exp((body_distance - 1) * 20))
+    blobs, blob_centers = [], []
+    for blob in BLOBS:
+        center = np.array(blob['center']) * extent
+        distance = np.sqrt((x - center[0]) ** 2 + (y - center[1]) ** 2 + (z - center[2]) ** 2)
+        blobs.append(1 / (1 + np.exp((distance - blob['radius']) / (0.35 * spacing))))
+        blob_centers.append(center)
+    return body, blobs, blob_centers
+
+
+def get_motion_parameters(motion_type: str, num_frames: int, max_rotation: float, max_translation: float,
+                          max_deformation: float, rng) -> list:
+    """
+    Draws a smooth random motion for every frame. The motion drifts like a random walk and vanishes at the last frame,
+    which is the reference frame of FALCON by default.
+    :param motion_type: 'rigid', 'affine' or 'deformable'
+    :param num_frames: Number of frames
+    :param max_rotation: Largest rotation in degrees
+    :param max_translation: Largest translation in mm
+    :param max_deformation: Largest amplitude of the smooth deformation in mm (deformable motion only)
+    :param rng: numpy random generator
+    :return: List of dictionaries with the motion parameters of every frame
+    """
+    import numpy as np
+    walk = np.cumsum(rng.normal(size=(num_frames, 12))[::-1], axis=0)[::-1]
+    walk -= walk[-1]
+    walk /= np.maximum(np.abs(walk).max(axis=0), 1e-6)
+    motions = []
+    for steps in walk:
+        motion = {'rotation_deg': (steps[0:3] * max_rotation).tolist(),
+                  'translation_mm': (steps[3:6] * max_translation).tolist(),
+                  'scale': [1.0, 1.0, 1.0], 'shear': [0.0, 0.0, 0.0]}
+        if motion_type == 'affine':
+            motion['scale'] = (1 + steps[6:9] * 0.04).tolist()
+            motion['shear'] = (steps[9:12] * 0.03).tolist()
+        elif motion_type == 'deformable':
+            motion['rotation_deg'] = (steps[0:3] * max_rotation / 2).tolist()
+            motion['translation_mm'] = (steps[3:6] * max_translation / 2).tolist()
+            motion['deformation_mm'] = (steps[6:9] * max_deformation).tolist()
+            motion['deformation_phase'] = (steps[9:12] * np.pi).tolist()
+        motions.append(motion)
+    return motions
+
+
+def get_linear_transform(motion: dict, center: list) -> 'SimpleITK.AffineTransform':
+    """
+    Builds the linear part of a frame motion
+    :param motion: Motion parameters of the frame, see get_motion_parameters
+    :param center: Center of rotation (physical coordinates)
+    :return: Affine transform that maps points of the motion-free frame to the points shown by the moved frame
+    """
+    import numpy as np
+    import SimpleITK
+    rotation = SimpleITK.Euler3DTransform()
+    rotation.SetRotation(*np.deg2rad(motion['rotation_deg']))
+    shear_x, shear_y, shear_z = motion['shear']
+    matrix = (np.array(rotation.GetMatrix()).reshape(3, 3) @ np.diag(motion['scale']) @
+              np.array([[1, shear_x, shear_y], [0, 1, shear_z], [0, 0, 1]]))
+    transform = SimpleITK.AffineTransform(3)
+    transform.SetCenter(center)
+    transform.SetMatrix(matrix.flatten().tolist())
+    transform.SetTranslation(motion['translation_mm'])
+    return transform
+
+
+def get_deformation_field(motion: dict, reference: 'SimpleITK.Image') -> 'SimpleITK.Image':
+    """
+    Builds a smooth displacement field: one low-frequency sine wave per axis, one period across the field of view
+    :param motion: Motion parameters of the frame, see get_motion_parameters
+    :param reference: Image defining the grid of the field
+    :return: Displacement field in mm (vector image)
+    """
+    import numpy as np
+    import SimpleITK
+    # Coordinates relative to the field of view (0 to 1)
+    z, y, x = np.meshgrid(*[np.arange(n) / n for n in reference.GetSize()[::-1]], indexing='ij')
+    phase_x, phase_y, phase_z = motion['deformation_phase']
+    amplitude_x, amplitude_y, amplitude_z = motion['deformation_mm']
+    field = np.stack([amplitude_x * np.sin(2 * np.pi * y + phase_x) * np.cos(np.pi * z),
+                      amplitude_y * np.sin(2 * np.pi * z + phase_y) * np.cos(np.pi * x),
+                      amplitude_z * np.sin(2 * np.pi * x + phase_z) * np.cos(np.pi * y)], axis=-1)
+    field_img = SimpleITK.GetImageFromArray(field.astype(np.float64), isVector=True)
+    field_img.CopyInformation(reference)
+    return field_img
+
+
+def create_phantom(out_dir: str, motion_type: str = 'affine', num_frames: int = 20, size: tuple = (96, 96, 64),
+                   spacing: float = 3.0, noise_level: float = 0.15, max_rotation: float = 3.0,
+                   max_translation: float = 6.0, max_deformation: float = 4.0, frame_format: str = '4d',
+                   seed: int = 0) -> dict:
+    """
+    Creates a synthetic dynamic PET study with known motion
+    :param out_dir: Folder in which the study folder '<motion>-phantom' and its ground truth folder are created
+    :param motion_type: 'rigid', 'affine' or 'deformable'
+    :param num_frames: Number of frames
+    :param size: Number of voxels along x, y and z
+    :param spacing: Voxel size in mm
+    :param noise_level: Relative noise of a unit activity in a 60 s frame; the noise scales with
+    sqrt(activity / frame duration)
+    :param max_rotation: Largest rotation in degrees
+    :param max_translation: Largest translation in mm
+    :param max_deformation: Largest amplitude of the smooth deformation in mm (deformable motion only)
+    :param frame_format: '4d' for one 4d NIfTI file, '3d' for one NIfTI file per frame
+    :param seed: Seed of the motion and the noise
+    :return: Ground truth of the study (also stored in the ground truth folder)
+    """
+    import nibabel as nib
+    import numpy as np
+    import SimpleITK
+    if motion_type not in MOTION_TYPES:
+        raise ValueError(f"Unknown motion type: {motion_type}")
+    rng = np.random.default_rng(seed)
+    study_dir = os.path.join(os.path.abspath(out_dir), f"{motion_type}-phantom")
+    ground_truth_dir = study_dir + '-ground-truth'
+    os.makedirs(study_dir, exist_ok=True)
+    os.makedirs(ground_truth_dir, exist_ok=True)
+
+    body, blobs, blob_centers = get_shapes(size, spacing)
+    reference = SimpleITK.Image([int(n) for n in size], SimpleITK.sitkFloat32)
+    reference.SetSpacing([spacing] * 3)
+    reference.SetOrigin([-(n - 1) / 2 * spacing for n in size])
+    center = [0.0, 0.0, 0.0]
+    body_mask = SimpleITK.GetImageFromArray((body > 0.5).astype(np.uint8))
+    body_mask.CopyInformation(reference)
+    body_mask_file = os.path.join(ground_truth_dir, 'body-mask.nii.gz')
+    SimpleITK.WriteImage(body_mask, body_mask_file)
+
+    durations = get_frame_durations(num_frames)
+    motions = get_motion_parameters(motion_type, num_frames, max_rotation, max_translation, max_deformation, rng)
+    frame_start = 0.0
+    ground_truth = {'motion_type': motion_type, 'size': list(size), 'spacing_mm': spacing, 'noise_level': noise_level,
+                    'seed': seed, 'body_mask': body_mask_file, 'blobs': [], 'frames': []}
+    for blob, blob_center in zip(BLOBS, blob_centers):
+        ground_truth['blobs'].append({**blob, 'center_mm': blob_center.tolist()})
+
+    frame_files = []
+    for index, (duration, motion) in enumerate(zip(durations, motions)):
+        mid_time = frame_start + duration / 2
+        frame_start += duration
+        activity = body * get_activity('background', mid_time)
+        for blob, blob_shape in zip(BLOBS, blobs):
+            activity = activity + blob_shape * (get_activity(blob['tac'], mid_time) - get_activity('background',
+                                                                                                      mid_time)) * body
+        static_img = SimpleITK.GetImageFromArray(activity.astype(np.float32))
+        static_img.CopyInformation(reference)
+        static_file = os.path.join(ground_truth_dir, f"static-frame{index:04d}.nii.gz")
+        SimpleITK.WriteImage(static_img, static_file)
+
+        # The moved frame at x shows the motion-free frame at T(x)
+        transform = get_linear_transform(motion, center)
+        frame_truth = {'index': index, 'mid_time_s': mid_time, 'duration_s': duration, 'motion': motion,
+                       'matrix': list(transform.GetMatrix()), 'translation_mm': list(transform.GetTranslation()),
+                       'center_mm': center, 'static_frame': static_file}
+        if motion_type == 'deformable':
+            field_img = get_deformation_field(motion, reference)
+            frame_truth['deformation_field'] = os.path.join(ground_truth_dir, f"deformation-frame{index:04d}.nii.gz")
+            SimpleITK.WriteImage(SimpleITK.Cast(field_img, SimpleITK.sitkVectorFloat32),
+                                 frame_truth['deformation_field'])
+            # SimpleITK applies the last transform of a composite first: the deformation, then the linear motion
+            transform = SimpleITK.CompositeTransform([transform, SimpleITK.DisplacementFieldTransform(field_img)])
+        moved = SimpleITK.GetArrayFromImage(SimpleITK.Resample(static_img, reference, transform,
+                                                               SimpleITK.sitkLinear, 0.0))
+        noise_sigma = noise_level * np.sqrt(np.maximum(moved, 0) * 60 / duration)
+        noisy = np.maximum(moved + rng.normal(size=moved.shape) * noise_sigma, 0).astype(np.float32)
+        frame_img = SimpleITK.GetImageFromArray(noisy)
+        frame_img.CopyInformation(reference)
+        frame_file = os.path.join(study_dir if frame_format == '3d' else ground_truth_dir,
+                                  f"frame{index:04d}.nii.gz")
+        SimpleITK.WriteImage(frame_img, frame_file)
+        frame_files.append(frame_file)
+        ground_truth['frames'].append(frame_truth)
+
+    if frame_format == '4d':
+        study_file = os.path.join(study_dir, 'pet-4d.nii.gz')
+        nib.save(nib.funcs.concat_images(frame_files, False), study_file)
+        for frame_file in frame_files:
+            os.remove(frame_file)
+        ground_truth['study_files'] = [study_file]
+    else:
+        ground_truth['study_files'] = frame_files
+    ground_truth['study_dir'] = study_dir
+
+    with open(os.path.join(ground_truth_dir, GROUND_TRUTH_FILE), 'w') as ground_truth_out:
+        json.dump(ground_truth, ground_truth_out, indent=4)
+    logging.info(f"Created {motion_type} phantom with {num_frames} frames of size {size} in {study_dir}")
+    return ground_truth
+
+
+def load_ground_truth(study_dir: str) -> dict:
+    """
+    Loads the ground truth of a phantom study
+    :param study_dir: Study folder created by create_phantom
+    :return: Ground truth of the study
+    """
+    with open(os.path.join(os.path.abspath(study_dir) + '-ground-truth', GROUND_TRUTH_FILE), 'r') as ground_truth_in:
+        return json.load(ground_truth_in)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--out_dir", type=str, required=True,
+                        help="folder to create the phantom study and its ground truth in")
+    parser.add_argument("-m", "--motion", type=str, choices=MOTION_TYPES, default='affine',
+                        help="type of the motion between the frames")
+    parser.add_argument("-n", "--num_frames", type=int, default=20, help="number of frames")
+    parser.add_argument("--size", type=int, nargs=3, default=[96, 96, 64], help="number of voxels along x, y and z")
+    parser.add_argument("--spacing", type=float, default=3.0, help="voxel size in mm")
+    parser.add_argument("--noise_level", type=float, default=0.15,
+                        help="relative noise of a unit activity in a 60 s frame")
+    parser.add_argument("--format", type=str, choices=['3d', '4d'], default='4d',
+                        help="one 4d NIfTI file or one 3d NIfTI file per frame")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the motion and the noise")
+    args = parser.parse_args()
+
+    phantom = create_phantom(args.out_dir, motion_type=args.motion, num_frames=args.num_frames, size=tuple(args.size),
+                             spacing=args.spacing, noise_level=args.noise_level, frame_format=args.format,
+                             seed=args.seed)
+    print(f"Phantom study: {phantom['study_dir']}")
+    print(f"Ground truth: {phantom['study_dir']}-ground-truth")
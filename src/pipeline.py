@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: pipeline.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: Pipelined frame alignment. A small I/O pool prefetches and decompresses the upcoming frames into a
+# staging folder (tmpfs if available) while the registration workers run, and a writer pool compresses and persists
+# the outputs behind them, so that the registration workers never wait for gzip.
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+# Imported Libraries
+
+import glob
+import gzip
+import logging
+import multiprocessing
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+import timeit
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import constants as c
+import distributed
+import greedy
+import jobControl
+import sysUtil as su
+
+# Preferred staging folder: tmpfs, so that the decompressed frames never touch a disk
+TMPFS_DIR = '/dev/shm'
+
+# Pipeline stages whose queue depths are reported
+STAGES = ('prefetch', 'ready', 'register', 'write')
+
+
+def get_staging_dir(staging_root: str = None) -> str:
+    """
+    Creates a private staging folder
+    :param staging_root: Folder to create the staging folder in [default: tmpfs if available, else the temp folder]
+    :return: Path to the staging folder
+    """
+    if staging_root is None:
+        staging_root = TMPFS_DIR if os.access(TMPFS_DIR, os.W_OK) else tempfile.gettempdir()
+    return tempfile.mkdtemp(prefix='falcon-stage-', dir=staging_root)
+
+
+def get_staged_name(img: str) -> str:
+    """
+    Gets the file name of the uncompressed copy of an image
+    :param img: Path to the image
+    :return: File name of the uncompressed copy
+    """
+    img_filename = pathlib.Path(img).name
+    return img_filename[:-len('.gz')] if img_filename.endswith('.gz') else img_filename
+
+
+def prefetch(img: str, staging_dir: str, prefix: str = '') -> str:
+    """
+    Copies an image into the staging folder, decompressing it on the way
+    :param img: Path to the (gzipped) image
+    :param staging_dir: Staging folder
+    :param prefix: Optional prefix of the staged file name
+    :return: Path to the staged, uncompressed image
+    """
+    staged_img = os.path.join(staging_dir, prefix + get_staged_name(img))
+    opener = gzip.open if img.endswith('.gz') else open
+    with opener(img, 'rb') as img_in, open(staged_img, 'wb') as staged_out:
+        shutil.copyfileobj(img_in, staged_out, length=16 * 1024 * 1024)
+    return staged_img
+
+
+def persist(staged_file: str, target_file: str) -> str:
+    """
+    Moves a staged file to its target, compressing it on the way if the target is gzipped
+    :param staged_file: Path to the staged file
+    :param target_file: Path to the target file
+    :return: Path to the target file
+    """
+    if target_file.endswith('.gz') and not staged_file.endswith('.gz'):
+        with open(staged_file, 'rb') as staged_in, gzip.open(target_file, 'wb', compresslevel=6) as target_out:
+            shutil.copyfileobj(staged_in, target_out, length=16 * 1024 * 1024)
+        os.remove(staged_file)
+    else:
+        shutil.move(staged_file, target_file)
+    return target_file
+
+
+def write_outputs(moving_img: str, staged_img: str, moco_dir: str) -> None:
+    """
+    Persists the outputs of a registered frame: the resampled frame goes to the moco folder and the transforms next to
+    the original frame, under the names they would have had without staging
+    :param moving_img: Path to the original moving image
+    :param staged_img: Path to the staged moving image that was registered
+    :param moco_dir: Directory where the motion corrected frames are saved
+    :return: None
+    """
+    moving_img_filename = pathlib.Path(moving_img).name
+    staging_dir = os.path.dirname(staged_img)
+    staged_img_filename = pathlib.Path(staged_img).name
+    persist(os.path.join(staging_dir, 'moco-' + staged_img_filename),
+            os.path.join(moco_dir, 'moco-' + moving_img_filename))
+    for transform_file in glob.glob(os.path.join(staging_dir, glob.escape(staged_img_filename) + '_*')):
+        suffix = pathlib.Path(transform_file).name[len(staged_img_filename):]
+        shutil.move(transform_file, os.path.join(pathlib.Path(moving_img).parent, moving_img_filename + suffix))
+    os.remove(staged_img)
+
+
+def align_staged_mp(align_param: tuple, staged_img: str) -> str:
+    """
+    Aligns a staged image to the staged fixed image, the resampled image stays in the staging folder
+    :param align_param: Tuple containing the staged fixed image, the registration type, the number of iterations and
+    the registration options
+    :param staged_img: Path to the staged moving image
+    :return: Tuple of the duration of the registration job in seconds and the path to the staged moving image
+    """
+    start = timeit.default_timer()
+    staged_fixed_img, registration_type, multi_resolution_iterations, registration_options = align_param
+    if registration_options['threads_per_job']:
+        su.set_thread_budget(registration_options['threads_per_job'])
+    greedy.registration(fixed_img=staged_fixed_img, moving_img=staged_img, registration_type=registration_type,
+                        multi_resolution_iterations=multi_resolution_iterations,
+                        compute_inverse=registration_options['compute_inverse'],
+                        linear_shrink_factor=registration_options['linear_shrink_factor'],
+                        initializer=registration_options['initializer'])
+    greedy.finish_frame(staged_fixed_img, staged_img, registration_type, os.path.dirname(staged_img),
+                        registration_options)
+    return timeit.default_timer() - start, staged_img
+
+
+def summarize_depths(depth_samples: list) -> dict:
+    """
+    Summarizes the sampled queue depths of the pipeline stages
+    :param depth_samples: List of (time, depths) tuples, depths being a dictionary of the depth per stage
+    :return: Dictionary with the maximum and the time-weighted mean depth per stage, and the samples
+    """
+    summary = {'max_depth': {stage: 0 for stage in STAGES}, 'mean_depth': {stage: 0.0 for stage in STAGES},
+               'samples': [{'time': sample_time, **depths} for sample_time, depths in depth_samples]}
+    if len(depth_samples) < 2:
+        return summary
+    duration = depth_samples[-1][0] - depth_samples[0][0]
+    for (sample_time, depths), (next_time, _) in zip(depth_samples, depth_samples[1:]):
+        for stage in STAGES:
+            summary['max_depth'][stage] = max(summary['max_depth'][stage], depths[stage])
+            if duration > 0:
+                summary['mean_depth'][stage] += depths[stage] * (next_time - sample_time) / duration
+    return summary
+
+
+def align_pipelined(fixed_img: str, moving_imgs: list, registration_type: str, multi_resolution_iterations: str,
+                    njobs: int, moco_dir: str, registration_options: dict, executor=None,
+                    durations: list = None) -> dict:
+    """
+    Aligns the moving images to a fixed image like greedy.align, with prefetching and write-behind. Every frame passes
+    through four stages: 'prefetch' (decompression into the staging folder by the I/O pool), 'ready' (waiting for a
+    registration worker), 'register' (registration and resampling on the uncompressed images) and 'write'
+    (compression into the moco folder by the writer pool). At most njobs + io_jobs frames are staged at a time.
+    The tools are run through jobControl.run_checked and a failed registration job is retried up to
+    c.JOB_MAX_ATTEMPTS times, but unlike jobControl.map_jobs the pipeline has no timeouts and no speculative re-issue
+    of stragglers. With a distributed executor and no staging folder, the frames are staged next to the moco folder
+    (shared storage) instead of on the local tmpfs the remote workers cannot see.
+    :param fixed_img: Path to the fixed image
+    :param moving_imgs: List of paths to the moving images
+    :param registration_type: Type of registration to be performed
+    :param multi_resolution_iterations: Number of iterations for multi-resolution
+    :param njobs: Number of registrations to run in parallel
+    :param moco_dir: Directory where the output files will be saved
+    :param registration_options: Complete registration options, see greedy.get_registration_options
+    :param executor: Optional caller-provided concurrent.futures.Executor to run the registrations on
+    :param durations: Optional list the duration in seconds of the registration job of every moving image is appended
+    to, in the order of moving_imgs (see greedy.save_job_history)
+    :return: Queue depth statistics of the stages, see summarize_depths
+    """
+    io_jobs = registration_options['io_jobs']
+    staging_root = registration_options['staging_dir']
+    if staging_root is None and isinstance(executor, distributed.DistributedExecutor):
+        staging_root = os.path.dirname(moco_dir)
+    staging_dir = get_staging_dir(staging_root)
+    own_executor = executor is None
+    if own_executor:
+        # The workers are forked before any I/O thread exists
+        mp_context = multiprocessing.get_context('fork')
+        if registration_options['pin_cores']:
+            executor = ProcessPoolExecutor(max_workers=njobs, mp_context=mp_context, initializer=su.pin_worker,
+                                           initargs=(su.get_core_sets(njobs, registration_options['threads_per_job']),
+                                                     mp_context.Value('i', 0)))
+        else:
+            executor = ProcessPoolExecutor(max_workers=njobs, mp_context=mp_context)
+        wait([executor.submit(os.getpid) for _ in range(njobs)])
+    logging.info(f"Pipelined alignment of {len(moving_imgs)} frames | Staging folder: {staging_dir} | Registration "
+                 f"jobs: {njobs} | I/O jobs: {io_jobs}")
+
+    queued_imgs = list(moving_imgs)
+    max_staged = njobs + io_jobs
+    prefetching, registering, writing = {}, {}, {}
+    attempts, job_durations = {}, {}
+    depth_samples = []
+    try:
+        with ThreadPoolExecutor(max_workers=io_jobs) as io_pool, ThreadPoolExecutor(max_workers=io_jobs) as writer_pool:
+            staged_fixed_img = prefetch(fixed_img, staging_dir, prefix='fixed-')
+            if registration_options['linear_shrink_factor'] > 1:
+                greedy.get_downscaled_image(staged_fixed_img, registration_options['linear_shrink_factor'])
+            if registration_options['initializer'] != 'image-centers':
+                greedy.get_downscaled_image(staged_fixed_img, c.INIT_SHRINK_LEVEL)
+            align_param = (staged_fixed_img, registration_type, multi_resolution_iterations, registration_options)
+            while queued_imgs or prefetching or registering or writing:
+                while queued_imgs and len(prefetching) + len(registering) < max_staged:
+                    moving_img = queued_imgs.pop(0)
+                    prefetching[io_pool.submit(prefetch, moving_img, staging_dir)] = moving_img
+
+                depth_samples.append((time.time(), {
+                    'prefetch': len(prefetching),
+                    'ready': sum(not job.running() and not job.done() for job in registering),
+                    'register': sum(job.running() for job in registering),
+                    'write': len(writing)}))
+                done_jobs, _ = wait(list(prefetching) + list(registering) + list(writing), timeout=1.0,
+                                    return_when=FIRST_COMPLETED)
+
+                for job in done_jobs:
+                    if job in prefetching:
+                        moving_img = prefetching.pop(job)
+                        attempts[moving_img] = (job.result(), 1)
+                        registering[executor.submit(align_staged_mp, align_param, job.result())] = moving_img
+                    elif job in registering:
+                        moving_img = registering.pop(job)
+                        if job.exception() is not None:
+                            staged_img, attempt = attempts[moving_img]
+                            if attempt >= c.JOB_MAX_ATTEMPTS:
+                                raise jobControl.JobError(f"Registration of {pathlib.Path(moving_img).name} failed "
+                                                          f"after {attempt} attempts: {job.exception()}")
+                            logging.warning(f"Pipeline: registration of {pathlib.Path(moving_img).name} failed "
+                                            f"(attempt {attempt}), retrying: {job.exception()}")
+                            attempts[moving_img] = (staged_img, attempt + 1)
+                            registering[executor.submit(align_staged_mp, align_param, staged_img)] = moving_img
+                            continue
+                        job_durations[moving_img], staged_img = job.result()
+                        writing[writer_pool.submit(write_outputs, moving_img, staged_img, moco_dir)] = moving_img
+                    else:
+                        moving_img = writing.pop(job)
+                        job.result()
+                        logging.info(f"Pipeline: {pathlib.Path(moving_img).name} written to {moco_dir}")
+            depth_samples.append((time.time(), {stage: 0 for stage in STAGES}))
+    finally:
+        if own_executor:
+            executor.shutdown()
+        # The staging folder is usually tmpfs, i.e. memory
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    if durations is not None:
+        durations.extend(job_durations[moving_img] for moving_img in moving_imgs)
+
+    pipeline_stats = summarize_depths(depth_samples)
+    logging.info(f"Pipeline queue depths | max: {pipeline_stats['max_depth']} | mean: "
+                 f"{ {stage: round(depth, 2) for stage, depth in pipeline_stats['mean_depth'].items()} }")
+    return pipeline_stats
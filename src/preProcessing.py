@@ -12,18 +12,12 @@
 # Description: Library for preprocessing operations such as determining starting frame in a 4D series based on MI.
 # License: Apache 2.0
 # **********************************************************************************************************************
-import logging
 import os
 import re
-import subprocess
-from statistics import mean
-import pathlib
-import SimpleITK as sitk
-from halo import Halo
-from mpire import WorkerPool
 import constants as c
 import fileOp as fop
-from skimage.metrics import structural_similarity as ssim
+import perfTrace
+import sysUtil as su
 
 
 def downscale_image(downscale_param: tuple, input_image: str) -> str:
@@ -41,13 +35,13 @@ def downscale_image(downscale_param: tuple, input_image: str) -> str:
     gauss_variance = int(gauss_variance)
     cmd_to_smooth = f"c3d {re.escape(input_image)} -smooth-fast {gauss_variance}x{gauss_variance}x{gauss_variance}vox -o" \
                     f" {re.escape(input_image_blurred)} "
-    subprocess.run(cmd_to_smooth, shell=True, capture_output=True)
+    perfTrace.run_tool(cmd_to_smooth, frame=input_image_name)
     # Resample the smoothed input image later
     input_image_downscaled = os.path.join(output_dir, f"{shrink_factor}x_downscaled_{input_image_name}")
     shrink_percentage = str(int(100 / shrink_factor))
     cmd_to_downscale = f"c3d {re.escape(input_image_blurred)} -resample {shrink_percentage}x{shrink_percentage}x" \
                        f"{shrink_percentage}% -o {re.escape(input_image_downscaled)}"
-    subprocess.run(cmd_to_downscale, shell=True, capture_output=True)
+    perfTrace.run_tool(cmd_to_downscale, frame=input_image_name)
     return input_image_downscaled
 
 
@@ -59,36 +53,43 @@ def calc_mean_intensity(image: str) -> float:
     :return: mean intensity of the image
     :rtype: float
     """
+    import SimpleITK as sitk
     image = sitk.ReadImage(image, sitk.sitkFloat32)
     return sitk.GetArrayFromImage(image).mean()
 
 
-def calc_voxelwise_ncc_images(image1: str, image2: str, output_dir: str) -> str:
+def calc_voxelwise_ncc_images(image1: str, image2: str, output_dir: str, threads: int = None) -> str:
     """
     Calculates voxelwise normalized cross correlation between two images and writes it to the output directory
     :param image1: path to the first image
     :param image2: path to the second image
     :param output_dir: path to the output directory
+    :param threads: optional thread budget of the job, see sysUtil.set_thread_budget
     :return: path to the voxelwise ncc image
     """
+    if threads:
+        su.set_thread_budget(threads)
     # get the image names without the extension '.nii.gz'
     image1_name = os.path.basename(image1).split(".")[0]
     image2_name = os.path.basename(image2).split(".")[0]
     output_image = os.path.join(output_dir, f"ncc_{image2_name}.nii.gz")
     c3d_cmd = f"c3d {re.escape(image1)} {re.escape(image2)} -ncc {c.NCC_RADIUS} -o {re.escape(output_image)}"
-    subprocess.run(c3d_cmd, shell=True, capture_output=True)
+    perfTrace.run_tool(c3d_cmd, frame=os.path.basename(image2))
     # clip the negative correlations to zero
     c3d_cmd = f"c3d {re.escape(output_image)} -clip 0 inf -o {re.escape(output_image)}"
-    subprocess.run(c3d_cmd, shell=True, capture_output=True)
+    perfTrace.run_tool(c3d_cmd, frame=os.path.basename(image2))
     return output_image
 
 
-def determine_candidate_frames(candidate_files: list, reference_file: str, njobs: int) -> int:
+def determine_candidate_frames(candidate_files: list, reference_file: str, njobs: int, executor=None,
+                               threads_per_job: int = None) -> int:
     """
     Determines the candidate frames of a 4D PET series on which motion correction can be performed effectively
     :param candidate_files: list of 3D candidate moving PET files
     :param reference_file: path to the reference PET file
     :param njobs: number of jobs to run in parallel
+    :param executor: optional caller-provided concurrent.futures.Executor to run the jobs on
+    :param threads_per_job: optional thread budget of a job (0 for all CPUs) [default: the CPUs shared by njobs jobs]
     :return:  Index of the starting frame from which motion correction can be performed
     :rtype: int
     """
@@ -98,9 +99,10 @@ def determine_candidate_frames(candidate_files: list, reference_file: str, njobs
     # Create the folder to dump the ncc images
     ncc_dir = fop.make_dir(pet_folder, "ncc-images")
 
-    # using mpire to run the ncc calculation in parallel
-    with WorkerPool(njobs) as pool:
-        ncc_images = pool.map(calc_voxelwise_ncc_images, [(reference_file, file, ncc_dir) for file in candidate_files])
+    # run the ncc calculation in parallel
+    threads = su.get_threads_per_job(njobs) if threads_per_job is None else threads_per_job
+    su.map_jobs(calc_voxelwise_ncc_images, [(reference_file, file, ncc_dir, threads) for file in candidate_files],
+                njobs, executor=executor)
 
     ncc_images = fop.get_files(ncc_dir, "ncc_*.nii.gz")
 
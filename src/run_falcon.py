@@ -18,26 +18,22 @@
 # Imported Libraries
 
 import argparse
+import contextlib
 import logging
 import os
-import pathlib
-import timeit
 from datetime import datetime
 
-from halo import Halo
-
-import checkArgs
 import constants as c
+import distributed
+import falcon
 import fileOp as fop
-import greedy
-import imageIO
-import imageOp
-import preProcessing as pp
 import sysUtil as su
+import tune
 
 # Initialize Logger
+log_file = datetime.now().strftime('falcon-%H-%M-%d-%m-%Y.log')
 logging.basicConfig(format='%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s', level=logging.INFO,
-                    filename=datetime.now().strftime('falcon-%H-%M-%d-%m-%Y.log'),
+                    filename=log_file,
                     filemode='w')
 
 # Main Function for FALCON Registration script
@@ -80,201 +76,200 @@ if __name__ == "__main__":
         default='100x50x25',
         help="Number of iterations for each resolution level"
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of jobs to run in parallel [default: derived from the RAM and CPUs of this host; with "
+             "--queue_file, all frames are queued at once]"
+    )
+    parser.add_argument(
+        "--skip_inverse_warp",
+        action="store_true",
+        help="Deformable only: do not compute the inverse warps during the run (they can be computed later on demand)"
+    )
+    parser.add_argument(
+        "--warp_shrink_factor",
+        type=int,
+        choices=[1, c.SHRINK_LEVEL_2x, c.SHRINK_LEVEL_4x],
+        default=1,
+        help="Deformable only: store the warps downsampled by this factor"
+    )
+    parser.add_argument(
+        "--warp_16bit",
+        action="store_true",
+        help="Deformable only: store the warps as 16-bit integers"
+    )
+    parser.add_argument(
+        "--triage",
+        action="store_true",
+        help="Skip the registration of frames that did not move (estimated on 8x downsampled images)"
+    )
+    parser.add_argument(
+        "--skip_identity_resample",
+        action="store_true",
+        help="Rigid/affine only: link frames whose transform moves the body by less than "
+             f"{c.RESAMPLE_SKIP_THRESHOLD} voxels into the moco folder instead of resampling them"
+    )
+    parser.add_argument(
+        "--linear_shrink_factor",
+        type=int,
+        choices=[1, c.SHRINK_LEVEL_2x, c.SHRINK_LEVEL_4x, c.SHRINK_LEVEL_8x],
+        default=1,
+        help="Estimate rigid/affine transforms on smoothed images downsampled by this factor (the transforms are "
+             "applied to the original resolution images)"
+    )
+    parser.add_argument(
+        "--initializer",
+        type=str,
+        choices=["image-centers", "phase-correlation", "phase-correlation-rotation"],
+        default="image-centers",
+        help="Initial alignment of the rigid/affine registrations: the image centers, or the shift (and optionally "
+             "rotation) estimated by phase correlation on 4x downsampled frames"
+    )
+    parser.add_argument(
+        "--slabs",
+        type=int,
+        default=1,
+        help="Deformable only: register this many overlapping axial slabs as independent jobs and blend their warps "
+             "(for total-body fields of view)"
+    )
+    parser.add_argument(
+        "--slab_overlap",
+        type=int,
+        default=c.SLAB_OVERLAP,
+        help="Deformable only: number of slices a slab extends into each of its neighbours"
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        help="Decompress upcoming frames into tmpfs and compress the outputs in the background while the registrations "
+             "run"
+    )
+    parser.add_argument(
+        "--io_jobs",
+        type=int,
+        default=2,
+        help="Number of prefetch and of writer threads used with --prefetch"
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Profile written by falcon-tune; its registration type, iterations, linear shrink factor and initializer "
+             "become the defaults of -r, -i, --linear_shrink_factor and --initializer"
+    )
+    parser.add_argument(
+        "--threads_per_job",
+        type=int,
+        default=None,
+        help="Threads of each registration job (greedy -threads, ITK and OpenMP); 0 lets every job use all CPUs "
+             "[default: the available CPUs divided by the number of jobs]"
+    )
+    parser.add_argument(
+        "--pin_cores",
+        action="store_true",
+        help="Pin every worker to its own set of cores, kept within one NUMA node where possible"
+    )
+    parser.add_argument(
+        "--job_history",
+        type=os.path.abspath,
+        default=None,
+        help="JSON file of the registration times of earlier runs, used to register the longest frames first and "
+             "updated after the run; studies of the same protocol can share one [default: job-history.json in the "
+             "moco folder]"
+    )
+    parser.add_argument(
+        "--scratch_dir",
+        type=str,
+        default=None,
+        help="Fast local folder (e.g. NVMe or /dev/shm) to run the pipeline in; only the moco folder is copied back, "
+             "the intermediate files are removed on success and kept on failure"
+    )
+    parser.add_argument(
+        "--link_unregistered",
+        action="store_true",
+        help="Place the frames before the start frame in the moco folder as symbolic links instead of copies (listed "
+             "in moco/symlinks.json)"
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="JSON lines file to write a performance trace (wall time, CPU time and peak RSS of every phase and "
+             "external tool call) to; summarize or export it with perfTrace.py"
+    )
+    parser.add_argument(
+        "--sample_resources",
+        type=float,
+        nargs="?",
+        const=1.0,
+        default=None,
+        metavar="INTERVAL",
+        help="Sample the CPU, memory, disk and IO-wait utilisation every INTERVAL seconds [default: 1] and save the "
+             "samples, tagged with the active phase, and the idle-core time per phase next to the log file"
+    )
+    parser.add_argument(
+        "-q",
+        "--queue_file",
+        type=str,
+        default=None,
+        help="Distribute the frame-level jobs through this queue file on shared storage; they are run by falcon-worker "
+             "processes on any host that sees the same paths. The workers run the pickled jobs of the queue, so keep "
+             "it writable by you only (it is created with mode 600). The queue relies on file locks: avoid NFS "
+             "mounts without a working lock manager"
+    )
+    # The settings of a tuning profile become defaults, so that arguments given explicitly still take precedence
+    known_args, _ = parser.parse_known_args()
+    if known_args.profile:
+        try:
+            parser.set_defaults(**tune.load_profile(known_args.profile))
+        except (OSError, ValueError) as error:
+            print(f"Profile could not be loaded: {error}")
+            exit(1)
     args = parser.parse_args()
 
-    # Capture inputs and check if the input arguments are valid
-
-    working_dir = os.path.abspath(args.main_folder)
-    if not checkArgs.dir_exists(working_dir):
-        logging.error("Main folder does not exist")
-        print("Main folder does not exist")
-        exit(1)
-
-    start_frame = args.start_frame
-    if not checkArgs.is_non_negative(start_frame):
-        logging.error("Start frame must be non-negative")
-        print("Start frame must be non-negative")
-        exit(1)
-
-    registration = args.registration
-
-    multi_resolution_iterations = args.multi_resolution_iterations
-    if checkArgs.is_string_alpha(checkArgs.remove_char(multi_resolution_iterations, 'x')):
-        logging.error("Multi-resolution iterations must be a string of integers separated by 'x'")
-        print("Multi-resolution iterations must be a string of integers separated by 'x'")
-        exit(1)
-
-    # Figure out the number of jobs that can be run in parallel
+    # Capture inputs, the checks of the input arguments are performed by falcon.run
+
+    config = falcon.RunConfig(main_folder=args.main_folder,
+                              reference_frame_index=args.reference_frame_index,
+                              start_frame=None if args.start_frame == 99 else args.start_frame,
+                              registration=args.registration,
+                              multi_resolution_iterations=args.multi_resolution_iterations,
+                              registration_options={'compute_inverse': not args.skip_inverse_warp,
+                                                    'warp_shrink_factor': args.warp_shrink_factor,
+                                                    'warp_16bit': args.warp_16bit,
+                                                    'triage': args.triage,
+                                                    'linear_shrink_factor': args.linear_shrink_factor,
+                                                    'slabs': args.slabs,
+                                                    'slab_overlap': args.slab_overlap,
+                                                    'prefetch': args.prefetch,
+                                                    'io_jobs': args.io_jobs,
+                                                    'job_history': args.job_history,
+                                                    'threads_per_job': args.threads_per_job,
+                                                    'pin_cores': args.pin_cores,
+                                                    'initializer': args.initializer,
+                                                    'skip_identity_resample': args.skip_identity_resample},
+                              njobs=args.jobs,
+                              scratch_dir=args.scratch_dir,
+                              link_unregistered=args.link_unregistered,
+                              trace_file=args.trace)
 
-    num_jobs = 1
-    if registration.__eq__('rigid'):
-        num_jobs = su.get_number_of_possible_jobs(process_memory=c.MINIMUM_RAM_REQUIRED_RIGID,
-                                                  process_threads=c.MINIMUM_THREADS_REQUIRED_RIGID)
-    elif registration.__eq__('affine'):
-        num_jobs = su.get_number_of_possible_jobs(process_memory=c.MINIMUM_RAM_REQUIRED_AFFINE,
-                                                  process_threads=c.MINIMUM_THREADS_REQUIRED_AFFINE)
-    elif registration.__eq__('deformable'):
-        num_jobs = su.get_number_of_possible_jobs(process_memory=c.MINIMUM_RAM_REQUIRED_DEFORMABLE,
-                                                  process_threads=c.MINIMUM_THREADS_REQUIRED_DEFORMABLE)
-    else:
-        logging.error("Registration type not recognized")
-        exit(1)
-
-    reference_frame_index = args.reference_frame_index
-
-    # Start the registration process by performing data checks and then calling the registration function
-
-    logging.info('****************************************************************************************************')
-    logging.info(
-        '                                       STARTING FALCON V.01                                             ')
-    logging.info('****************************************************************************************************')
-    start = timeit.default_timer()
     fop.display_logo_FALCON()
     fop.display_citation()
-    logging.info(' ')
-    logging.info('INPUT ARGUMENTS')
-    logging.info('-----------------')
-    logging.info(' - Working directory: ' + working_dir)
-    logging.info(' - Registration type: ' + registration)
-    logging.info(' - Multi-resolution iterations: ' + multi_resolution_iterations)
-    logging.info(' ')
-    logging.info('SANITY CHECKS AND DATA PREPARATION')
-    logging.info('-----------------------------------')
-    logging.info(' ')
-    print(' ')
-    if num_jobs > 1:
-        logging.info(
-            f"Based on the available RAM and available threads, FALCON will run in parallel with {num_jobs} jobs "
-            f"at a time")
-        print(
-            f"Based on the available RAM and available threads, FALCON will run in parallel with {num_jobs} jobs at a "
-            f"time")
-    else:
-        logging.info("Due to the available RAM and available threads, FALCON will run in serial")
-        print("Due to the available RAM and available threads, FALCON will run in serial")
-    nifti_dir, input_image_type = imageIO.convert_all_non_nifti(working_dir)
-
-    # Check if the nifti files are 3d or 4d
-
-    nifti_files = fop.get_files(nifti_dir, '*nii*')
-    split3d_folder = []
-    if len(nifti_files) == 1:
-        logging.info(f"Number of nifti files: {len(nifti_files)}")
-        img_dimensions = imageOp.get_dimensions(nifti_files[0])
-        if img_dimensions == 3:
-            logging.error('Single 3d nifti file found: Cannot perform motion correction!')
-            print('Single 3d nifti file found: Cannot perform motion correction!')
-            exit(1)
-        elif img_dimensions == 4:
-            logging.info('Type of nifti file : 4d')
-            imageIO.split4d(nifti_files[0], nifti_dir)
-            split3d_folder = (fop.make_dir(nifti_dir, 'split3d'))
-            fop.move_files(nifti_dir, split3d_folder, 'vol*.nii*')
-            logging.info(f"PET files to motion correct are stored here: {split3d_folder}")
-    elif len(nifti_files) > 1:
-        logging.info('Multiple nifti files found, assuming we have 3d nifti files!')
-        split3d_folder = nifti_dir
-        logging.info(f"PET files to motion correct are stored here: {split3d_folder}")
-    else:
-        split3d_folder = []
-        logging.error('No nifti files found: Cannot perform motion correction!')
+    executor = distributed.DistributedExecutor(args.queue_file) if args.queue_file else None
+    sampler = su.ResourceSampler(args.sample_resources) if args.sample_resources else None
+    try:
+        with sampler or contextlib.nullcontext():
+            falcon.run(config, executor=executor)
+    except falcon.FalconError as error:
+        logging.error(str(error))
+        print(str(error))
         exit(1)
-
-    logging.info(' ')
-
-    # Motion correction starts here
-
-    logging.info('MOTION CORRECTION')
-    print('')
-    print("Initiating motion correction...")
-    print()
-    logging.info('--------------------')
-    logging.info('Resampling parameters - Images: Linear interpolation  | Segmentations: Nearest neighbor ')
-    non_moco_files = fop.get_files(split3d_folder, '*nii*')
-
-    # Determine the start frame from which motion correction needs to be performed.
-    if start_frame == 99:
-        logging.info('Starting frame not provided by user! Calculating the starting frame from which motion correction'
-                     ' can be performed')
-        print('Starting frame not provided by user...')
-        reference_frame_for_ncc_calc = non_moco_files[reference_frame_index]
-        candidate_files_for_ncc_calc = non_moco_files[:]
-        candidate_files_for_ncc_calc.remove(reference_frame_for_ncc_calc)
-        spinner = Halo(text='Calculating the starting frame from which motion correction can be performed',
-                       spinner='dots')
-        spinner.start()
-        start_frame = pp.determine_candidate_frames(candidate_files=candidate_files_for_ncc_calc,
-                                                    reference_file=reference_frame_for_ncc_calc,
-                                                    njobs=num_jobs)
-        spinner.succeed(f"Starting frame for motion correction is {start_frame}")
-        logging.info(f'Starting frame index: {start_frame}')
-    else:
-        logging.info(f'Starting frame index: {start_frame}')
-    print(' ')
-
-    # Allocating the fixed and moving frames for motion correction
-
-    moco_dir = fop.make_dir(split3d_folder, 'moco')
-    fixed_img_filename = pathlib.Path(non_moco_files[reference_frame_index]).name
-    fop.copy_files(split3d_folder, moco_dir, non_moco_files[reference_frame_index])
-    os.chdir(moco_dir)
-    os.rename(fixed_img_filename, 'moco-' + fixed_img_filename)
-    reference_img = fop.get_files(moco_dir, '*nii*')[0]
-
-    # Parallelized alignment based on the resources available: Reference image is always the last file in the list
-
-    logging.info(f"Reference image (is fixed): {reference_img}")
-    print(f"Reference image (is fixed): {reference_img}")
-    moving_imgs = []
-    for y in range(start_frame, len(non_moco_files)):
-        moving_imgs.append(non_moco_files[y])
-    # remove the reference image from the moving images list
-    moving_imgs.remove(non_moco_files[reference_frame_index])
-
-    greedy.align(fixed_img=reference_img, moving_imgs=moving_imgs, registration_type=registration,
-                 multi_resolution_iterations=multi_resolution_iterations, njobs=num_jobs, moco_dir=moco_dir)
-    if start_frame != 0:
-        for x in range(0, start_frame):
-            fop.copy_files(split3d_folder, moco_dir, pathlib.Path(non_moco_files[x]).name)
-            logging.info(f"Copying files {pathlib.Path(non_moco_files[x]).name} to {moco_dir}")
-            print(f"Copying files {pathlib.Path(non_moco_files[x]).name} to {moco_dir}")
-            os.chdir(moco_dir)
-            os.rename(pathlib.Path(non_moco_files[x]).name, 'moco-' + pathlib.Path(non_moco_files[x]).name)
-    else:
-        logging.info('No files to copy! Motion correction is being performed from first frame.')
-        print(' ')
-        print('Motion correction is being performed from first frame...')
-
-    # Merge the split 3d motion corrected file into a single 4d file
-
-    imageIO.merge3d(nifti_dir=moco_dir, wild_card='moco-*nii*', nifti_outfile='4d-moco.nii.gz')
-    logging.info(f"Merged 3d motion corrected files into a single 4d file: {os.path.join(moco_dir, '4d-moco.nii.gz')}")
-    print(f"Merged 3d motion corrected files into a single 4d file: {os.path.join(moco_dir, '4d-moco.nii.gz')}")
-
-    # Clean up measures: Moving the generated transform files to the 'transform' folder for subsequent use.
-
-    transform_dir = fop.make_dir(moco_dir, 'transforms')
-    if registration == 'rigid':
-        fop.move_files(src_dir=split3d_folder, dest_dir=transform_dir, wildcard='*rigid*.mat')
-        logging.info(f"Moved rigid transform files to {transform_dir}")
-        print(f"Moved rigid transform files to {transform_dir}")
-    elif registration == 'affine':
-        fop.move_files(src_dir=split3d_folder, dest_dir=transform_dir, wildcard='*affine*.mat')
-        logging.info(f"Moved affine transform files to {transform_dir}")
-        print(f"Moved affine transform files to {transform_dir}")
-    elif registration == 'deformable':
-        fop.move_files(src_dir=split3d_folder, dest_dir=transform_dir, wildcard='*affine*.mat')
-        fop.move_files(src_dir=split3d_folder, dest_dir=transform_dir, wildcard='*warp*.nii.gz')
-        logging.info(f"Moved deformable warp files to {transform_dir}")
-        print(f"Moved deformable warp files to {transform_dir}")
-    else:
-        logging.info('No transform files to move!')
-        print('No transform files to move!')
-
-    stop = timeit.default_timer()
-    logging.info(' ')
-    logging.info('MOTION CORRECTION DONE!')
-    print('MOTION CORRECTION DONE!')
-    logging.info(f"Total time taken for motion correction: {(stop - start) / 60:.2f} minutes")
-    print(f"Total time taken for motion correction: {(stop - start) / 60:.2f} minutes")
-    logging.info(' ')
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if sampler is not None:
+            summary_file = sampler.save(os.path.splitext(log_file)[0] + '-resources.csv')
+            logging.info(f"Resource samples saved next to {log_file}, summary per phase: {summary_file}")
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: run_falcon_apply.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: Applies the transforms stored by a finished FALCON run (moco/transforms) to new images or label maps,
+# e.g. to propagate an atlas or a ROI set without repeating the registration.
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+# Imported Libraries
+
+import argparse
+import logging
+import os
+import timeit
+from datetime import datetime
+
+import checkArgs
+import constants as c
+import fileOp as fop
+import greedy
+import sysUtil as su
+
+# Initialize Logger
+logging.basicConfig(format='%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s', level=logging.INFO,
+                    filename=datetime.now().strftime('falcon-apply-%H-%M-%d-%m-%Y.log'),
+                    filemode='w')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-m",
+        "--moco_folder",
+        type=str,
+        help="moco folder of a finished FALCON run",
+        required=True,
+    )
+    parser.add_argument(
+        "-i",
+        "--images",
+        type=str,
+        nargs='+',
+        help="image(s) to transform: a single image in reference space (e.g. an atlas or a CT aligned to the "
+             "reference frame) is mapped into the space of every frame, otherwise one image per frame (in frame "
+             "order, all frames of the study) is mapped onto the reference",
+        required=True,
+    )
+    parser.add_argument(
+        "-o",
+        "--output_folder",
+        type=str,
+        help="folder where the transformed images will be stored",
+        required=True,
+    )
+    parser.add_argument(
+        "-t",
+        "--transform_folder",
+        type=str,
+        default=None,
+        help="folder containing the transforms [default: <moco_folder>/transforms]",
+    )
+    parser.add_argument(
+        "-f",
+        "--frame_folder",
+        type=str,
+        default=None,
+        help="folder containing the 3d frames of the study [default: the parent folder of the moco folder]",
+    )
+    parser.add_argument(
+        "-ref",
+        "--reference_image",
+        type=str,
+        default=None,
+        help="image that defines the output grid [default: first motion corrected frame in the moco folder]",
+    )
+    parser.add_argument(
+        "-r",
+        "--registration",
+        type=str,
+        choices=["rigid", "affine", "deformable"],
+        default=None,
+        help="Type of transforms to apply: rigid | affine | deformable [default: inferred from the transforms]"
+    )
+    parser.add_argument(
+        "-ri",
+        "--interpolation",
+        type=str,
+        choices=["LINEAR", "NN", "LABEL"],
+        default='LINEAR',
+        help="Interpolation: LINEAR | NN | LABEL (use LABEL for segmentations and atlases)"
+    )
+    parser.add_argument(
+        "--invert_warps",
+        action="store_true",
+        help="Deformable only: compute the inverse warps of runs that skipped them (--skip_inverse_warp); they are "
+             "needed to map a single reference-space image into the space of every frame"
+    )
+    args = parser.parse_args()
+
+    moco_dir = os.path.abspath(args.moco_folder)
+    if not checkArgs.dir_exists(moco_dir):
+        logging.error("Moco folder does not exist")
+        print("Moco folder does not exist")
+        exit(1)
+
+    transform_dir = os.path.abspath(args.transform_folder) if args.transform_folder else \
+        os.path.join(moco_dir, 'transforms')
+    if not checkArgs.dir_exists(transform_dir):
+        logging.error("Transform folder does not exist")
+        print("Transform folder does not exist")
+        exit(1)
+
+    images = [os.path.abspath(image) for image in args.images]
+    for image in images:
+        if not os.path.isfile(image):
+            logging.error(f"Image {image} does not exist")
+            print(f"Image {image} does not exist")
+            exit(1)
+
+    if args.reference_image:
+        reference_img = os.path.abspath(args.reference_image)
+    else:
+        reference_img = fop.get_files(moco_dir, c.MOCO_FILE_PATTERN)[0]
+
+    frame_dir = os.path.abspath(args.frame_folder) if args.frame_folder else os.path.dirname(moco_dir)
+    frames = fop.get_files(frame_dir, '*nii*')
+    if not frames:
+        logging.error(f"No frames found in {frame_dir}")
+        print(f"No frames found in {frame_dir}")
+        exit(1)
+
+    registration = args.registration if args.registration else greedy.get_registration_type(transform_dir)
+    output_dir = os.path.abspath(args.output_folder)
+    os.makedirs(output_dir, exist_ok=True)
+
+    start = timeit.default_timer()
+    fop.display_logo_FALCON()
+    fop.display_citation()
+    logging.info(' ')
+    logging.info('INPUT ARGUMENTS')
+    logging.info('-----------------')
+    logging.info(' - Moco directory: ' + moco_dir)
+    logging.info(' - Transform directory: ' + transform_dir)
+    logging.info(' - Frame directory: ' + frame_dir)
+    logging.info(' - Reference image: ' + reference_img)
+    logging.info(' - Registration type: ' + registration)
+    logging.info(' - Interpolation: ' + args.interpolation)
+    logging.info(' ')
+
+    frame_transforms = greedy.get_frame_transforms(transform_dir, registration)
+    if not frame_transforms:
+        logging.error(f"No {registration} transforms found in {transform_dir}")
+        print(f"No {registration} transforms found in {transform_dir}")
+        exit(1)
+
+    if args.invert_warps and registration == 'deformable' and len(images) == 1:
+        for frame, transform_files in frame_transforms.items():
+            if len(transform_files) < 2:
+                # Frames triaged as motionless have no warp
+                continue
+            inverse_warp_file = os.path.join(transform_dir, f"{frame}_inverse_warp.nii.gz")
+            if not os.path.exists(inverse_warp_file):
+                print(f"Computing inverse warp of {frame}")
+                greedy.invert_warp(fixed_img=reference_img, warp_file=transform_files[0],
+                                   inverse_warp_file=inverse_warp_file)
+
+    num_jobs = su.get_number_of_possible_jobs(process_memory=c.MINIMUM_RAM_REQUIRED_RIGID,
+                                              process_threads=c.MINIMUM_THREADS_REQUIRED_RIGID)
+    print(f"Applying {registration} transforms of {len(frame_transforms)} of {len(frames)} frames (identity for the "
+          f"others) to {len(images)} image(s) with {num_jobs} jobs at a time")
+    try:
+        greedy.apply_all(fixed_img=reference_img, frame_transforms=frame_transforms, frames=frames, images=images,
+                         out_dir=output_dir, interpolation=args.interpolation, njobs=num_jobs)
+    except (ValueError, FileNotFoundError) as error:
+        logging.error(str(error))
+        print(str(error))
+        exit(1)
+
+    stop = timeit.default_timer()
+    logging.info(f"Transformed images are stored in {output_dir}")
+    print(f"Transformed images are stored in {output_dir}")
+    logging.info(f"Total time taken for applying the transforms: {(stop - start) / 60:.2f} minutes")
+    print(f"Total time taken for applying the transforms: {(stop - start) / 60:.2f} minutes")
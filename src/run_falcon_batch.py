@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: run_falcon_batch.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: Motion corrects a cohort of studies with one global, resource-aware worker pool, so that the serial
+# phases of one study overlap with the registrations of the others.
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+# Imported Libraries
+
+import argparse
+import contextlib
+import logging
+import os
+import timeit
+from datetime import datetime
+
+import constants as c
+import falcon
+import fileOp as fop
+import sysUtil as su
+import tune
+
+if __name__ == "__main__":
+    # Initialize Logger (only in the main process: the workers are started with 'forkserver' and import this module)
+    log_file = os.path.abspath(datetime.now().strftime('falcon-batch-%H-%M-%d-%m-%Y.log'))
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                        level=logging.INFO, filename=log_file, filemode='w')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-m",
+        "--main_folders",
+        type=str,
+        nargs='+',
+        help="study folders containing the images to motion correct",
+        required=True,
+    )
+    parser.add_argument(
+        "-rf",
+        "--reference_frame_index",
+        type=int,
+        default=-1,
+        help="index of the reference frame [index starts from 0]",
+    )
+    parser.add_argument(
+        "-sf",
+        "--start_frame",
+        type=int,
+        default=99,
+        help="frame from which the motion correction will be performed"
+    )
+    parser.add_argument(
+        "-r",
+        "--registration",
+        type=str,
+        choices=["rigid", "affine", "deformable"],
+        default='affine',
+        help="Type of registration: rigid | affine | deformable"
+    )
+    parser.add_argument(
+        "-i",
+        "--multi_resolution_iterations",
+        type=str,
+        default='100x50x25',
+        help="Number of iterations for each resolution level"
+    )
+    parser.add_argument(
+        "--scratch_dir",
+        type=str,
+        default=None,
+        help="Fast local folder (e.g. NVMe or /dev/shm) to run the pipeline in; only the moco folder is copied back, "
+             "the intermediate files are removed on success and kept on failure"
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="JSON lines file to write a performance trace of all studies and workers to"
+    )
+    parser.add_argument(
+        "--sample_resources",
+        type=float,
+        nargs="?",
+        const=1.0,
+        default=None,
+        metavar="INTERVAL",
+        help="Sample the CPU, memory, disk and IO-wait utilisation every INTERVAL seconds [default: 1] and save the "
+             "samples, tagged with the active phases, and the idle-core time per phase next to the log file"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of workers of the global pool [default: derived from the available RAM and threads]"
+    )
+    parser.add_argument(
+        "-cs",
+        "--concurrent_studies",
+        type=int,
+        default=2,
+        help="Number of studies that are processed at the same time"
+    )
+    parser.add_argument(
+        "--triage",
+        action="store_true",
+        help="Skip the registration of frames that did not move (estimated on 8x downsampled images)"
+    )
+    parser.add_argument(
+        "--skip_identity_resample",
+        action="store_true",
+        help="Rigid/affine only: link frames whose transform moves the body by less than "
+             f"{c.RESAMPLE_SKIP_THRESHOLD} voxels into the moco folder instead of resampling them"
+    )
+    parser.add_argument(
+        "--linear_shrink_factor",
+        type=int,
+        choices=[1, c.SHRINK_LEVEL_2x, c.SHRINK_LEVEL_4x, c.SHRINK_LEVEL_8x],
+        default=1,
+        help="Estimate rigid/affine transforms on smoothed images downsampled by this factor"
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Profile written by falcon-tune; its registration type, iterations, linear shrink factor and initializer "
+             "become the defaults of -r, -i, --linear_shrink_factor and --initializer"
+    )
+    parser.add_argument(
+        "--threads_per_job",
+        type=int,
+        default=None,
+        help="Threads of each registration job (greedy -threads, ITK and OpenMP); 0 lets every job use all CPUs "
+             "[default: the available CPUs divided by the number of jobs]"
+    )
+    parser.add_argument(
+        "--pin_cores",
+        action="store_true",
+        help="Pin every worker to its own set of cores, kept within one NUMA node where possible"
+    )
+    parser.add_argument(
+        "--initializer",
+        type=str,
+        choices=["image-centers", "phase-correlation", "phase-correlation-rotation"],
+        default="image-centers",
+        help="Initial alignment of the rigid/affine registrations: the image centers, or the shift (and optionally "
+             "rotation) estimated by phase correlation on 4x downsampled frames"
+    )
+    parser.add_argument(
+        "--job_history",
+        type=os.path.abspath,
+        default=None,
+        help="JSON file of the registration times of earlier runs, used to register the longest frames first and "
+             "updated after the run; studies of the same protocol can share one [default: job-history.json in the "
+             "moco folder]"
+    )
+    # The settings of a tuning profile become defaults, so that arguments given explicitly still take precedence
+    known_args, _ = parser.parse_known_args()
+    if known_args.profile:
+        try:
+            parser.set_defaults(**tune.load_profile(known_args.profile))
+        except (OSError, ValueError) as error:
+            print(f"Profile could not be loaded: {error}")
+            exit(1)
+    args = parser.parse_args()
+
+    configs = [falcon.RunConfig(main_folder=main_folder,
+                                reference_frame_index=args.reference_frame_index,
+                                start_frame=None if args.start_frame == 99 else args.start_frame,
+                                registration=args.registration,
+                                multi_resolution_iterations=args.multi_resolution_iterations,
+                                registration_options={'triage': args.triage,
+                                                      'linear_shrink_factor': args.linear_shrink_factor,
+                                                      'job_history': args.job_history,
+                                                      'threads_per_job': args.threads_per_job,
+                                                      'pin_cores': args.pin_cores,
+                                                      'initializer': args.initializer,
+                                                      'skip_identity_resample': args.skip_identity_resample},
+                                scratch_dir=args.scratch_dir)
+               for main_folder in args.main_folders]
+
+    fop.display_logo_FALCON()
+    fop.display_citation()
+    start = timeit.default_timer()
+    sampler = su.ResourceSampler(args.sample_resources) if args.sample_resources else None
+    with sampler or contextlib.nullcontext():
+        results = falcon.run_batch(configs, njobs=args.jobs, concurrent_studies=args.concurrent_studies,
+                                   log_file=log_file, trace_file=args.trace)
+    if sampler is not None:
+        summary_file = sampler.save(os.path.splitext(log_file)[0] + '-resources.csv')
+        logging.info(f"Resource samples saved next to {log_file}, summary per phase: {summary_file}")
+    stop = timeit.default_timer()
+
+    print(' ')
+    failed_studies = 0
+    for config, result in zip(configs, results):
+        if isinstance(result, falcon.RunResult):
+            print(f"Done   | {config.main_folder} | {result.timings['total'] / 60:.2f} minutes")
+        else:
+            failed_studies += 1
+            print(f"Failed | {config.main_folder} | {result}")
+    logging.info(f"Total time taken for the batch of {len(configs)} studies: {(stop - start) / 60:.2f} minutes")
+    print(f"Total time taken for the batch of {len(configs)} studies: {(stop - start) / 60:.2f} minutes")
+    if failed_studies:
+        exit(1)
@@ -19,7 +19,7 @@
 # Imports
 import imageOp
 import os
-import subprocess
+import falcon
 import fileOp
 import argparse
 import constants
@@ -147,13 +147,16 @@ if __name__ == '__main__':
         # run FALCON on reference frame folder
         spinner = Halo(text=f"Running FALCON on {prepared_reference_frame_folder_path}", spinner='dots')
         spinner.start()
-        FALCON_reference = f"falcon " \
-                           f"-m {prepared_reference_frame_folder_path} " \
-                           f"-rf -1 " \
-                           f"-sf 0 " \
-                           f"-r {registration} " \
-                           f"-i {multi_resolution_iterations}"
-        subprocess.run(FALCON_reference, shell=True, capture_output=True)
+        try:
+            falcon.run(falcon.RunConfig(main_folder=prepared_reference_frame_folder_path,
+                                        reference_frame_index=-1,
+                                        start_frame=0,
+                                        registration=registration,
+                                        multi_resolution_iterations=multi_resolution_iterations))
+        except falcon.FalconError as error:
+            spinner.fail(text=f"FALCON failed on the reference frames.")
+            print(str(error))
+            exit(1)
         spinner.succeed(text=f"FALCON successfully performed motion correction on reference frames.")
 
         # sum reference frame and move to sequence folder
@@ -171,13 +174,16 @@ if __name__ == '__main__':
     # run FALCON on sequence folder
     spinner = Halo(text=f"Running FALCON on {sequence_frames_directory}", spinner='dots')
     spinner.start()
-    FALCON_sequence = f"falcon " \
-                      f"-m {sequence_frames_directory} " \
-                      f"-rf -1 " \
-                      f"-sf 0 " \
-                      f"-r {registration} " \
-                      f"-i {multi_resolution_iterations}"
-    subprocess.run(FALCON_sequence, shell=True, capture_output=True)
+    try:
+        falcon.run(falcon.RunConfig(main_folder=sequence_frames_directory,
+                                    reference_frame_index=-1,
+                                    start_frame=0,
+                                    registration=registration,
+                                    multi_resolution_iterations=multi_resolution_iterations))
+    except falcon.FalconError as error:
+        spinner.fail(text=f"FALCON failed on the sequence frames.")
+        print(str(error))
+        exit(1)
     spinner.succeed(text=f"FALCON successfully performed motion correction on sequence frames.")
 
     corrected_frames = fileOp.get_files(os.path.join(sequence_frames_directory, "moco"), constants.MOCO_FILE_PATTERN)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: run_falcon_server.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: Starts a long-running FALCON server on a spool directory, and submits studies to it, reports its status
+# or stops it (local client).
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+# Imported Libraries
+
+import argparse
+import json
+import logging
+import os
+from datetime import datetime
+
+import constants as c
+import falcon
+import fileOp as fop
+import server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help="run the server until it is stopped")
+    serve_parser.add_argument("-s", "--spool_folder", type=str, required=True,
+                              help="spool folder the jobs are submitted to")
+    serve_parser.add_argument("-j", "--jobs", type=int, default=None,
+                              help="Number of workers of the warm pool [default: derived from the available RAM and "
+                                   "threads]")
+    serve_parser.add_argument("-cs", "--concurrent_studies", type=int, default=2,
+                              help="Number of studies that are processed at the same time")
+    serve_parser.add_argument("-p", "--poll_interval", type=float, default=2.0,
+                              help="time between two polls of the queue in seconds")
+
+    submit_parser = subparsers.add_parser('submit', help="submit a study to a running server")
+    submit_parser.add_argument("-s", "--spool_folder", type=str, required=True,
+                               help="spool folder of the server")
+    submit_parser.add_argument("-m", "--main_folder", type=str, required=True,
+                               help="path containing the images to motion correct")
+    submit_parser.add_argument("-rf", "--reference_frame_index", type=int, default=-1,
+                               help="index of the reference frame [index starts from 0]")
+    submit_parser.add_argument("-sf", "--start_frame", type=int, default=99,
+                               help="frame from which the motion correction will be performed")
+    submit_parser.add_argument("-r", "--registration", type=str, choices=["rigid", "affine", "deformable"],
+                               default='affine', help="Type of registration: rigid | affine | deformable")
+    submit_parser.add_argument("-i", "--multi_resolution_iterations", type=str, default='100x50x25',
+                               help="Number of iterations for each resolution level")
+    submit_parser.add_argument("--triage", action="store_true",
+                               help="Skip the registration of frames that did not move")
+    submit_parser.add_argument("--linear_shrink_factor", type=int,
+                               choices=[1, c.SHRINK_LEVEL_2x, c.SHRINK_LEVEL_4x, c.SHRINK_LEVEL_8x], default=1,
+                               help="Estimate rigid/affine transforms on smoothed images downsampled by this factor")
+    submit_parser.add_argument("-pr", "--priority", type=int, default=0,
+                               help="priority of the study, studies with a higher priority are processed first")
+    submit_parser.add_argument("-w", "--wait", action="store_true",
+                               help="wait until the study is motion corrected")
+
+    status_parser = subparsers.add_parser('status', help="report the status of a server")
+    status_parser.add_argument("-s", "--spool_folder", type=str, required=True,
+                               help="spool folder of the server")
+
+    stop_parser = subparsers.add_parser('stop', help="stop a server once its running studies are finished")
+    stop_parser.add_argument("-s", "--spool_folder", type=str, required=True,
+                             help="spool folder of the server")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        # Initialize Logger (only in the main process: the workers are started with 'forkserver')
+        log_file = os.path.abspath(datetime.now().strftime('falcon-server-%H-%M-%d-%m-%Y.log'))
+        logging.basicConfig(format='%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                            level=logging.INFO, filename=log_file, filemode='w')
+        fop.display_logo_FALCON()
+        fop.display_citation()
+        server.serve(spool_dir=args.spool_folder, njobs=args.jobs, concurrent_studies=args.concurrent_studies,
+                     poll_interval=args.poll_interval, log_file=log_file)
+
+    elif args.command == 'submit':
+        config = falcon.RunConfig(main_folder=args.main_folder,
+                                  reference_frame_index=args.reference_frame_index,
+                                  start_frame=None if args.start_frame == 99 else args.start_frame,
+                                  registration=args.registration,
+                                  multi_resolution_iterations=args.multi_resolution_iterations,
+                                  registration_options={'triage': args.triage,
+                                                        'linear_shrink_factor': args.linear_shrink_factor})
+        try:
+            falcon.check_config(config)
+        except falcon.FalconError as error:
+            print(str(error))
+            exit(1)
+        job_id = server.submit(args.spool_folder, config, priority=args.priority)
+        print(f"Submitted job {job_id}")
+        if args.wait:
+            job = server.wait_for_job(os.path.abspath(args.spool_folder), job_id)
+            if 'error' in job:
+                print(f"Job {job_id} failed: {job['error']}")
+                exit(1)
+            print(f"Job {job_id} done: {job['result']['moco_4d_file']}")
+
+    elif args.command == 'status':
+        status = server.get_status(os.path.abspath(args.spool_folder))
+        if not status:
+            print(f"No FALCON server ever ran on {args.spool_folder}")
+            exit(1)
+        print(json.dumps(status, indent=4))
+
+    elif args.command == 'stop':
+        server.request_stop(os.path.abspath(args.spool_folder))
+        print("The server will stop once its running studies are finished")
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: run_falcon_stream.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: Online motion correction of the frames of a dynamic PET acquisition while they are reconstructed.
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+# Imported Libraries
+
+import argparse
+import logging
+import os
+from datetime import datetime
+
+import falcon
+import fileOp as fop
+import streaming
+
+if __name__ == "__main__":
+    # Initialize Logger (only in the main process: the workers are started with 'forkserver' and import this module)
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                        level=logging.INFO,
+                        filename=os.path.abspath(datetime.now().strftime('falcon-stream-%H-%M-%d-%m-%Y.log')),
+                        filemode='w')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-m",
+        "--frame_folder",
+        type=str,
+        help="folder the reconstructed 3D nifti frames are written to",
+        required=True,
+    )
+    parser.add_argument(
+        "-ref",
+        "--reference_image",
+        type=str,
+        default=None,
+        help="provisional or late reference on the grid of the frames [default: first frame of the acquisition]",
+    )
+    parser.add_argument(
+        "-sf",
+        "--start_frame",
+        type=int,
+        default=0,
+        help="frame from which the motion correction will be performed"
+    )
+    parser.add_argument(
+        "-r",
+        "--registration",
+        type=str,
+        choices=["rigid", "affine", "deformable"],
+        default='affine',
+        help="Type of registration: rigid | affine | deformable"
+    )
+    parser.add_argument(
+        "-i",
+        "--multi_resolution_iterations",
+        type=str,
+        default='100x50x25',
+        help="Number of iterations for each resolution level"
+    )
+    parser.add_argument(
+        "-n",
+        "--num_frames",
+        type=int,
+        default=None,
+        help="number of frames of the acquisition"
+    )
+    parser.add_argument(
+        "-p",
+        "--poll_interval",
+        type=float,
+        default=5.0,
+        help="time between two polls of the frame folder in seconds"
+    )
+    parser.add_argument(
+        "-t",
+        "--idle_timeout",
+        type=float,
+        default=None,
+        help=f"time in seconds without new frames after which the acquisition is considered done (the acquisition "
+             f"also ends after --num_frames frames or when a '{streaming.END_OF_ACQUISITION_FILE}' file appears)"
+    )
+    args = parser.parse_args()
+
+    if args.num_frames is None and args.idle_timeout is None:
+        print(f"Without --num_frames or --idle_timeout, the acquisition ends when a "
+              f"'{streaming.END_OF_ACQUISITION_FILE}' file appears in {args.frame_folder}")
+
+    fop.display_logo_FALCON()
+    fop.display_citation()
+    try:
+        streaming.stream(frame_dir=args.frame_folder, reference_image=args.reference_image,
+                         registration=args.registration, multi_resolution_iterations=args.multi_resolution_iterations,
+                         start_frame=args.start_frame, num_frames=args.num_frames, poll_interval=args.poll_interval,
+                         idle_timeout=args.idle_timeout)
+    except falcon.FalconError as error:
+        logging.error(str(error))
+        print(str(error))
+        exit(1)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: run_falcon_tune.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: falcon-tune: finds the cheapest iteration schedule and linear shrink level of a protocol within an
+# accuracy tolerance and saves them as a profile for falcon --profile and falcon-batch --profile.
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+# Imported Libraries
+
+import argparse
+import logging
+import os
+from datetime import datetime
+
+import constants as c
+import tune
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-m",
+        "--input",
+        type=str,
+        help="folder of 3d NIfTI frames (e.g. the split3d folder of an earlier run) or 4d NIfTI file of a study of the "
+             "protocol",
+        required=True,
+    )
+    parser.add_argument(
+        "-r",
+        "--registration",
+        type=str,
+        choices=["rigid", "affine", "deformable"],
+        default='affine',
+        help="Type of registration: rigid | affine | deformable"
+    )
+    parser.add_argument(
+        "-o",
+        "--profile",
+        type=str,
+        help="JSON file to save the profile to",
+        required=True,
+    )
+    parser.add_argument(
+        "-rf",
+        "--reference_frame_index",
+        type=int,
+        default=-1,
+        help="index of the reference frame [index starts from 0]",
+    )
+    parser.add_argument(
+        "-sf",
+        "--start_frame",
+        type=int,
+        default=0,
+        help="first frame that is motion corrected in the production runs"
+    )
+    parser.add_argument(
+        "-n",
+        "--num_frames",
+        type=int,
+        default=c.TUNE_NUM_FRAMES,
+        help="number of frames to tune on"
+    )
+    parser.add_argument(
+        "-s",
+        "--schedules",
+        type=str,
+        nargs='+',
+        default=c.TUNE_SCHEDULES,
+        help="candidate iteration schedules"
+    )
+    parser.add_argument(
+        "--shrink_levels",
+        type=int,
+        nargs='+',
+        choices=[1, c.SHRINK_LEVEL_2x, c.SHRINK_LEVEL_4x, c.SHRINK_LEVEL_8x],
+        default=c.TUNE_SHRINK_LEVELS,
+        help="candidate linear shrink levels"
+    )
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        type=float,
+        default=c.TUNE_TOLERANCE,
+        help="largest accepted RMS difference to the reference registration, relative to the intensity range"
+    )
+    parser.add_argument(
+        "--initializer",
+        type=str,
+        choices=["image-centers", "phase-correlation", "phase-correlation-rotation"],
+        default="image-centers",
+        help="Initial alignment of the rigid/affine registrations: the image centers, or the shift (and optionally "
+             "rotation) estimated by phase correlation on 4x downsampled frames"
+    )
+    parser.add_argument(
+        "--threads_per_job",
+        type=int,
+        default=None,
+        help="threads of each registration, set it to the thread budget of the production runs"
+    )
+    parser.add_argument(
+        "-d",
+        "--work_dir",
+        type=str,
+        default=None,
+        help="folder for the intermediate files [default: a temporary folder that is removed afterwards]"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                        level=logging.INFO, filename=datetime.now().strftime('falcon-tune-%H-%M-%d-%m-%Y.log'),
+                        filemode='w')
+
+    if not os.path.exists(args.input):
+        print("Input does not exist")
+        exit(1)
+    profile = tune.tune(args.input, args.registration, reference_frame_index=args.reference_frame_index,
+                        start_frame=args.start_frame, num_frames=args.num_frames, schedules=args.schedules,
+                        shrink_levels=args.shrink_levels, tolerance=args.tolerance,
+                        threads_per_job=args.threads_per_job, work_dir=args.work_dir,
+                        initializer=args.initializer)
+    tune.save_profile(profile, args.profile)
+    print(' ')
+    print(f"Recommended for {profile['registration']} registration: -i {profile['multi_resolution_iterations']} "
+          f"--linear_shrink_factor {profile['linear_shrink_factor']} --initializer {profile['initializer']} | "
+          f"{profile['recommended_s']:.2f} s per frame "
+          f"instead of {profile['reference_s']:.2f} s with {profile['reference_iterations']}")
+    print(f"Profile saved to {args.profile}, use it with falcon --profile {args.profile}")
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: run_falcon_worker.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: Worker of a distributed FALCON run: claims the frame-level jobs of a shared queue and runs them. Start
+# as many workers as the hosts allow; they can join and leave while the driver (falcon -q) is running.
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+# Imported Libraries
+
+import argparse
+import logging
+import os
+import socket
+from datetime import datetime
+
+import distributed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-q",
+        "--queue_file",
+        type=str,
+        help="queue file on storage shared with the driver; its jobs are unpickled and run, so it must only be "
+             "writable by you (the worker refuses it otherwise) and lie on a file system with working file locks",
+        required=True,
+    )
+    parser.add_argument(
+        "-l",
+        "--lease_time",
+        type=float,
+        default=distributed.LEASE_TIME,
+        help="time in seconds a claimed job belongs to this worker without a heartbeat"
+    )
+    parser.add_argument(
+        "-t",
+        "--idle_timeout",
+        type=float,
+        default=None,
+        help="time in seconds with an empty queue after which the worker stops [default: run until killed]"
+    )
+    parser.add_argument(
+        "-n",
+        "--max_jobs",
+        type=int,
+        default=None,
+        help="number of jobs after which the worker stops"
+    )
+    args = parser.parse_args()
+
+    # Initialize Logger (one log file per worker, as several workers can share a folder)
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                        level=logging.INFO,
+                        filename=datetime.now().strftime(f"falcon-worker-{socket.gethostname()}-{os.getpid()}-"
+                                                         f"%H-%M-%d-%m-%Y.log"),
+                        filemode='w')
+
+    if not os.path.isdir(os.path.dirname(os.path.abspath(args.queue_file))):
+        print("Folder of the queue file does not exist")
+        exit(1)
+    try:
+        num_jobs = distributed.work(queue_file=args.queue_file, lease_time=args.lease_time,
+                                    idle_timeout=args.idle_timeout, max_tasks=args.max_jobs)
+    except PermissionError as error:
+        print(error)
+        exit(1)
+    print(f"Worker finished {num_jobs} jobs")
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: server.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: Long-running FALCON server. Jobs are submitted through a spool directory and processed by priority in
+# one warm process with one warm worker pool, so that small studies do not pay for process startup and cold imports.
+# Only the process, the pool and the imported modules stay warm: caches, downscaled images and reference data belong
+# to a study and are not kept between studies.
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+# Imported Libraries
+
+import dataclasses
+import glob
+import importlib
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import falcon
+import sysUtil as su
+
+# Layout of the spool directory
+INCOMING_DIR = 'incoming'
+RUNNING_DIR = 'running'
+DONE_DIR = 'done'
+FAILED_DIR = 'failed'
+STATUS_FILE = 'status.json'
+STOP_FILE = 'STOP'
+
+# Modules every worker of the server imports once at startup instead of once per job
+PRELOAD_MODULES = ['numpy', 'SimpleITK', 'nibabel', 'greedy', 'imageOp', 'preProcessing']
+
+# Times a job is started before it is failed; a job that was running when the server died is started again, so a job
+# that keeps killing the server would otherwise bring it down on every start
+MAX_JOB_STARTS = 2
+
+# Fields every job file must have
+JOB_FIELDS = ('job_id', 'priority', 'submitted', 'config')
+
+
+def init_spool_dir(spool_dir: str) -> str:
+    """
+    Creates the folders of a spool directory
+    :param spool_dir: Spool directory of the server
+    :return: Absolute path of the spool directory
+    """
+    spool_dir = os.path.abspath(spool_dir)
+    for queue_dir in (INCOMING_DIR, RUNNING_DIR, DONE_DIR, FAILED_DIR):
+        os.makedirs(os.path.join(spool_dir, queue_dir), exist_ok=True)
+    return spool_dir
+
+
+def write_json(json_file: str, content: dict) -> None:
+    """
+    Writes a JSON file atomically, so that readers never see a partially written file
+    :param json_file: Path of the JSON file
+    :param content: Content to write
+    :return: None
+    """
+    tmp_file = f"{json_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as json_out:
+        json.dump(content, json_out, indent=4)
+    os.replace(tmp_file, json_file)
+
+
+def read_json(json_file: str) -> dict:
+    """
+    Reads a JSON file
+    :param json_file: Path of the JSON file
+    :return: Content of the file
+    """
+    with open(json_file, 'r') as json_in:
+        return json.load(json_in)
+
+
+# Client side
+
+
+def submit(spool_dir: str, config: falcon.RunConfig, priority: int = 0) -> str:
+    """
+    Submits a study to a FALCON server
+    :param spool_dir: Spool directory of the server
+    :param config: Configuration of the run
+    :param priority: Priority of the study, studies with a higher priority are processed first
+    :return: Id of the job
+    """
+    spool_dir = init_spool_dir(spool_dir)
+    job_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    config = dataclasses.replace(config, main_folder=os.path.abspath(config.main_folder))
+    job = {'job_id': job_id, 'priority': priority, 'submitted': time.time(), 'config': dataclasses.asdict(config)}
+    write_json(os.path.join(spool_dir, INCOMING_DIR, f"{job_id}.json"), job)
+    logging.info(f"Submitted {config.main_folder} as job {job_id} with priority {priority}")
+    return job_id
+
+
+def get_job_state(spool_dir: str, job_id: str) -> str:
+    """
+    Gets the state of a job
+    :param spool_dir: Spool directory of the server
+    :param job_id: Id of the job
+    :return: 'queued', 'running', 'done', 'failed' or 'unknown'
+    """
+    states = {INCOMING_DIR: 'queued', RUNNING_DIR: 'running', DONE_DIR: 'done', FAILED_DIR: 'failed'}
+    for queue_dir, state in states.items():
+        if os.path.exists(os.path.join(spool_dir, queue_dir, f"{job_id}.json")):
+            return state
+    return 'unknown'
+
+
+def wait_for_job(spool_dir: str, job_id: str, poll_interval: float = 2.0, timeout: float = None) -> dict:
+    """
+    Waits until a job is finished
+    :param spool_dir: Spool directory of the server
+    :param job_id: Id of the job
+    :param poll_interval: Time between two checks in seconds
+    :param timeout: Optional maximum waiting time in seconds
+    :return: Finished job, including its 'result' or 'error'
+    """
+    start = time.time()
+    while True:
+        state = get_job_state(spool_dir, job_id)
+        if state in ('done', 'failed'):
+            return read_json(os.path.join(spool_dir, DONE_DIR if state == 'done' else FAILED_DIR, f"{job_id}.json"))
+        if timeout is not None and time.time() - start > timeout:
+            raise TimeoutError(f"Job {job_id} is still {state} after {timeout} s")
+        time.sleep(poll_interval)
+
+
+def get_status(spool_dir: str) -> dict:
+    """
+    Reads the status the server reports
+    :param spool_dir: Spool directory of the server
+    :return: Status of the server, empty if no server ever ran on this spool directory
+    """
+    status_file = os.path.join(spool_dir, STATUS_FILE)
+    return read_json(status_file) if os.path.exists(status_file) else {}
+
+
+def request_stop(spool_dir: str) -> None:
+    """
+    Asks the server to stop once the running studies are finished
+    :param spool_dir: Spool directory of the server
+    :return: None
+    """
+    open(os.path.join(spool_dir, STOP_FILE), 'w').close()
+
+
+# Server side
+
+
+def warm_up_worker(modules: list) -> int:
+    """
+    Imports the given modules in a worker, so that the first job does not pay for them
+    :param modules: Modules to import
+    :return: Process id of the worker
+    """
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            logging.warning(f"Could not preload {module} in worker {os.getpid()}")
+    return os.getpid()
+
+
+def get_queued_jobs(spool_dir: str) -> list:
+    """
+    Gets the queued jobs, highest priority first and first come, first served within a priority
+    :param spool_dir: Spool directory of the server
+    :return: List of queued jobs
+    """
+    jobs = []
+    for job_file in glob.glob(os.path.join(spool_dir, INCOMING_DIR, '*.json')):
+        try:
+            job = read_json(job_file)
+        except (OSError, ValueError):
+            # Claimed by another server or not readable yet
+            continue
+        if not isinstance(job, dict) or any(job_field not in job for job_field in JOB_FIELDS) or \
+                job['job_id'] != os.path.basename(job_file)[:-len('.json')] or \
+                not isinstance(job['config'], dict) or 'main_folder' not in job['config'] or \
+                not isinstance(job['priority'], (int, float)) or not isinstance(job['submitted'], (int, float)):
+            reject_job_file(spool_dir, job_file, "Malformed job file")
+            continue
+        jobs.append(job)
+    return sorted(jobs, key=lambda job: (-job['priority'], job['submitted']))
+
+
+def reject_job_file(spool_dir: str, job_file: str, reason: str) -> None:
+    """
+    Moves a job file that cannot be processed to the failed folder, so that it is not picked up again
+    :param spool_dir: Spool directory of the server
+    :param job_file: Path of the job file
+    :param reason: Reason of the rejection, logged
+    :return: None
+    """
+    try:
+        os.replace(job_file, os.path.join(spool_dir, FAILED_DIR, os.path.basename(job_file)))
+    except FileNotFoundError:
+        return
+    logging.error(f"{reason}: {os.path.basename(job_file)} moved to {FAILED_DIR}")
+    print(f"Failed | {os.path.basename(job_file)} | {reason}")
+
+
+def get_job_config(job: dict, njobs: int) -> falcon.RunConfig:
+    """
+    Builds and checks the run configuration of a job
+    :param job: Job
+    :param njobs: Number of workers of the server
+    :return: Configuration of the run
+    """
+    try:
+        config = falcon.RunConfig(**job['config'])
+    except TypeError as error:
+        raise falcon.FalconError(f"Invalid job configuration: {error}") from error
+    falcon.check_config(config)
+    config.njobs = njobs
+    return config
+
+
+def requeue_interrupted_jobs(spool_dir: str) -> None:
+    """
+    Queues the jobs that were running when a previous server died again, unless they were already started
+    MAX_JOB_STARTS times
+    :param spool_dir: Spool directory of the server
+    :return: None
+    """
+    for job_file in glob.glob(os.path.join(spool_dir, RUNNING_DIR, '*.json')):
+        try:
+            job = read_json(job_file)
+            starts = job.get('starts', 1)
+        except (OSError, ValueError, AttributeError):
+            reject_job_file(spool_dir, job_file, "Unreadable interrupted job")
+            continue
+        if starts >= MAX_JOB_STARTS:
+            job['error'] = f"Interrupted {starts} times, the job may crash the server"
+            write_json(job_file, job)
+            reject_job_file(spool_dir, job_file, job['error'])
+            continue
+        os.replace(job_file, os.path.join(spool_dir, INCOMING_DIR, os.path.basename(job_file)))
+        logging.warning(f"Requeued interrupted job {os.path.basename(job_file)}")
+
+
+def claim_job(spool_dir: str, job: dict) -> bool:
+    """
+    Claims a queued job by moving it to the running folder; the move is atomic, so a job is only claimed once
+    :param spool_dir: Spool directory of the server
+    :param job: Job to claim
+    :return: True if the job was claimed
+    """
+    try:
+        os.rename(os.path.join(spool_dir, INCOMING_DIR, f"{job['job_id']}.json"),
+                  os.path.join(spool_dir, RUNNING_DIR, f"{job['job_id']}.json"))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def finish_job(spool_dir: str, job: dict, result: falcon.RunResult = None, error: Exception = None) -> None:
+    """
+    Stores the outcome of a job in the done or failed folder
+    :param spool_dir: Spool directory of the server
+    :param job: Finished job
+    :param result: Result of the run, if it succeeded
+    :param error: Exception that stopped the run, if it failed
+    :return: None
+    """
+    job['finished'] = time.time()
+    if error is None:
+        job['result'] = dataclasses.asdict(result)
+        write_json(os.path.join(spool_dir, DONE_DIR, f"{job['job_id']}.json"), job)
+    else:
+        job['error'] = f"{type(error).__name__}: {error}"
+        write_json(os.path.join(spool_dir, FAILED_DIR, f"{job['job_id']}.json"), job)
+    os.remove(os.path.join(spool_dir, RUNNING_DIR, f"{job['job_id']}.json"))
+
+
+def serve(spool_dir: str, njobs: int = None, concurrent_studies: int = 2, poll_interval: float = 2.0,
+          log_file: str = None) -> None:
+    """
+    Runs the FALCON server until a STOP file appears in the spool directory. The server keeps one worker pool warm
+    (workers are started at once with the heavy modules preloaded), picks queued studies by priority and processes up
+    to concurrent_studies of them at the same time on the shared pool, like falcon.run_batch. Its status is written to
+    the status file of the spool directory on every poll.
+    :param spool_dir: Spool directory of the server
+    :param njobs: Number of workers of the pool, None to derive it from the available resources
+    :param concurrent_studies: Number of studies that are processed at the same time
+    :param poll_interval: Time between two polls of the queue in seconds
+    :param log_file: Optional log file the workers write their log messages to
+    :return: None
+    """
+    spool_dir = init_spool_dir(spool_dir)
+    stop_file = os.path.join(spool_dir, STOP_FILE)
+    if os.path.exists(stop_file):
+        os.remove(stop_file)
+
+    requeue_interrupted_jobs(spool_dir)
+
+    if njobs is None:
+        njobs = falcon.get_number_of_jobs('affine')
+    started = time.time()
+    completed, failed = 0, 0
+    running = {}
+    logging.info(f"FALCON server started on {spool_dir} | Worker pool: {njobs} jobs | Concurrent studies: "
+                 f"{concurrent_studies}")
+    print(f"FALCON server started on {spool_dir} with {njobs} workers")
+
+    with su.create_worker_pool(njobs, log_file, preload=PRELOAD_MODULES) as worker_pool, \
+            ThreadPoolExecutor(max_workers=concurrent_studies) as study_pool:
+        worker_pids = [job.result() for job in [worker_pool.submit(warm_up_worker, PRELOAD_MODULES)
+                                                 for _ in range(njobs)]]
+        logging.info(f"Worker pool is warm: {sorted(set(worker_pids))}")
+
+        while True:
+            # Collect the finished studies
+            for job_id in [job_id for job_id, (job, future) in running.items() if future.done()]:
+                job, future = running.pop(job_id)
+                try:
+                    finish_job(spool_dir, job, result=future.result())
+                    completed += 1
+                    logging.info(f"Job {job_id} ({job['config']['main_folder']}) done")
+                    print(f"Done   | {job_id} | {job['config']['main_folder']}")
+                except Exception as error:
+                    finish_job(spool_dir, job, error=error)
+                    failed += 1
+                    logging.error(f"Job {job_id} ({job['config']['main_folder']}) failed: {error}")
+                    print(f"Failed | {job_id} | {job['config']['main_folder']} | {error}")
+
+            stopping = os.path.exists(stop_file)
+            queued_jobs = get_queued_jobs(spool_dir)
+
+            # Start the highest priority studies while there are free slots
+            while not stopping and queued_jobs and len(running) < concurrent_studies:
+                job = queued_jobs.pop(0)
+                if not claim_job(spool_dir, job):
+                    continue
+                job['started'] = time.time()
+                job['starts'] = job.get('starts', 0) + 1
+                write_json(os.path.join(spool_dir, RUNNING_DIR, f"{job['job_id']}.json"), job)
+                try:
+                    config = get_job_config(job, njobs)
+                except falcon.FalconError as error:
+                    finish_job(spool_dir, job, error=error)
+                    failed += 1
+                    logging.error(f"Job {job['job_id']} rejected: {error}")
+                    print(f"Failed | {job['job_id']} | {error}")
+                    continue
+                running[job['job_id']] = (job, study_pool.submit(falcon.run_study, config, worker_pool))
+                logging.info(f"Job {job['job_id']} ({config.main_folder}) started with priority {job['priority']}")
+                print(f"Start  | {job['job_id']} | {config.main_folder}")
+
+            write_json(os.path.join(spool_dir, STATUS_FILE), {
+                'pid': os.getpid(),
+                'state': 'stopping' if stopping else 'running',
+                'started': started,
+                'updated': time.time(),
+                'njobs': njobs,
+                'concurrent_studies': concurrent_studies,
+                'running': [{'job_id': job_id, 'main_folder': job['config']['main_folder'],
+                             'priority': job['priority'], 'started': job['started']}
+                            for job_id, (job, future) in running.items()],
+                'queued': [{'job_id': job['job_id'], 'main_folder': job['config']['main_folder'],
+                            'priority': job['priority']} for job in queued_jobs],
+                'completed': completed,
+                'failed': failed
+            })
+
+            if stopping and not running:
+                break
+            time.sleep(poll_interval)
+
+    status = get_status(spool_dir)
+    status.update({'state': 'stopped', 'updated': time.time()})
+    write_json(os.path.join(spool_dir, STATUS_FILE), status)
+    os.remove(stop_file)
+    logging.info(f"FALCON server stopped | Completed: {completed} | Failed: {failed}")
+    print(f"FALCON server stopped | Completed: {completed} | Failed: {failed}")
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: streaming.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: Online motion correction: frames are registered as soon as the reconstruction writes them into a
+# folder, and the 4D motion corrected image is merged once the acquisition is complete.
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+import logging
+import os
+import pathlib
+import re
+import shutil
+import time
+import timeit
+
+import falcon
+import fileOp as fop
+import greedy
+import imageIO
+import sysUtil as su
+
+# File that the reconstruction (or the operator) can create in the watched folder to mark the end of the acquisition
+END_OF_ACQUISITION_FILE = 'ACQUISITION_DONE'
+
+
+def watch_frames(frame_dir: str, wildcard: str, poll_interval: float, num_frames: int = None,
+                 idle_timeout: float = None):
+    """
+    Watches a folder by polling and yields the frames that land in it, in natural order. A frame is only yielded once
+    its size did not change between two polls, so that partially written frames are never used. The watch ends when
+    num_frames frames were seen, when the END_OF_ACQUISITION_FILE appears or when no new frame arrived within the idle
+    timeout.
+    :param frame_dir: Folder the reconstructed frames are written to
+    :param wildcard: Wildcard to filter the frames
+    :param poll_interval: Time between two polls in seconds
+    :param num_frames: Optional number of frames of the acquisition
+    :param idle_timeout: Optional time in seconds without new frames after which the acquisition is considered done
+    :return: Generator of frame paths
+    """
+    seen_frames = set()
+    last_sizes = {}
+    last_arrival = timeit.default_timer()
+    while True:
+        end_of_acquisition = os.path.exists(os.path.join(frame_dir, END_OF_ACQUISITION_FILE))
+        for frame in fop.get_files(frame_dir, wildcard):
+            # Transforms are written next to the frames (e.g. vol0001.nii.gz_warp.nii.gz) and are no frames
+            if frame in seen_frames or re.search(r'\.nii(\.gz)?_', pathlib.Path(frame).name):
+                continue
+            size = os.path.getsize(frame)
+            if last_sizes.get(frame) == size or end_of_acquisition:
+                seen_frames.add(frame)
+                last_arrival = timeit.default_timer()
+                yield frame
+            else:
+                last_sizes[frame] = size
+        pending_frames = any(frame not in seen_frames for frame in last_sizes)
+        if num_frames is not None and len(seen_frames) >= num_frames:
+            return
+        if end_of_acquisition and not pending_frames:
+            return
+        if idle_timeout is not None and timeit.default_timer() - last_arrival > idle_timeout and not pending_frames:
+            logging.info(f"No new frame arrived within {idle_timeout} s, the acquisition is considered done")
+            return
+        time.sleep(poll_interval)
+
+
+def move_frame_transforms(moving_img: str, registration_type: str, transform_dir: str) -> None:
+    """
+    Moves the transforms of a registered frame to the transforms folder, as soon as its registration is done
+    :param moving_img: Path to the registered frame
+    :param registration_type: 'rigid', 'affine', or 'deformable'
+    :param transform_dir: Directory the transforms are moved to
+    :return: None
+    """
+    moving_img_filename = pathlib.Path(moving_img).name
+    frame_dir = pathlib.Path(moving_img).parent
+    transform_files = greedy.get_transform_files(moving_img_filename, frame_dir, registration_type)
+    transform_files.append(os.path.join(frame_dir, f"{moving_img_filename}_inverse_warp.nii.gz"))
+    for transform_file in transform_files:
+        if os.path.exists(transform_file):
+            shutil.move(transform_file, os.path.join(transform_dir, os.path.basename(transform_file)))
+
+
+def stream(frame_dir: str, reference_image: str = None, registration: str = 'affine',
+           multi_resolution_iterations: str = '100x50x25', registration_options: dict = None, start_frame: int = 0,
+           njobs: int = None, num_frames: int = None, poll_interval: float = 5.0, idle_timeout: float = None,
+           executor=None) -> falcon.RunResult:
+    """
+    Motion corrects the frames of a dynamic acquisition while they are being reconstructed. Every frame is registered
+    to the reference as soon as it lands; its moco- image and transforms are written right away, and the 4D image is
+    merged at the end of the acquisition.
+    :param frame_dir: Folder the reconstructed 3D nifti frames are written to
+    :param reference_image: Provisional or late reference (e.g. a late frame of a previous study with the same grid).
+    If None, the first frame of the acquisition is the reference.
+    :param registration: Type of registration: rigid | affine | deformable
+    :param multi_resolution_iterations: Number of iterations for each resolution level
+    :param registration_options: Optional registration settings, see greedy.get_registration_options
+    :param start_frame: Frames before this index are copied without registration
+    :param njobs: Number of registrations to run in parallel, None to derive it from the available resources
+    :param num_frames: Optional number of frames of the acquisition
+    :param poll_interval: Time between two polls of the frame folder in seconds
+    :param idle_timeout: Optional time in seconds without new frames after which the acquisition is considered done
+    :param executor: Optional caller-provided concurrent.futures.Executor to run the registrations on
+    :return: Result of the run
+    """
+    start = timeit.default_timer()
+    frame_dir = os.path.abspath(frame_dir)
+    if not os.path.isdir(frame_dir):
+        raise falcon.FalconError("Frame folder does not exist")
+    result = falcon.RunResult(working_dir=frame_dir, input_image_type='Nifti', nifti_dir=frame_dir,
+                              split3d_dir=frame_dir, start_frame=start_frame)
+    result.njobs = njobs if njobs else falcon.get_number_of_jobs(registration)
+    result.moco_dir = fop.make_dir(frame_dir, 'moco')
+    result.transform_dir = fop.make_dir(result.moco_dir, 'transforms')
+    registration_options = greedy.get_registration_options(registration_options)
+    if registration_options['threads_per_job'] is None:
+        registration_options['threads_per_job'] = su.get_threads_per_job(result.njobs)
+    own_executor = executor is None
+    if own_executor:
+        executor = su.create_worker_pool(result.njobs)
+
+    logging.info(f"Streaming motion correction of {frame_dir} | Registration type: {registration} | "
+                 f"Reference: {reference_image if reference_image else 'first frame'}")
+    print(f"Waiting for frames in {frame_dir}...")
+    if reference_image is not None:
+        result.reference_image = os.path.abspath(reference_image)
+
+    pending_registrations = {}
+    try:
+        for frame_index, frame in enumerate(watch_frames(frame_dir, '*.nii*', poll_interval, num_frames,
+                                                         idle_timeout)):
+            frame_filename = pathlib.Path(frame).name
+            if not result.reference_image:
+                result.reference_image = fop.copy_file(frame, os.path.join(result.moco_dir, 'moco-' + frame_filename))
+                logging.info(f"Reference image (is fixed): {result.reference_image}")
+                print(f"Reference image (is fixed): {result.reference_image}")
+            elif frame_index < start_frame:
+                fop.copy_file(frame, os.path.join(result.moco_dir, 'moco-' + frame_filename))
+                logging.info(f"Copying files {frame_filename} to {result.moco_dir}")
+            else:
+                align_param = (result.reference_image, registration, multi_resolution_iterations, result.moco_dir,
+                               registration_options)
+                pending_registrations[frame] = executor.submit(greedy.align_mp, align_param, frame)
+                logging.info(f"Frame {frame_filename} arrived and was queued for registration")
+                print(f"Frame {frame_filename} arrived and was queued for registration")
+
+            # Publish the transforms of every registration that finished in the meantime
+            for registered_frame in [pending_frame for pending_frame, job in pending_registrations.items()
+                                     if job.done()]:
+                pending_registrations.pop(registered_frame).result()
+                move_frame_transforms(registered_frame, registration, result.transform_dir)
+
+        for registered_frame, job in pending_registrations.items():
+            job.result()
+            move_frame_transforms(registered_frame, registration, result.transform_dir)
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    # Finalize: merge the motion corrected frames into a single 4d file
+    imageIO.merge3d(nifti_dir=result.moco_dir, wild_card='moco-*nii*', nifti_outfile='4d-moco.nii.gz')
+    result.moco_4d_file = os.path.join(result.moco_dir, '4d-moco.nii.gz')
+    result.frame_transforms = greedy.get_frame_transforms(result.transform_dir, registration)
+    result.timings['total'] = timeit.default_timer() - start
+    logging.info(f"Merged 3d motion corrected files into a single 4d file: {result.moco_4d_file}")
+    print(f"Merged 3d motion corrected files into a single 4d file: {result.moco_4d_file}")
+    return result
@@ -12,10 +12,25 @@
 # License: Apache 2.0
 # **********************************************************************************************************************
 
+import csv
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 import psutil
-import tqdm
+
+import perfTrace
+
+# Thread budget of the jobs of a worker; the external tools read the ITK and OpenMP variables, FALCON adds the thread
+# count of its own variable to the greedy command lines (see set_thread_budget)
+THREADS_ENV_VARIABLE = 'FALCON_THREADS_PER_JOB'
+THREAD_LIBRARY_ENV_VARIABLES = ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                                'MKL_NUM_THREADS']
 
 
 def get_number_of_possible_jobs(process_memory: int, process_threads: int) -> int:
@@ -48,17 +63,269 @@ def get_number_of_possible_jobs(process_memory: int, process_threads: int) -> in
     return number_of_jobs
 
 
-def display_system_load(refresh_interval=0.5) -> None:
+def map_jobs(function, jobs: list, njobs: int, shared_objects=None, executor=None) -> list:
+    """
+    Runs a function on a list of jobs in parallel and returns the results in the order of the jobs. Without an executor
+    a WorkerPool with njobs workers is created for the call; with a caller-provided concurrent.futures.Executor (e.g. a
+    pool kept warm across many studies) the jobs are submitted to it instead.
+    :param function: Function to run; it receives the shared objects (if any) followed by the arguments of a job
+    :param jobs: List of jobs, each either a single argument or a tuple of arguments
+    :param njobs: Number of jobs to run in parallel when no executor is given
+    :param shared_objects: Object passed as first argument to every call of the function
+    :param executor: Optional caller-provided concurrent.futures.Executor
+    :return: List of the results of the function
+    """
+    if executor is None:
+        # mpire pulls in numpy, which the CLI entry points should not pay for on every start
+        from mpire import WorkerPool
+        with WorkerPool(n_jobs=njobs, shared_objects=shared_objects, start_method='fork') as pool:
+            return pool.map(function, jobs, progress_bar=False)
+
+    futures = []
+    for job in jobs:
+        job_args = job if isinstance(job, tuple) else (job,)
+        if shared_objects is not None:
+            job_args = (shared_objects,) + job_args
+        futures.append(executor.submit(function, *job_args))
+    return [future.result() for future in futures]
+
+
+def init_worker_logging(log_file: str) -> None:
+    """
+    Initializes the logging of a worker process, so that its messages end up in the log file of the main process
+    :param log_file: Log file of the main process
+    :return: None
+    """
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s', level=logging.INFO,
+                        filename=log_file, filemode='a')
+
+
+def init_worker(log_file: str = None, core_sets: list = None, slot_counter=None) -> None:
+    """
+    Initializes a worker process: its logging (see init_worker_logging) and its CPU affinity (see pin_worker)
+    :param log_file: Optional log file of the main process
+    :param core_sets: Optional core sets of the workers, see get_core_sets
+    :param slot_counter: Shared counter of the workers started so far, required with core_sets
+    :return: None
+    """
+    if log_file is not None:
+        init_worker_logging(log_file)
+    if core_sets:
+        pin_worker(core_sets, slot_counter)
+
+
+def create_worker_pool(njobs: int, log_file: str = None, preload: list = None,
+                       core_sets: list = None) -> ProcessPoolExecutor:
+    """
+    Creates a worker pool that can be shared by several studies (see map_jobs). The workers are started with
+    'forkserver', because the pool is used from several threads at once, which does not mix well with 'fork'.
+    :param njobs: Number of worker processes
+    :param log_file: Optional log file the workers write their log messages to
+    :param preload: Optional list of modules the fork server imports once, so that every worker starts with them warm
+    (only effective if the fork server is not running yet)
+    :param core_sets: Optional core sets to pin the workers to, one per worker, see get_core_sets
+    :return: The worker pool
+    """
+    mp_context = multiprocessing.get_context('forkserver')
+    if preload:
+        mp_context.set_forkserver_preload(preload)
+    if log_file is None and not core_sets:
+        return ProcessPoolExecutor(max_workers=njobs, mp_context=mp_context)
+    return ProcessPoolExecutor(max_workers=njobs, mp_context=mp_context, initializer=init_worker,
+                               initargs=(log_file, core_sets, mp_context.Value('i', 0) if core_sets else None))
+
+
+def parse_cpu_list(cpu_list: str) -> list:
+    """
+    Parses a Linux CPU list such as '0-3,8-11'
+    :param cpu_list: CPU list
+    :return: List of the CPU numbers
+    """
+    cpus = []
+    for cpu_range in cpu_list.strip().split(','):
+        if not cpu_range:
+            continue
+        first_cpu, _, last_cpu = cpu_range.partition('-')
+        cpus.extend(range(int(first_cpu), int(last_cpu or first_cpu) + 1))
+    return cpus
+
+
+def get_numa_nodes() -> list:
+    """
+    Gets the CPUs this process may run on, grouped by NUMA node
+    :return: List of the sorted CPU lists of the NUMA nodes (a single node if the topology is unknown)
+    """
+    available_cpus = set(os.sched_getaffinity(0))
+    numa_nodes = []
+    for cpu_list_file in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'),
+                                key=lambda node_file: int(node_file.split('/')[-2][4:])):
+        with open(cpu_list_file, 'r') as cpu_list_in:
+            node_cpus = sorted(available_cpus.intersection(parse_cpu_list(cpu_list_in.read())))
+        if node_cpus:
+            numa_nodes.append(node_cpus)
+    if sum(len(node_cpus) for node_cpus in numa_nodes) != len(available_cpus):
+        return [sorted(available_cpus)]
+    return numa_nodes
+
+
+def get_threads_per_job(njobs: int) -> int:
+    """
+    Gets the number of threads each of njobs concurrent jobs gets, so that together they do not oversubscribe the CPUs
+    this process may run on
+    :param njobs: Number of concurrent jobs
+    :return: Number of threads per job
+    """
+    return max(1, len(os.sched_getaffinity(0)) // max(njobs, 1))
+
+
+def get_core_sets(njobs: int, threads_per_job: int) -> list:
+    """
+    Splits the available CPUs into disjoint core sets, one per worker. A core set never spans two NUMA nodes if it
+    fits into one, so that a job and the memory it first touches stay on one socket, and the core sets are handed out
+    round-robin over the nodes, so that fewer jobs than core sets spread over all sockets. With more jobs than fit,
+    the core sets are reused.
+    :param njobs: Number of workers
+    :param threads_per_job: Number of CPUs per core set
+    :return: List of njobs core sets (lists of CPU numbers)
     """
-    Displays the utilized system load as two bars. Keep in mind that this call locks a thread
+    numa_nodes = get_numa_nodes()
+    if threads_per_job > min(len(node_cpus) for node_cpus in numa_nodes):
+        numa_nodes = [[cpu for node_cpus in numa_nodes for cpu in node_cpus]]
+    node_core_sets = [[node_cpus[first:first + threads_per_job]
+                       for first in range(0, len(node_cpus) - threads_per_job + 1, threads_per_job)]
+                      for node_cpus in numa_nodes]
+    core_sets = [node_core_sets[node][index] for index in range(max(len(sets) for sets in node_core_sets))
+                 for node in range(len(node_core_sets)) if index < len(node_core_sets[node])]
+    if not core_sets:
+        core_sets = [sorted(os.sched_getaffinity(0))]
+    return [core_sets[worker % len(core_sets)] for worker in range(njobs)]
+
+
+def set_thread_budget(threads: int) -> None:
+    """
+    Limits the external tools started from this process from now on to a number of threads
+    :param threads: Number of threads
+    :return: None
+    """
+    os.environ[THREADS_ENV_VARIABLE] = str(threads)
+    for env_variable in THREAD_LIBRARY_ENV_VARIABLES:
+        os.environ[env_variable] = str(threads)
+
+
+def pin_worker(core_sets: list, slot_counter) -> None:
     """
-    with tqdm.tqdm(total=100, desc='CPU%', position=1, bar_format='{l_bar}{bar}|') as cpu_bar, \
-         tqdm.tqdm(total=100, desc='RAM%', position=0, bar_format='{l_bar}{bar}|') as ram_bar:
-        while True:
-            # Get current utilization
-            ram_bar.n = psutil.virtual_memory().percent
-            cpu_bar.n = psutil.cpu_percent()
-            # Refresh bars
-            ram_bar.refresh()
-            cpu_bar.refresh()
-            time.sleep(refresh_interval)
+    Pins the calling worker process to the next free core set and gives its jobs as many threads as the set has CPUs.
+    The external tools it starts inherit the affinity.
+    :param core_sets: Core sets of the workers, see get_core_sets
+    :param slot_counter: Shared counter of the workers started so far (multiprocessing.Value)
+    :return: None
+    """
+    with slot_counter.get_lock():
+        slot = slot_counter.value
+        slot_counter.value += 1
+    cores = core_sets[slot % len(core_sets)]
+    os.sched_setaffinity(0, cores)
+    set_thread_budget(len(cores))
+
+
+class ResourceSampler(threading.Thread):
+    """
+    Background thread that samples the utilisation of the machine (CPU, idle cores, IO wait, memory, disk throughput)
+    at a fixed interval, tagging every sample with the FALCON phases active at that moment (see perfTrace.phase).
+    Use it as a context manager around a run, then save the samples and the per-phase summary.
+    """
+
+    def __init__(self, interval: float = 1.0):
+        """
+        :param interval: Time between two samples in seconds
+        """
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = []
+        self.stop_event = threading.Event()
+
+    def run(self) -> None:
+        psutil.cpu_percent(percpu=True)
+        psutil.cpu_times_percent()
+        last_disk_io = psutil.disk_io_counters()
+        last_time = time.time()
+        while not self.stop_event.wait(self.interval):
+            now = time.time()
+            core_percents = psutil.cpu_percent(percpu=True)
+            cpu_times = psutil.cpu_times_percent()
+            memory = psutil.virtual_memory()
+            disk_io = psutil.disk_io_counters()
+            elapsed = max(now - last_time, 1e-6)
+            self.samples.append({
+                'time': now,
+                'phase': '+'.join(perfTrace.get_active_phases()) or 'idle',
+                'cpu_percent': sum(core_percents) / len(core_percents),
+                'idle_cores': sum(100 - core_percent for core_percent in core_percents) / 100,
+                'iowait_percent': getattr(cpu_times, 'iowait', 0.0),
+                'memory_percent': memory.percent,
+                'memory_used_gb': (memory.total - memory.available) / 1024 ** 3,
+                'disk_read_mb_s': (disk_io.read_bytes - last_disk_io.read_bytes) / 1024 ** 2 / elapsed
+                if disk_io and last_disk_io else 0.0,
+                'disk_write_mb_s': (disk_io.write_bytes - last_disk_io.write_bytes) / 1024 ** 2 / elapsed
+                if disk_io and last_disk_io else 0.0
+            })
+            last_disk_io, last_time = disk_io, now
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.stop()
+
+    def stop(self) -> None:
+        """
+        Stops sampling
+        """
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    def summarize(self) -> dict:
+        """
+        Summarizes the samples per phase
+        :return: Dictionary mapping each phase to its duration, mean CPU, IO wait and memory utilisation, peak memory and
+        idle core time (core-seconds no process used), i.e. how far the phase under-subscribed the machine
+        """
+        summary = {}
+        for sample in self.samples:
+            entry = summary.setdefault(sample['phase'], {'duration_s': 0.0, 'idle_core_s': 0.0, 'cpu_percent': 0.0,
+                                                         'iowait_percent': 0.0, 'memory_percent': 0.0,
+                                                         'peak_memory_used_gb': 0.0, 'samples': 0})
+            entry['duration_s'] += self.interval
+            entry['idle_core_s'] += sample['idle_cores'] * self.interval
+            entry['cpu_percent'] += sample['cpu_percent']
+            entry['iowait_percent'] += sample['iowait_percent']
+            entry['memory_percent'] += sample['memory_percent']
+            entry['peak_memory_used_gb'] = max(entry['peak_memory_used_gb'], sample['memory_used_gb'])
+            entry['samples'] += 1
+        for entry in summary.values():
+            for mean_field in ('cpu_percent', 'iowait_percent', 'memory_percent'):
+                entry[mean_field] /= entry['samples']
+            entry['mean_idle_cores'] = entry['idle_core_s'] / entry['duration_s']
+        return summary
+
+    def save(self, samples_file: str) -> str:
+        """
+        Saves the samples as CSV or JSON (chosen by the file extension) and the per-phase summary as JSON next to them
+        :param samples_file: Path to the samples file (*.csv or *.json)
+        :return: Path to the summary file
+        """
+        if samples_file.endswith('.csv'):
+            with open(samples_file, 'w', newline='') as samples_out:
+                writer = csv.DictWriter(samples_out, fieldnames=list(self.samples[0]) if self.samples else ['time'])
+                writer.writeheader()
+                writer.writerows(self.samples)
+        else:
+            with open(samples_file, 'w') as samples_out:
+                json.dump(self.samples, samples_out, indent=4)
+        summary_file = os.path.splitext(samples_file)[0] + '-summary.json'
+        with open(summary_file, 'w') as summary_out:
+            json.dump({'interval_s': self.interval, 'cpu_count': psutil.cpu_count(), 'phases': self.summarize()},
+                      summary_out, indent=4)
+        return summary_file
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: tune.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: Autotuner of the iteration schedule and the linear shrink level for a protocol. A sample of frames of
+# a study is registered to its reference frame with a high-iteration reference schedule and with every candidate
+# schedule and shrink level; the cheapest candidate whose aligned frames stay within a tolerance of the reference is
+# saved as a profile that falcon and falcon-batch load with --profile.
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+# Imported Libraries
+
+import json
+import logging
+import os
+import pathlib
+import shutil
+import statistics
+import tempfile
+import timeit
+from datetime import datetime
+
+import constants as c
+import fileOp as fop
+import greedy
+import imageIO
+import imageOp
+import sysUtil as su
+
+# Settings a profile provides, as defaults of the command line arguments of the same name (profiles of tuning runs
+# without an initializer lack the last one)
+PROFILE_SETTINGS = ['registration', 'multi_resolution_iterations', 'linear_shrink_factor', 'initializer']
+REQUIRED_PROFILE_SETTINGS = PROFILE_SETTINGS[:3]
+
+
+def get_frames(input_path: str, work_dir: str) -> list:
+    """
+    Gets the 3d frames of a study
+    :param input_path: Folder of 3d NIfTI frames (e.g. the split3d folder of an earlier run) or a 4d NIfTI file
+    :param work_dir: Folder a 4d NIfTI file is split into
+    :return: Sorted list of the paths of the 3d frames
+    """
+    nifti_files = [input_path] if os.path.isfile(input_path) else fop.get_files(input_path, '*nii*')
+    if len(nifti_files) == 1 and imageOp.get_dimensions(nifti_files[0]) == 4:
+        split_dir = fop.make_dir(work_dir, 'split3d')
+        imageIO.split4d(nifti_files[0], split_dir)
+        nifti_files = fop.get_files(split_dir, 'vol*.nii*')
+    if len(nifti_files) < 2:
+        raise ValueError(f"At least two 3d frames are needed to tune, found {len(nifti_files)} in {input_path}")
+    return nifti_files
+
+
+def sample_frames(frames: list, reference_frame_index: int, start_frame: int, num_frames: int) -> list:
+    """
+    Picks moving frames evenly spread over the frames that are registered
+    :param frames: Sorted list of all frames
+    :param reference_frame_index: Index of the reference frame
+    :param start_frame: Index of the first frame that is registered
+    :param num_frames: Number of moving frames to pick
+    :return: List of the picked moving frames
+    """
+    reference_frame = frames[reference_frame_index]
+    candidates = [frame for frame in frames[start_frame:] if frame != reference_frame]
+    if len(candidates) <= num_frames:
+        return candidates
+    step = len(candidates) / num_frames
+    return [candidates[int(index * step + step / 2)] for index in range(num_frames)]
+
+
+def register_frame(reference_img: str, moving_img: str, case_dir: str, registration_type: str,
+                   multi_resolution_iterations: str, linear_shrink_factor: int,
+                   initializer: str = 'image-centers') -> tuple:
+    """
+    Registers a moving frame like FALCON does and resamples it onto the reference frame
+    :param reference_img: Path to the reference frame
+    :param moving_img: Path to the moving frame
+    :param case_dir: Folder of this candidate, the transforms and the aligned frame are written here
+    :param registration_type: Type of registration
+    :param multi_resolution_iterations: Iteration schedule of the candidate
+    :param linear_shrink_factor: Linear shrink level of the candidate
+    :param initializer: Initial alignment, see greedy.get_initialization
+    :return: Tuple of the registration time in seconds and the path of the aligned frame
+    """
+    case_img = fop.copy_file(moving_img, os.path.join(case_dir, pathlib.Path(moving_img).name))
+    start = timeit.default_timer()
+    greedy.registration(fixed_img=reference_img, moving_img=case_img, registration_type=registration_type,
+                        multi_resolution_iterations=multi_resolution_iterations,
+                        linear_shrink_factor=linear_shrink_factor, initializer=initializer)
+    registration_time = timeit.default_timer() - start
+    aligned_img = os.path.join(case_dir, 'moco-' + pathlib.Path(moving_img).name)
+    greedy.resample(fixed_img=reference_img, moving_img=case_img, resampled_moving_img=aligned_img,
+                    registration_type=registration_type)
+    return registration_time, aligned_img
+
+
+def get_image_error(aligned_img: str, reference_aligned_img: str) -> float:
+    """
+    Compares a frame aligned with a candidate schedule to the same frame aligned with the reference schedule
+    :param aligned_img: Path to the frame aligned with the candidate
+    :param reference_aligned_img: Path to the frame aligned with the reference schedule
+    :return: RMS difference relative to the intensity range (99.9th percentile) of the reference aligned frame
+    """
+    import numpy as np
+    import SimpleITK
+    aligned = SimpleITK.GetArrayFromImage(SimpleITK.ReadImage(aligned_img, SimpleITK.sitkFloat32))
+    reference_aligned = SimpleITK.GetArrayFromImage(SimpleITK.ReadImage(reference_aligned_img,
+                                                                        SimpleITK.sitkFloat32))
+    intensity_range = float(np.percentile(reference_aligned, 99.9) - reference_aligned.min())
+    if intensity_range <= 0:
+        return 0.0
+    return float(np.sqrt(np.mean((aligned - reference_aligned) ** 2)) / intensity_range)
+
+
+def tune(input_path: str, registration_type: str, reference_frame_index: int = -1, start_frame: int = 0,
+         num_frames: int = c.TUNE_NUM_FRAMES, schedules: list = None, shrink_levels: list = None,
+         tolerance: float = c.TUNE_TOLERANCE, threads_per_job: int = None, work_dir: str = None,
+         initializer: str = 'image-centers') -> dict:
+    """
+    Finds the cheapest iteration schedule and linear shrink level whose aligned frames stay within the tolerance of a
+    high-iteration reference registration (c.TUNE_REFERENCE_ITERATIONS). The frames are registered one at a time, so
+    that the times do not disturb each other; give threads_per_job the thread budget of the production runs.
+    :param input_path: Folder of 3d NIfTI frames or a 4d NIfTI file of a study of the protocol
+    :param registration_type: Type of registration: rigid | affine | deformable
+    :param reference_frame_index: Index of the reference frame
+    :param start_frame: Index of the first frame that is registered
+    :param num_frames: Number of moving frames to tune on
+    :param schedules: Candidate iteration schedules [default: c.TUNE_SCHEDULES]
+    :param shrink_levels: Candidate linear shrink levels [default: c.TUNE_SHRINK_LEVELS]
+    :param tolerance: Largest accepted error of a frame, see get_image_error
+    :param threads_per_job: Optional number of threads of each registration
+    :param work_dir: Folder for the intermediate files [default: a temporary folder that is removed afterwards]
+    :param initializer: Initial alignment of the candidates (the reference always starts from the image centers),
+    see greedy.get_initialization
+    :return: Profile with the recommended settings and the measurements of all candidates
+    """
+    schedules = schedules or c.TUNE_SCHEDULES
+    shrink_levels = shrink_levels or c.TUNE_SHRINK_LEVELS
+    own_work_dir = work_dir is None
+    work_dir = tempfile.mkdtemp(prefix='falcon-tune-') if own_work_dir else fop.make_dir(work_dir, 'falcon-tune')
+    if threads_per_job:
+        su.set_thread_budget(threads_per_job)
+    try:
+        frames = get_frames(input_path, work_dir)
+        reference_img = fop.copy_file(frames[reference_frame_index],
+                                      os.path.join(work_dir, pathlib.Path(frames[reference_frame_index]).name))
+        moving_imgs = sample_frames(frames, reference_frame_index, start_frame, num_frames)
+        reference_iterations = c.TUNE_REFERENCE_ITERATIONS[registration_type]
+        logging.info(f"Tuning {registration_type} registration on {len(moving_imgs)} frames | Reference schedule: "
+                     f"{reference_iterations} | Tolerance: {tolerance}")
+        print(f"Registering {len(moving_imgs)} frames with the reference schedule {reference_iterations}...")
+
+        reference_dir = fop.make_dir(work_dir, 'reference')
+        reference_times = []
+        reference_aligned_imgs = []
+        for moving_img in moving_imgs:
+            registration_time, aligned_img = register_frame(reference_img, moving_img, reference_dir,
+                                                            registration_type, reference_iterations, 1)
+            reference_times.append(registration_time)
+            reference_aligned_imgs.append(aligned_img)
+
+        candidates = []
+        for schedule in schedules:
+            for shrink_level in shrink_levels:
+                case_dir = fop.make_dir(work_dir, f"{schedule}-{shrink_level}x")
+                times = []
+                errors = []
+                for moving_img, reference_aligned_img in zip(moving_imgs, reference_aligned_imgs):
+                    registration_time, aligned_img = register_frame(reference_img, moving_img, case_dir,
+                                                                    registration_type, schedule, shrink_level,
+                                                                    initializer)
+                    times.append(registration_time)
+                    errors.append(get_image_error(aligned_img, reference_aligned_img))
+                candidate = {'multi_resolution_iterations': schedule, 'linear_shrink_factor': shrink_level,
+                             'mean_s': statistics.mean(times), 'mean_error': statistics.mean(errors),
+                             'max_error': max(errors), 'accepted': max(errors) <= tolerance}
+                candidates.append(candidate)
+                shutil.rmtree(case_dir)
+                logging.info(f"Candidate {schedule} | Shrink level: {shrink_level}x | {candidate['mean_s']:.2f} s per "
+                             f"frame | Error: mean {candidate['mean_error']:.4f}, max {candidate['max_error']:.4f}")
+                print(f"{schedule:<14} {shrink_level}x | {candidate['mean_s']:8.2f} s per frame | error: mean "
+                      f"{candidate['mean_error']:.4f}, max {candidate['max_error']:.4f}"
+                      f"{'' if candidate['accepted'] else ' (rejected)'}")
+    finally:
+        if own_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    reference_s = statistics.mean(reference_times)
+    accepted = [candidate for candidate in candidates if candidate['accepted']]
+    if accepted:
+        best = min(accepted, key=lambda candidate: candidate['mean_s'])
+        multi_resolution_iterations, linear_shrink_factor, best_s = best['multi_resolution_iterations'], \
+            best['linear_shrink_factor'], best['mean_s']
+    else:
+        logging.warning(f"No candidate is within the tolerance of {tolerance}, recommending the reference schedule")
+        multi_resolution_iterations, linear_shrink_factor, best_s = reference_iterations, 1, reference_s
+    return {'registration': registration_type,
+            'multi_resolution_iterations': multi_resolution_iterations,
+            'linear_shrink_factor': linear_shrink_factor,
+            'initializer': initializer if accepted else 'image-centers',
+            'tolerance': tolerance,
+            'reference_iterations': reference_iterations,
+            'reference_s': reference_s,
+            'recommended_s': best_s,
+            'speedup': reference_s / best_s if best_s > 0 else None,
+            'threads_per_job': threads_per_job,
+            'study': os.path.abspath(input_path),
+            'frames': [pathlib.Path(moving_img).name for moving_img in moving_imgs],
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'candidates': candidates}
+
+
+def save_profile(profile: dict, profile_file: str) -> str:
+    """
+    Saves a tuning profile
+    :param profile: Profile, see tune
+    :param profile_file: JSON file to write
+    :return: Path of the profile file
+    """
+    with open(profile_file, 'w') as profile_out:
+        json.dump(profile, profile_out, indent=4)
+    return profile_file
+
+
+def load_profile(profile_file: str) -> dict:
+    """
+    Loads the settings of a tuning profile
+    :param profile_file: JSON file written by falcon-tune
+    :return: Dictionary of the settings in PROFILE_SETTINGS
+    """
+    with open(profile_file, 'r') as profile_in:
+        profile = json.load(profile_in)
+    missing_settings = [setting for setting in REQUIRED_PROFILE_SETTINGS if setting not in profile]
+    if missing_settings:
+        raise ValueError(f"Profile {profile_file} lacks the settings {missing_settings}")
+    return {setting: profile[setting] for setting in PROFILE_SETTINGS if setting in profile}
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: test_imageOp.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: Checks that the phase-correlation initializer recovers a known shift with the sign greedy expects.
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+import imageOp as iop  # noqa: E402
+
+
+def get_phantom(shape: tuple, shift: tuple = (0, 0, 0)) -> 'np.ndarray':
+    """
+    Two Gaussian blobs of different size, moved by a shift
+    :param shape: Shape of the array
+    :param shift: Shift of the blobs in voxels (array axis order)
+    :return: Phantom array
+    """
+    grid = np.mgrid[tuple(slice(0, length) for length in shape)].astype(float)
+    phantom = np.zeros(shape)
+    for center, sigma, height in (((0.5, 0.5, 0.5), 7, 1.0), ((0.35, 0.65, 0.4), 3, 0.6)):
+        squared_distance = sum((grid[axis] - center[axis] * shape[axis] - shift[axis]) ** 2 for axis in range(3))
+        phantom += height * np.exp(-squared_distance / (2 * sigma ** 2))
+    return phantom
+
+
+@pytest.mark.parametrize('shift', [(1, 0, 0), (0, 3, 0), (2, -4, 5), (0, 0, 1.5)])
+def test_phase_correlation_recovers_shift(shift):
+    rng = np.random.default_rng(0)
+    fixed = 100 * get_phantom((48, 48, 48)) + rng.normal(0, 10, (48, 48, 48))
+    moving = 100 * get_phantom((48, 48, 48), shift) + rng.normal(0, 10, (48, 48, 48))
+    estimated_shift, _ = iop.get_phase_correlation(fixed, moving)
+    assert np.allclose(estimated_shift, shift, atol=0.3)
+
+
+def test_initial_transform_maps_fixed_to_moving(tmp_path):
+    sitk = pytest.importorskip('SimpleITK')
+    fixed = sitk.GetImageFromArray(get_phantom((40, 44, 48)))
+    fixed.SetSpacing((2.0, 2.0, 2.5))
+    fixed.SetOrigin((-40.0, 10.0, 5.0))
+    # Content moved by (4, -6, 5) mm (LPS)
+    moving = sitk.Resample(fixed, fixed, sitk.TranslationTransform(3, (-4.0, 6.0, -5.0)), sitk.sitkLinear, 0.0)
+    fixed_file, moving_file = str(tmp_path / 'fixed.nii.gz'), str(tmp_path / 'moving.nii.gz')
+    sitk.WriteImage(fixed, fixed_file)
+    sitk.WriteImage(moving, moving_file)
+    transform = iop.estimate_initial_transform(fixed_file, moving_file)
+    # greedy's RAS transform maps the fixed point x to the moving point x + shift
+    assert np.allclose(transform[:3, 3], (-4.0, 6.0, 5.0), atol=0.5)
+    assert np.allclose(transform[:3, :3], np.eye(3))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# **********************************************************************************************************************
+# File: test_jobControl.py
+# Project: falcon
+# Created: 19.10.2026
+# Institute: Quantitative Imaging and Medical Physics, Medical University of Vienna
+# Description: Checks the retries, timeouts and speculative re-issue of jobControl.map_jobs on an in-process executor.
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+
+import constants as c  # noqa: E402
+import jobControl  # noqa: E402
+
+
+class Attempts:
+    """
+    Counts the attempts per job across the threads of the executor and records why attempts were stopped
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.stop_reasons = []
+
+    def start(self, job: int) -> int:
+        """
+        :param job: Job that starts an attempt
+        :return: Number of the attempt, starting from 1
+        """
+        with self.lock:
+            self.counts[job] = self.counts.get(job, 0) + 1
+            return self.counts[job]
+
+    def wait_for_stop(self, limit: float) -> None:
+        """
+        Runs like a tool until the driver stops the attempt, raising JobCancelled like run_checked
+        :param limit: Time in seconds after which the test gives up waiting
+        """
+        deadline = time.time() + limit
+        while time.time() < deadline:
+            stop_reason = jobControl.get_stop_reason()
+            if stop_reason is not None:
+                with self.lock:
+                    self.stop_reasons.append(stop_reason)
+                raise jobControl.JobCancelled(stop_reason)
+            time.sleep(0.01)
+        raise AssertionError('Attempt was never stopped')
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=4) as thread_pool:
+        yield thread_pool
+
+
+@pytest.fixture
+def fast_job_control(monkeypatch):
+    monkeypatch.setattr(c, 'JOB_MIN_SAMPLES', 3)
+    monkeypatch.setattr(c, 'JOB_MIN_TIMEOUT', 0)
+
+
+def test_failed_job_is_retried(executor, tmp_path):
+    attempts = Attempts()
+
+    def job(index):
+        if index == 1 and attempts.start(index) == 1:
+            raise RuntimeError('tool crashed')
+        return index * 10
+
+    durations = []
+    results = jobControl.map_jobs(job, [0, 1, 2], 2, executor=executor, control_root=str(tmp_path),
+                                  durations=durations)
+    assert results == [0, 10, 20]
+    assert attempts.counts[1] == 2
+    assert len(durations) == 3
+
+
+def test_job_failing_every_attempt_raises(executor, tmp_path):
+    attempts = Attempts()
+
+    def job(index):
+        attempts.start(index)
+        raise RuntimeError('tool crashed')
+
+    with pytest.raises(jobControl.JobError):
+        jobControl.map_jobs(job, [0], 1, executor=executor, control_root=str(tmp_path), max_attempts=2)
+    assert attempts.counts[0] == 2
+    # The control folder of the cancel files is removed
+    assert os.listdir(tmp_path) == []
+
+
+def test_hanging_job_times_out_and_is_retried(executor, tmp_path, fast_job_control, monkeypatch):
+    monkeypatch.setattr(c, 'JOB_TIMEOUT_FACTOR', 4.0)
+    monkeypatch.setattr(c, 'JOB_STRAGGLER_FACTOR', 1000.0)
+    attempts = Attempts()
+
+    def job(index):
+        if index == 3 and attempts.start(index) == 1:
+            attempts.wait_for_stop(limit=20)
+        time.sleep(0.05)
+        return index
+
+    results = jobControl.map_jobs(job, [0, 1, 2, 3], 4, executor=executor, control_root=str(tmp_path))
+    assert results == [0, 1, 2, 3]
+    assert attempts.counts[3] == 2
+    assert attempts.stop_reasons[0].startswith('timed out')
+
+
+def test_first_copy_of_a_straggler_wins(executor, tmp_path, fast_job_control, monkeypatch):
+    monkeypatch.setattr(c, 'JOB_TIMEOUT_FACTOR', 1000.0)
+    monkeypatch.setattr(c, 'JOB_STRAGGLER_FACTOR', 2.0)
+    attempts = Attempts()
+
+    def job(index):
+        if index == 3 and attempts.start(index) == 1:
+            attempts.wait_for_stop(limit=20)
+            return 'straggler'
+        time.sleep(0.05)
+        return 'copy' if index == 3 else index
+
+    results = jobControl.map_jobs(job, [0, 1, 2, 3], 4, executor=executor, control_root=str(tmp_path))
+    assert results == [0, 1, 2, 'copy']
+    assert attempts.counts[3] == 2
+    executor.shutdown(wait=True)
+    # The straggler is stopped, either by its cancel file or because the control folder is gone
+    assert attempts.stop_reasons and attempts.stop_reasons[0] in ('superseded by a faster copy', 'job finished')
+
+
+def test_no_speculative_copy_without_speculation(executor, tmp_path, fast_job_control, monkeypatch):
+    monkeypatch.setattr(c, 'JOB_TIMEOUT_FACTOR', 1000.0)
+    monkeypatch.setattr(c, 'JOB_STRAGGLER_FACTOR', 2.0)
+    attempts = Attempts()
+
+    def job(index):
+        attempts.start(index)
+        time.sleep(1.5 if index == 3 else 0.05)
+        return index
+
+    results = jobControl.map_jobs(job, [0, 1, 2, 3], 4, executor=executor, control_root=str(tmp_path),
+                                  speculate=False)
+    assert results == [0, 1, 2, 3]
+    assert attempts.counts[3] == 1